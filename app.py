@@ -1,5 +1,11 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
+import os
+import threading
+import time
+from dataclasses import asdict
+from urllib.parse import quote
 import requests
+from requests.adapters import HTTPAdapter
 
 app = Flask(__name__)
 
@@ -7,6 +13,90 @@ WRITER_URL = "http://localhost:4001"
 READER_URL = "http://localhost:4003"
 ANALYTICS_URL = "http://localhost:4002"
 
+# Seconds to connect to a backend and to wait for its answer
+CONNECT_TIMEOUT = float(os.getenv('GATEWAY_CONNECT_TIMEOUT', '1'))
+READ_TIMEOUT = float(os.getenv('GATEWAY_READ_TIMEOUT', '5'))
+POOL_SIZE = int(os.getenv('GATEWAY_POOL_SIZE', '32'))  # Kept-alive connections per backend
+STATS_TTL = float(os.getenv('GATEWAY_STATS_TTL', '1'))  # Seconds /api/stats is served from memory
+
+# GATEWAY_DIRECT=1 attaches the gateway to the cache itself: /api/get and
+# /api/stats read shared memory instead of going through the reader and
+# analytics services. Writes still go to the writer, which logs them,
+# unless GATEWAY_DIRECT_WRITES=1 as well.
+DIRECT = os.getenv('GATEWAY_DIRECT', '0') == '1'
+DIRECT_WRITES = DIRECT and os.getenv('GATEWAY_DIRECT_WRITES', '0') == '1'
+
+if DIRECT:
+    from memstream import Cache
+    cache = Cache()
+
+
+def backend_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+    session.mount('http://', adapter)
+    return session
+
+
+# One pool per backend, so a slow service cannot use up another's connections
+sessions = {url: backend_session() for url in (WRITER_URL, READER_URL, ANALYTICS_URL)}
+
+
+def forward(method: str, base: str, path: str, **kwargs):
+    """Call a backend and return its (body, status, content type) unchanged"""
+    try:
+        response = sessions[base].request(method, f"{base}{path}",
+                                          timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+    except requests.Timeout:
+        return b'{"error": "Backend timed out"}\n', 504, 'application/json'
+    except requests.ConnectionError:
+        return b'{"error": "Backend unavailable"}\n', 502, 'application/json'
+    return response.content, response.status_code, response.headers.get('Content-Type')
+
+
+def respond(result) -> Response:
+    body, status, content_type = result
+    return Response(body, status=status, content_type=content_type)
+
+
+class SingleFlight:
+    """Runs one call per key at a time; callers that arrive while it is in
+    flight wait for it and share its result"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> [done event, result]
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = [threading.Event(), None]
+        if not leader:
+            call[0].wait()
+            return call[1]
+        try:
+            call[1] = fn()
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+        return call[1]
+
+
+gets = SingleFlight()
+stats_fetches = SingleFlight()
+stats_cache = {'entry': (0.0, None)}  # (expires_at, result), replaced as a whole
+
+
+def fetch_stats():
+    result = forward('GET', ANALYTICS_URL, '/stats')
+    if result[1] == 200:
+        stats_cache['entry'] = (time.monotonic() + STATS_TTL, result)
+    return result
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -14,24 +104,61 @@ def index():
 @app.route('/api/set', methods=['POST'])
 def set_value():
     data = request.json
-    response = requests.post(f"{WRITER_URL}/set", json=data)
-    return jsonify(response.json()), response.status_code
+    if DIRECT_WRITES:
+        data = data if isinstance(data, dict) else {}
+        key, value, ttl_ms = data.get('key'), data.get('value'), data.get('ttl_ms', 0)
+        # Same checks and answers as the writer's /set
+        if not key or not value:
+            return jsonify({'error': 'Missing key or value'}), 400
+        if not isinstance(key, str) or not isinstance(value, str):
+            return jsonify({'error': 'key and value must be strings'}), 400
+        if not isinstance(ttl_ms, int) or isinstance(ttl_ms, bool) or ttl_ms < 0:
+            return jsonify({'error': 'ttl_ms must be a non-negative integer'}), 400
+        if cache.set(key, value, ttl_ms):
+            return jsonify({'message': 'Value set successfully'})
+        return jsonify({'error': 'Failed to set value'}), 500
+    return respond(forward('POST', WRITER_URL, '/set', json=data))
 
 @app.route('/api/get/<key>')
 def get_value(key):
-    response = requests.get(f"{READER_URL}/get/{key}")
-    return jsonify(response.json()), response.status_code
+    if DIRECT:
+        # A get from shared memory is a copy under a read lock: there is no
+        # backend to protect with single-flight and nothing that can hang
+        # long enough to need a timeout
+        value = cache.get(key)
+        if value is not None:
+            return jsonify({'key': key, 'value': value.decode('utf-8', errors='replace')})
+        return jsonify({'error': f'Key not found: {key}'}), 404
+    path = f"/get/{quote(key, safe='')}"
+    return respond(gets.do(key, lambda: forward('GET', READER_URL, path)))
 
 @app.route('/api/delete', methods=['DELETE'])
 def delete_value():
     data = request.json
-    response = requests.delete(f"{WRITER_URL}/delete", json=data)
-    return jsonify(response.json()), response.status_code
+    if DIRECT_WRITES:
+        key = data.get('key') if isinstance(data, dict) else None
+        if not key:
+            return jsonify({'error': 'Missing key'}), 400
+        if not isinstance(key, str):
+            return jsonify({'error': 'key must be a string'}), 400
+        if cache.delete(key):
+            return jsonify({'message': 'Value deleted successfully'})
+        return jsonify({'error': 'Failed to delete value'}), 500
+    return respond(forward('DELETE', WRITER_URL, '/delete', json=data))
 
 @app.route('/api/stats')
 def get_stats():
-    response = requests.get(f"{ANALYTICS_URL}/stats")
-    return jsonify(response.json()), response.status_code
+    if DIRECT:
+        # Reading the counters is cheaper than caching them
+        stats = cache.stats()
+        if stats is None:
+            return jsonify({'error': 'Failed to get cache statistics'}), 500
+        return jsonify({**asdict(stats), 'hit_ratio': f"{stats.hit_ratio:.2%}"})
+    # Dashboards poll this; one fetch per STATS_TTL is shared by all of them
+    expires_at, result = stats_cache['entry']
+    if time.monotonic() < expires_at:
+        return respond(result)
+    return respond(stats_fetches.do('stats', fetch_stats))
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000)
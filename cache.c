@@ -1,227 +1,1103 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
-#include <sys/shm.h>
 #include <sys/stat.h>
 #include <errno.h>
 #include <unistd.h>
 #include <fcntl.h>
+#include <sys/mman.h>
 #include "cache_internal.h"
 #include <bits/pthreadtypes.h>
 
 static cache_t* cache = NULL;
-static int shm_id = -1;
+static segment_t segment;
 
-int cache_connect(void) {
+int cache_connect_name(const char* name) {
     if (cache != NULL) {
+        if (!name) {
+            name = segment_default_name();
+        }
+        if (strcmp(name, segment.name) != 0) {
+            printf("Already connected to cache '%s', not '%s'\n", segment.name, name);
+            return -1;
+        }
         return 0;  //already connected
     }
 
-    shm_id = shmget(SHM_KEY, 0, 0666);
-    if (shm_id == -1) {
-        printf("Failed to find shared memory: %s\n", strerror(errno));
+    // attach to shared memory
+    if (segment_attach(&segment, name) != 0) {
         return -1;
     }
+    cache = (cache_t*)segment.base;
 
-    // attach to shared memory
-    cache = (cache_t*)shmat(shm_id, NULL, 0);
-    if (cache == (void*)-1) {
-        printf("Failed to attach to shared memory: %s\n", strerror(errno));
+    // The layout is whatever the manager chose; refuse segments written by
+    // a different build rather than misreading them. magic is published
+    // last, so once it is seen everything else is initialized
+    uint32_t magic = __atomic_load_n(&cache->magic, __ATOMIC_ACQUIRE);
+    if (magic == 0) {
+        printf("Shared memory segment is still being initialized\n");
+        segment_detach(&segment);
+        cache = NULL;
+        return -1;
+    }
+    if (magic != CACHE_MAGIC || cache->version != CACHE_LAYOUT_VERSION) {
+        printf("Shared memory segment has layout version %u, expected %u\n",
+               magic == CACHE_MAGIC ? cache->version : 0, CACHE_LAYOUT_VERSION);
+        segment_detach(&segment);
+        cache = NULL;
         return -1;
     }
 
     return 0;
 }
 
+int cache_connect(void) {
+    return cache_connect_name(NULL);
+}
+
+void cache_config_init(cache_config_t* config) {
+    memset(config, 0, sizeof(*config));
+    config->max_memory = 1024 * 1024;
+    config->max_entries = DEFAULT_MAX_ENTRIES;
+    config->max_key_length = DEFAULT_KEY_LENGTH;
+    config->evict_policy = CACHE_EVICT_LRU;
+    config->shards = 8;
+    config->optimistic_reads = 1;
+}
+
 int cache_init(size_t max_memory_size) {
+    cache_config_t config;
+    cache_config_init(&config);
+    config.max_memory = max_memory_size;
+    return cache_init_config(&config);
+}
+
+static size_t round_up(size_t n, size_t align) {
+    return (n + align - 1) / align * align;
+}
+
+static uint32_t next_pow2(uint32_t n) {
+    uint32_t p = 1;
+    while (p < n) {
+        p <<= 1;
+    }
+    return p;
+}
+
+// Lay out one shard header and its regions; the first shard is used as a
+// template whose offsets every other shard copies
+static void layout_shard(shard_t* s, const cache_config_t* config) {
+    memset(s, 0, sizeof(*s));
+    s->nentries = (uint32_t)((config->max_entries + config->shards - 1) / config->shards);
+    s->index_size = next_pow2(2 * s->nentries);
+    s->sketch_width = config->evict_policy == CACHE_EVICT_TINYLFU
+                          ? next_pow2(s->nentries) : 0;
+    s->entries_offset = round_up(sizeof(shard_t), CACHE_LINE);
+    s->index_offset = round_up(s->entries_offset + (size_t)s->nentries * sizeof(entry_t),
+                               CACHE_LINE);
+    s->sketch_offset = round_up(s->index_offset + (size_t)s->index_size * sizeof(uint32_t),
+                                CACHE_LINE);
+    s->arena_offset = round_up(s->sketch_offset + (size_t)SKETCH_ROWS * s->sketch_width,
+                               CACHE_LINE);
+}
+
+static void init_shard(shard_t* s, const shard_t* layout, size_t arena_bytes,
+                       cache_evict_policy_t policy) {
+    *s = *layout;
+
+    pthread_rwlockattr_t attr;
+    pthread_rwlockattr_init(&attr);
+    pthread_rwlockattr_setpshared(&attr, PTHREAD_PROCESS_SHARED);
+    pthread_rwlock_init(&s->lock, &attr);
+    pthread_rwlockattr_destroy(&attr);
+
+    entry_t* entries = shard_entries(s);
+    memset(entries, 0, sizeof(entry_t) * s->nentries);
+    for (uint32_t i = 0; i < s->nentries; i++) {
+        entries[i].next_free = i + 1;
+    }
+    s->free_head = 0;
+    memset(shard_index(s), 0, sizeof(uint32_t) * s->index_size);
+    s->index_tombstones = 0;
+
+    arena_init(shard_arena(s), arena_bytes - sizeof(arena_t));
+    s->stats.total_size = arena_bytes;
+    evict_init(s, policy);
+}
+
+// In a file-backed segment the kernel decides what stays in memory. Every
+// lookup reads a shard's header, entry table and index, so those are read
+// in up front (and locked with lock_memory); values get the configured
+// access pattern and page in and out as they are used.
+static void advise_file_backing(const cache_config_t* config, size_t arena_bytes) {
+    static const int advice[] = {MADV_RANDOM, MADV_NORMAL, MADV_SEQUENTIAL};
+    size_t locked = 0;
+    for (uint32_t i = 0; i < cache->nshards; i++) {
+        shard_t* s = cache_shard(cache, i);
+        size_t offset = (char*)s - (char*)cache;
+        segment_advise(&segment, offset + s->arena_offset, arena_bytes,
+                       advice[config->value_access]);
+        segment_advise(&segment, offset, s->arena_offset, MADV_WILLNEED);
+        if (config->lock_memory && segment_lock(&segment, offset, s->arena_offset) == 0) {
+            locked += s->arena_offset;
+        }
+    }
+    if (config->lock_memory) {
+        if (segment_lock(&segment, 0, cache->shards_offset) == 0) {
+            locked += cache->shards_offset;
+        }
+        if (cache->wal_offset &&
+            segment_lock(&segment, cache->wal_offset, segment.size - cache->wal_offset) == 0) {
+            locked += segment.size - cache->wal_offset;
+        }
+        printf("Locked %zu bytes of metadata in memory\n", locked);
+    }
+}
+
+int cache_init_config(const cache_config_t* config) {
+    size_t max_memory_size = config->max_memory;
     printf("Initializing cache with size: %zu bytes\n", max_memory_size);
 
     if (cache != NULL) {
         printf("Error: Cache already initialized\n");
         return -1;
     }
-
-    shm_id = shmget(SHM_KEY, sizeof(cache_t) + max_memory_size,
-                    IPC_CREAT | 0666);
-    if (shm_id == -1) {
-        printf("shmget failed: %s\n", strerror(errno));
+    if (config->shards == 0 || config->shards > MAX_SHARDS) {
+        printf("Error: shard count must be between 1 and %d\n", MAX_SHARDS);
+        return -1;
+    }
+    if (config->max_entries < config->shards ||
+        config->max_entries / config->shards >= MAX_SHARD_ENTRIES) {
+        printf("Error: entry count must be between %u and %zu\n", config->shards,
+               (size_t)MAX_SHARD_ENTRIES * config->shards - 1);
+        return -1;
+    }
+    if ((unsigned)config->value_access > CACHE_ACCESS_SEQUENTIAL) {
+        printf("Error: unknown value access pattern %d\n", (int)config->value_access);
+        return -1;
+    }
+    if (config->max_key_length == 0 || config->max_key_length > UINT16_MAX) {
+        printf("Error: key length must be between 1 and %u\n", UINT16_MAX);
         return -1;
     }
-    printf("Created shared memory segment: %d\n", shm_id);
 
-    cache = (cache_t*)shmat(shm_id, NULL, 0);
-    if (cache == (void*)-1) {
-        printf("shmat failed: %s\n", strerror(errno));
+    shard_t layout;
+    layout_shard(&layout, config);
+    size_t arena_bytes = round_up(max_memory_size / config->shards, CACHE_LINE);
+    if (arena_bytes <= sizeof(arena_t)) {
+        printf("Error: %zu bytes is too small for %u shards\n",
+               max_memory_size, config->shards);
         return -1;
     }
-    printf("Attached to shared memory at: %p\n", (void*)cache);
+    size_t shards_offset = round_up(sizeof(cache_t), CACHE_LINE);
+    size_t shard_size = round_up(layout.arena_offset + arena_bytes, CACHE_LINE);
+    size_t segment_size = shards_offset + shard_size * config->shards;
+    size_t wal_offset = 0;
+    size_t wal_size = 0;
+    if (config->wal_buffer) {
+        wal_size = CACHE_LINE;
+        while (wal_size < config->wal_buffer) {
+            wal_size <<= 1;
+        }
+        wal_offset = segment_size;
+        segment_size += sizeof(wal_ring_t) + wal_size;
+    }
 
-    //initialize cache structure
-    pthread_rwlockattr_t attr;
-    pthread_rwlockattr_init(&attr);
-    pthread_rwlockattr_setpshared(&attr, PTHREAD_PROCESS_SHARED);
-    pthread_rwlock_init(&cache->lock, &attr);
-    pthread_rwlockattr_destroy(&attr);
+    if (segment_create(&segment, config, segment_size) != 0) {
+        return -1;
+    }
+    cache = (cache_t*)segment.base;
+    printf("Layout: %u shards of %u entries, %zu-byte arenas, %zu bytes in total\n",
+           config->shards, layout.nentries, arena_bytes, segment_size);
 
+    //initialize cache structure; magic is set last, see below
+    cache->version = CACHE_LAYOUT_VERSION;
+    cache->segment_size = segment_size;
+    cache->max_entries = (size_t)layout.nentries * config->shards;
+    cache->max_key_length = config->max_key_length;
     cache->max_memory = max_memory_size;
-    cache->used_memory = 0;
-    memset(&cache->stats, 0, sizeof(cache_stats_t));
-    cache->stats.total_size = max_memory_size;  //initialize total size
-    memset(cache->entries, 0, sizeof(entry_t) * MAX_ENTRIES);
+    cache->nshards = config->shards;
+    cache->shards_offset = shards_offset;
+    cache->shard_size = shard_size;
+    cache->optimistic_reads = config->optimistic_reads;
+    cache->next_stripe = 0;
+    memset(cache->read_stats, 0, sizeof(cache->read_stats));
+    cache->trace_enabled = 0;
+    memset(cache->trace, 0, sizeof(cache->trace));
+    cache->wal_enabled = 0;
+    cache->wal_offset = wal_offset;
+    if (wal_offset) {
+        wal_ring_t* ring = cache_wal(cache);
+        memset(ring, 0, sizeof(*ring));
+        ring->size = wal_size;
+    }
+    for (uint32_t i = 0; i < cache->nshards; i++) {
+        init_shard(cache_shard(cache, i), &layout, arena_bytes, config->evict_policy);
+    }
+    if (segment.file_backed) {
+        advise_file_backing(config, arena_bytes);
+    }
 
+    // Clients may attach as soon as the segment exists; they only use it
+    // once they see magic, which is released after every shard is ready
+    __atomic_store_n(&cache->magic, CACHE_MAGIC, __ATOMIC_RELEASE);
     return 0;
 }
 
 void cache_destroy(void) {
     if (cache) {
-        pthread_rwlock_destroy(&cache->lock);
-        shmdt(cache);
-        if (shm_id != -1) {
-            shmctl(shm_id, IPC_RMID, NULL);
+        for (uint32_t i = 0; i < cache->nshards; i++) {
+            shard_t* s = cache_shard(cache, i);
+            pthread_rwlock_destroy(&s->lock);
+            pthread_mutex_destroy(&s->lru_lock);
         }
+        segment_remove(&segment);
         cache = NULL;
-        shm_id = -1;
     }
 }
 
-static entry_t* find_entry(const char* key) {
-    for (size_t i = 0; i < MAX_ENTRIES; i++) {
-        if (cache->entries[i].is_valid &&
-            strcmp(cache->entries[i].key, key) == 0) {
-            return &cache->entries[i];
+// FNV-1a with a final avalanche so that linear probing sees well-mixed
+// low bits even for keys that only differ in their last characters
+static uint32_t hash_key(const char* key) {
+    uint64_t h = 14695981039346656037ULL;
+    for (const unsigned char* p = (const unsigned char*)key; *p; p++) {
+        h ^= *p;
+        h *= 1099511628211ULL;
+    }
+    h ^= h >> 33;
+    h *= 0xff51afd7ed558ccdULL;
+    h ^= h >> 33;
+    return (uint32_t)h;
+}
+
+// The high bits of the hash pick the shard, the low bits the index slot
+static shard_t* shard_for(uint32_t hash) {
+    return cache_shard(cache, (uint32_t)(((uint64_t)hash * cache->nshards) >> 32));
+}
+
+static uint32_t shard_id(const shard_t* s) {
+    return (uint32_t)(((const char*)s - (const char*)cache - cache->shards_offset) /
+                      cache->shard_size);
+}
+
+// Returns the index slot holding key, or -1 when the key is absent
+static long find_slot(shard_t* s, const char* key, uint32_t hash) {
+    uint32_t* index = shard_index(s);
+    entry_t* entries = shard_entries(s);
+    size_t mask = s->index_size - 1;
+    for (size_t i = hash & mask, n = 0; n < s->index_size; i = (i + 1) & mask, n++) {
+        uint32_t slot = index[i];
+        if (slot == INDEX_EMPTY) {
+            return -1;
+        }
+        if (slot == INDEX_TOMBSTONE) {
+            continue;
+        }
+        entry_t* entry = &entries[slot - 1];
+        if (entry->hash == hash && strcmp(entry_key(s, entry), key) == 0) {
+            return (long)i;
         }
     }
-    return NULL;
+    return -1;
 }
 
-static entry_t* find_free_entry(void) {
-    for (size_t i = 0; i < MAX_ENTRIES; i++) {
-        if (!cache->entries[i].is_valid) {
-            return &cache->entries[i];
+static entry_t* find_entry(shard_t* s, const char* key, uint32_t hash) {
+    long i = find_slot(s, key, hash);
+    return i < 0 ? NULL : &shard_entries(s)[shard_index(s)[i] - 1];
+}
+
+static void index_insert(shard_t* s, entry_t* entry) {
+    uint32_t* index = shard_index(s);
+    size_t mask = s->index_size - 1;
+    size_t i = entry->hash & mask;
+    while (index[i] != INDEX_EMPTY && index[i] != INDEX_TOMBSTONE) {
+        i = (i + 1) & mask;
+    }
+    if (index[i] == INDEX_TOMBSTONE) {
+        s->index_tombstones--;
+    }
+    index[i] = (uint32_t)(entry - shard_entries(s)) + 1;
+}
+
+// Rehash every live entry into a clean index, dropping all tombstones
+static void index_rebuild(shard_t* s) {
+    entry_t* entries = shard_entries(s);
+    memset(shard_index(s), 0, sizeof(uint32_t) * s->index_size);
+    s->index_tombstones = 0;
+    for (size_t i = 0; i < s->nentries; i++) {
+        if (entries[i].is_valid) {
+            index_insert(s, &entries[i]);
         }
     }
-    return NULL;
 }
 
-int cache_set(const char* key, const void* value, size_t value_size) {
-    printf("\nDEBUG: cache_set called with key=%s, size=%zu\n", key, value_size);
+static void index_remove(shard_t* s, size_t i) {
+    uint32_t* index = shard_index(s);
+    size_t mask = s->index_size - 1;
+    if (index[(i + 1) & mask] == INDEX_EMPTY) {
+        // End of a probe chain: trailing tombstones can become empty too
+        index[i] = INDEX_EMPTY;
+        i = (i - 1) & mask;
+        while (index[i] == INDEX_TOMBSTONE) {
+            index[i] = INDEX_EMPTY;
+            s->index_tombstones--;
+            i = (i - 1) & mask;
+        }
+        return;
+    }
+    index[i] = INDEX_TOMBSTONE;
+    if (++s->index_tombstones > s->index_size / 4) {
+        index_rebuild(s);
+    }
+}
 
-    if (!cache || !key || !value || value_size == 0 ||
-        strlen(key) >= MAX_KEY_LENGTH) {
+static entry_t* find_free_entry(shard_t* s) {
+    if (s->free_head >= s->nentries) {
+        return NULL;
+    }
+    entry_t* entry = &shard_entries(s)[s->free_head];
+    s->free_head = entry->next_free;
+    return entry;
+}
+
+static void release_entry(shard_t* s, entry_t* entry) {
+    entry->is_valid = 0;
+    entry->next_free = s->free_head;
+    s->free_head = (uint32_t)(entry - shard_entries(s));
+}
+
+// Wall clock in milliseconds, the unit of entry_t.expires_at
+static uint64_t now_ms(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_REALTIME, &ts);
+    return (uint64_t)ts.tv_sec * 1000 + (uint64_t)ts.tv_nsec / 1000000;
+}
+
+// Only entries with a TTL pay for reading the clock
+static int is_expired(uint64_t expires_at) {
+    return expires_at != 0 && now_ms() >= expires_at;
+}
+
+// Unlink an entry from the index, the eviction policy and the arena
+static void remove_entry(shard_t* s, entry_t* entry, long slot) {
+    s->stats.used_size -= entry->value_size;
+    s->stats.total_entries--;
+    if (entry->expires_at) {
+        s->ttl_entries--;
+    }
+    evict_remove(s, entry);
+    seq_write_begin(&entry->seq);
+    arena_free(shard_arena(s), entry->data_offset);
+    release_entry(s, entry);
+    seq_write_end(&entry->seq);
+    seq_write_begin(&s->index_seq);
+    index_remove(s, (size_t)slot);
+    seq_write_end(&s->index_seq);
+}
+
+// Evict one entry chosen by the policy to make room for the key with the
+// given hash. The first eviction for a new key also runs the admission
+// check; *admitted records that it passed. Returns -1 when nothing can be
+// evicted or the key is refused.
+static int evict_one(shard_t* s, uint32_t hash, const entry_t* keep, int* admitted) {
+    entry_t* victim = evict_victim(s, keep);
+    if (!victim) {
         return -1;
     }
+    if (!*admitted) {
+        if (!evict_admit(s, hash, victim)) {
+            s->stats.rejections++;
+            TRACE(cache, TRACE_REJECT, shard_id(s), NULL, hash, 0);
+            return -1;
+        }
+        *admitted = 1;
+    }
+    TRACE(cache, TRACE_EVICT, shard_id(s), entry_key(s, victim), victim->value_size, 0);
+    remove_entry(s, victim, find_slot(s, entry_key(s, victim), victim->hash));
+    s->stats.evictions++;
+    return 0;
+}
+
+// Allocate size bytes for entry's value and key, evicting others until
+// they fit
+static size_t alloc_value(shard_t* s, entry_t* entry, size_t size, int* admitted) {
+    arena_t* arena = shard_arena(s);
+    uint32_t owner = (uint32_t)(entry - shard_entries(s));
+    size_t offset;
+    while ((offset = arena_alloc(arena, size, owner)) == ARENA_NONE) {
+        if (evict_one(s, entry->hash, entry->is_valid ? entry : NULL, admitted) != 0) {
+            break;
+        }
+    }
+    return offset;
+}
+
+// Record a read or update of entry. Readers may race with each other and,
+// on the optimistic path, with the entry being reused, so these are only
+// ever approximate and are updated with relaxed atomics.
+static void touch_entry(shard_t* s, entry_t* entry, time_t now) {
+    evict_touch(s, entry, now);
+    if (__atomic_load_n(&entry->last_access, __ATOMIC_RELAXED) != (uint32_t)now) {
+        __atomic_store_n(&entry->last_access, (uint32_t)now, __ATOMIC_RELAXED);
+    }
+    __atomic_fetch_add(&entry->access_count, 1, __ATOMIC_RELAXED);
+}
+
+static int valid_key(const char* key) {
+    return key && strnlen(key, (size_t)cache->max_key_length + 1) <= cache->max_key_length;
+}
+
+// Store one value, expiring at expires_at (0 for never); the caller holds
+// the shard's write lock
+static int set_locked(shard_t* s, const char* key, uint32_t hash,
+                      const void* value, size_t value_size, uint64_t expires_at,
+                      time_t now) {
+    arena_t* arena = shard_arena(s);
+    size_t key_size = strlen(key) + 1;
+    size_t need = value_size + key_size;  // The block holds the value, then the key
+    if (!value || value_size == 0 || need + sizeof(block_t) > arena->size) {
+        TRACE(cache, TRACE_SET_FAIL, shard_id(s), key, value_size, 0);
+        return -1;  // Larger than a whole shard, evicting cannot help
+    }
 
-    pthread_rwlock_wrlock(&cache->lock);
+    evict_record(s, hash);
+    evict_age(s);
 
-    entry_t* entry = find_entry(key);
+    entry_t* entry = find_entry(s, key, hash);
     if (entry) {
-        if (value_size != entry->value_size) {
-            cache->used_memory = cache->used_memory - entry->value_size + value_size;
-            cache->stats.used_size = cache->used_memory;
-            printf("Updated memory usage: old=%zu, new=%zu, total=%zu\n",
-                   entry->value_size, value_size, cache->used_memory);
+        size_t offset = entry->data_offset;
+        if (need > arena_capacity(arena, offset) || arena_pinned(arena, offset)) {
+            // Grow, or leave a pinned value alone, by moving to a new
+            // block; the old value stays intact if the arena has no room
+            int admitted = 1;
+            offset = alloc_value(s, entry, need, &admitted);
+            if (offset == ARENA_NONE) {
+                TRACE(cache, TRACE_SET_FAIL, shard_id(s), key, value_size, 0);
+                return -1;
+            }
         }
-        memcpy(cache->data + entry->data_offset, value, value_size);
+        seq_write_begin(&entry->seq);
+        TRACE(cache, TRACE_SET_UPDATE, shard_id(s), key, entry->value_size, value_size);
+        char* block = arena_ptr(arena, offset);
+        if (offset != entry->data_offset) {
+            memcpy(block + value_size, key, key_size);
+            arena_free(arena, entry->data_offset);
+            entry->data_offset = offset;
+        } else {
+            // Slide the key to just past the new value before writing it
+            memmove(block + value_size, block + entry->value_size, key_size);
+        }
+        memcpy(block, value, value_size);
+        arena_shrink(arena, offset, need);
+        s->stats.used_size = s->stats.used_size - entry->value_size + value_size;
         entry->value_size = value_size;
+        s->ttl_entries += (expires_at != 0) - (entry->expires_at != 0);
+        entry->expires_at = expires_at;
+        seq_write_end(&entry->seq);
+        touch_entry(s, entry, now);
     } else {
-        if (cache->used_memory + value_size > cache->max_memory) {
-            pthread_rwlock_unlock(&cache->lock);
-            return -1;
+        int admitted = 0;
+        while (!(entry = find_free_entry(s))) {
+            if (evict_one(s, hash, NULL, &admitted) != 0) {
+                TRACE(cache, TRACE_SET_FAIL, shard_id(s), key, value_size, 0);
+                return -1;
+            }
         }
-        entry = find_free_entry();
-        if (!entry) {
-            pthread_rwlock_unlock(&cache->lock);
+        // The entry may still be found through a stale index slot by an
+        // optimistic reader, so it stays odd until fully written
+        seq_write_begin(&entry->seq);
+        entry->hash = hash;
+        entry->is_valid = 0;
+        size_t offset = alloc_value(s, entry, need, &admitted);
+        if (offset == ARENA_NONE) {
+            release_entry(s, entry);
+            seq_write_end(&entry->seq);
+            TRACE(cache, TRACE_SET_FAIL, shard_id(s), key, value_size, 0);
             return -1;
         }
-        strcpy(entry->key, key);
-        entry->data_offset = cache->used_memory;
+        entry->key_len = (uint16_t)(key_size - 1);
+        entry->access_count = 1;
+        entry->last_access = now;
+        entry->data_offset = offset;
         entry->value_size = value_size;
         entry->is_valid = 1;
-        entry->created_at = time(NULL);
+        entry->created_at = now;
+        entry->expires_at = expires_at;
+        s->ttl_entries += expires_at != 0;
+        memcpy(arena_ptr(arena, offset), value, value_size);
+        memcpy(entry_key(s, entry), key, key_size);
+        seq_write_begin(&s->index_seq);
+        index_insert(s, entry);
+        seq_write_end(&s->index_seq);
+        seq_write_end(&entry->seq);
+        evict_insert(s, entry);
 
-        memcpy(cache->data + entry->data_offset, value, value_size);
-        cache->used_memory += value_size;
-        cache->stats.used_size = cache->used_memory;
-        cache->stats.total_entries++;
+        s->stats.used_size += value_size;
+        s->stats.total_entries++;
+        TRACE(cache, TRACE_SET_NEW, shard_id(s), key, value_size, offset);
+    }
+    WAL_LOG(cache, WAL_SET, key, key_size - 1, value, value_size, expires_at);
+    return 0;
+}
 
-        printf("New entry: key=%s, size=%zu, offset=%zu, total_memory=%zu\n",
-               key, value_size, entry->data_offset, cache->used_memory);
+int cache_set_ex(const char* key, const void* value, size_t value_size,
+                 uint64_t ttl_ms) {
+    if (!cache || !valid_key(key)) {
+        return -1;
     }
 
-    entry->last_access = time(NULL);
-    entry->access_count++;
+    uint32_t hash = hash_key(key);
+    shard_t* s = shard_for(hash);
+    uint64_t expires_at = ttl_ms ? now_ms() + ttl_ms : 0;
+    time_t now = time(NULL);
+    pthread_rwlock_wrlock(&s->lock);
+    int result = set_locked(s, key, hash, value, value_size, expires_at, now);
+    pthread_rwlock_unlock(&s->lock);
+    return result;
+}
 
-    pthread_rwlock_unlock(&cache->lock);
+int cache_set(const char* key, const void* value, size_t value_size) {
+    return cache_set_ex(key, value, value_size, 0);
+}
+
+// Each thread counts its hits and misses in one of a few cache-line sized
+// stripes, so readers on different cores do not fight over one counter
+static stat_stripe_t* stat_stripe(void) {
+    static __thread int stripe = -1;
+    if (stripe < 0) {
+        stripe = (int)(__atomic_fetch_add(&cache->next_stripe, 1, __ATOMIC_RELAXED)
+                       % STAT_STRIPES);
+    }
+    return &cache->read_stats[stripe];
+}
+
+enum { READ_HIT, READ_MISS, READ_SHORT, READ_RETRY, READ_EXPIRED };
+
+#define READ_RETRIES 8  // Optimistic attempts before falling back to the lock
+
+// Copy one value out; the caller holds the shard's lock
+static int get_locked(shard_t* s, const char* key, uint32_t hash,
+                      void* value, size_t* value_size, entry_t** found) {
+    entry_t* entry = find_entry(s, key, hash);
+    int result = READ_MISS;
+    if (entry && is_expired(entry->expires_at)) {
+        result = READ_EXPIRED;
+    } else if (entry) {
+        result = READ_SHORT;
+        if (*value_size >= entry->value_size) {
+            memcpy(value, arena_ptr(shard_arena(s), entry->data_offset), entry->value_size);
+            *found = entry;
+            result = READ_HIT;
+        }
+        *value_size = entry->value_size;
+    }
+    return result;
+}
+
+// Look the key up and copy its value without taking the shard lock. Every
+// field is read speculatively and only trusted once the sequence counters
+// show that no writer touched it meanwhile: the entry's counter for a hit,
+// the index counter for a miss and the compaction counter for the value
+// bytes. Offsets are bounds-checked before use because a torn read can
+// produce any value.
+static int get_optimistic(shard_t* s, const char* key, uint32_t hash,
+                          void* value, size_t* value_size, entry_t** found) {
+    uint32_t index_start = seq_read_begin(&s->index_seq);
+    uint32_t move_start = seq_read_begin(&s->move_seq);
+    uint32_t* index = shard_index(s);
+    entry_t* entries = shard_entries(s);
+    arena_t* arena = shard_arena(s);
+    size_t mask = s->index_size - 1;
+
+    for (size_t i = hash & mask, n = 0; n < s->index_size; i = (i + 1) & mask, n++) {
+        uint32_t slot = __atomic_load_n(&index[i], __ATOMIC_RELAXED);
+        if (slot == INDEX_EMPTY) {
+            break;
+        }
+        if (slot == INDEX_TOMBSTONE || slot - 1 >= s->nentries) {
+            continue;
+        }
+        entry_t* entry = &entries[slot - 1];
+        uint32_t start = seq_read_begin(&entry->seq);
+        if (__atomic_load_n(&entry->hash, __ATOMIC_RELAXED) != hash) {
+            continue;
+        }
+        if (start & 1) {
+            return READ_RETRY;
+        }
+        if (!__atomic_load_n(&entry->is_valid, __ATOMIC_RELAXED)) {
+            continue;
+        }
+
+        size_t size = __atomic_load_n(&entry->value_size, __ATOMIC_RELAXED);
+        size_t offset = __atomic_load_n(&entry->data_offset, __ATOMIC_RELAXED);
+        size_t key_size = (size_t)__atomic_load_n(&entry->key_len, __ATOMIC_RELAXED) + 1;
+        uint64_t expires_at = __atomic_load_n(&entry->expires_at, __ATOMIC_RELAXED);
+        if (offset > arena->size || size > arena->size - offset ||
+            key_size > arena->size - offset - size) {
+            return READ_RETRY;
+        }
+        // The key sits behind the value and moves when the value is
+        // rewritten in place or compacted, so a mismatch only counts once
+        // the counters confirm it was not torn
+        if (strncmp((char*)arena_ptr(arena, offset) + size, key, key_size) != 0) {
+            if (!seq_read_valid(&entry->seq, start) ||
+                !seq_read_valid(&s->move_seq, move_start)) {
+                return READ_RETRY;
+            }
+            continue;
+        }
+
+        int result = READ_SHORT;
+        if (is_expired(expires_at)) {
+            result = READ_EXPIRED;
+        } else if (size <= *value_size) {
+            memcpy(value, arena_ptr(arena, offset), size);
+            result = READ_HIT;
+        }
+        if (!seq_read_valid(&entry->seq, start) ||
+            !seq_read_valid(&s->move_seq, move_start)) {
+            return READ_RETRY;
+        }
+        if (result == READ_EXPIRED) {
+            return result;
+        }
+        *value_size = size;
+        if (result == READ_HIT) {
+            *found = entry;
+        }
+        return result;
+    }
+    return seq_read_valid(&s->index_seq, index_start) ? READ_MISS : READ_RETRY;
+}
+
+// Count a lookup and turn its outcome into cache_get's return code
+static int finish_get(shard_t* s, int result, entry_t* entry, time_t now) {
+    if (result == READ_EXPIRED) {
+        __atomic_fetch_add(&stat_stripe()->expired, 1, __ATOMIC_RELAXED);
+        result = READ_MISS;
+    }
+    if (result == READ_MISS) {
+        __atomic_fetch_add(&stat_stripe()->misses, 1, __ATOMIC_RELAXED);
+        return -1;
+    }
+    if (result == READ_SHORT) {
+        return CACHE_ERR_TOO_SMALL;
+    }
+    __atomic_fetch_add(&stat_stripe()->hits, 1, __ATOMIC_RELAXED);
+    touch_entry(s, entry, now ? now : time(NULL));
     return 0;
 }
 
+static int valid_get_args(const char* key, const void* value, const size_t* value_size) {
+    return key && value_size && (value || *value_size == 0);
+}
+
+// Lock-free get of one key, falling back to the read lock if writers keep
+// getting in the way
+static int get_one(shard_t* s, const char* key, uint32_t hash,
+                   void* value, size_t* value_size, time_t now) {
+    evict_record(s, hash);
+    entry_t* entry = NULL;
+    int result = READ_RETRY;
+    for (int n = 0; cache->optimistic_reads && n < READ_RETRIES && result == READ_RETRY; n++) {
+        result = get_optimistic(s, key, hash, value, value_size, &entry);
+    }
+    if (result == READ_RETRY) {
+        pthread_rwlock_rdlock(&s->lock);
+        result = get_locked(s, key, hash, value, value_size, &entry);
+        pthread_rwlock_unlock(&s->lock);
+    }
+    return finish_get(s, result, entry, now);
+}
+
 int cache_get(const char* key, void* value, size_t* value_size) {
-    if (!cache || !key || !value || !value_size) {
+    if (!cache || !valid_get_args(key, value, value_size)) {
         return -1;
     }
 
-    pthread_rwlock_rdlock(&cache->lock);
+    uint32_t hash = hash_key(key);
+    return get_one(shard_for(hash), key, hash, value, value_size, 0);
+}
 
-    entry_t* entry = find_entry(key);
-    if (!entry) {
-        cache->stats.misses++;
-        pthread_rwlock_unlock(&cache->lock);
+int cache_get_ref(const char* key, const void** value, size_t* value_size) {
+    if (!cache || !key || !value || !value_size) {
         return -1;
     }
 
-    if (*value_size < entry->value_size) {
-        pthread_rwlock_unlock(&cache->lock);
+    uint32_t hash = hash_key(key);
+    shard_t* s = shard_for(hash);
+    evict_record(s, hash);
+
+    // Pins are taken under the read lock so that no writer is deciding
+    // whether the block is still in use at the same time
+    pthread_rwlock_rdlock(&s->lock);
+    entry_t* entry = find_entry(s, key, hash);
+    if (!entry || is_expired(entry->expires_at)) {
+        pthread_rwlock_unlock(&s->lock);
+        if (entry) {
+            __atomic_fetch_add(&stat_stripe()->expired, 1, __ATOMIC_RELAXED);
+        }
+        __atomic_fetch_add(&stat_stripe()->misses, 1, __ATOMIC_RELAXED);
         return -1;
     }
-
-    memcpy(value, cache->data + entry->data_offset, entry->value_size);
+    arena_t* arena = shard_arena(s);
+    arena_pin(arena, entry->data_offset);
+    *value = arena_ptr(arena, entry->data_offset);
     *value_size = entry->value_size;
-    entry->last_access = time(NULL);
-    entry->access_count++;
-    cache->stats.hits++;
+    pthread_rwlock_unlock(&s->lock);
 
-    pthread_rwlock_unlock(&cache->lock);
+    __atomic_fetch_add(&stat_stripe()->hits, 1, __ATOMIC_RELAXED);
+    touch_entry(s, entry, time(NULL));
     return 0;
 }
 
-int cache_delete(const char* key) {
-    printf("\nDEBUG: cache_delete called with key=%s\n", key);
+void cache_release_ref(const void* value) {
+    if (!cache || !value) {
+        return;
+    }
+
+    size_t pos = (size_t)((const char*)value - ((char*)cache + cache->shards_offset));
+    shard_t* s = cache_shard(cache, (uint32_t)(pos / cache->shard_size));
+    arena_t* arena = shard_arena(s);
+    size_t offset = (size_t)((const char*)value - (char*)arena_ptr(arena, 0));
+
+    pthread_rwlock_rdlock(&s->lock);
+    int orphaned = arena_unpin(arena, offset);
+    pthread_rwlock_unlock(&s->lock);
+    if (orphaned) {
+        // The key was changed or removed while pinned; the old value is
+        // unreachable now, so nobody can pin it again before it is freed
+        pthread_rwlock_wrlock(&s->lock);
+        arena_free(arena, offset);
+        pthread_rwlock_unlock(&s->lock);
+    }
+}
 
+// Remove one key; the caller holds the shard's write lock
+static int delete_locked(shard_t* s, const char* key, uint32_t hash) {
+    long slot = find_slot(s, key, hash);
+    if (slot < 0) {
+        return -1;
+    }
+    entry_t* entry = &shard_entries(s)[shard_index(s)[slot] - 1];
+    if (is_expired(entry->expires_at)) {
+        // Already gone as far as readers are concerned
+        TRACE(cache, TRACE_EXPIRE, shard_id(s), key, entry->value_size,
+              now_ms() - entry->expires_at);
+        remove_entry(s, entry, slot);
+        s->stats.reaped++;
+        return -1;
+    }
+    TRACE(cache, TRACE_DELETE, shard_id(s), key, entry->value_size, 0);
+    WAL_LOG(cache, WAL_DELETE, key, entry->key_len, NULL, 0, 0);
+    remove_entry(s, entry, slot);
+    return 0;
+}
+
+int cache_delete(const char* key) {
     if (!cache || !key) {
         return -1;
     }
 
-    pthread_rwlock_wrlock(&cache->lock);
+    uint32_t hash = hash_key(key);
+    shard_t* s = shard_for(hash);
+    pthread_rwlock_wrlock(&s->lock);
+    int result = delete_locked(s, key, hash);
+    pthread_rwlock_unlock(&s->lock);
+    return result;
+}
+
+// Batched calls visit the keys shard by shard so that each shard is locked
+// once per call rather than once per key. batch_t holds the keys' hashes
+// and their positions sorted by shard (a counting sort, stable within a
+// shard so duplicate keys are applied in order).
+typedef struct {
+    uint32_t* hashes;
+    uint32_t* shards;
+    size_t* order;
+} batch_t;
 
-    entry_t* entry = find_entry(key);
-    if (!entry) {
-        pthread_rwlock_unlock(&cache->lock);
+static int batch_init(batch_t* batch, size_t count, const char* const* keys) {
+    batch->hashes = malloc(count * sizeof(uint32_t));
+    batch->shards = malloc(count * sizeof(uint32_t));
+    batch->order = malloc(count * sizeof(size_t));
+    size_t* starts = calloc(cache->nshards + 1, sizeof(size_t));
+    if (!batch->hashes || !batch->shards || !batch->order || !starts) {
+        free(batch->hashes);
+        free(batch->shards);
+        free(batch->order);
+        free(starts);
         return -1;
     }
 
-    cache->used_memory -= entry->value_size;
-    cache->stats.used_size = cache->used_memory;
-    cache->stats.total_entries--;
-    entry->is_valid = 0;
-
-    printf("DEBUG: After delete - used_memory=%zu\n", cache->used_memory);
-    pthread_rwlock_unlock(&cache->lock);
+    for (size_t i = 0; i < count; i++) {
+        batch->hashes[i] = keys[i] ? hash_key(keys[i]) : 0;
+        batch->shards[i] = (uint32_t)(((uint64_t)batch->hashes[i] * cache->nshards) >> 32);
+        starts[batch->shards[i] + 1]++;
+    }
+    for (uint32_t i = 0; i < cache->nshards; i++) {
+        starts[i + 1] += starts[i];
+    }
+    for (size_t i = 0; i < count; i++) {
+        batch->order[starts[batch->shards[i]]++] = i;
+    }
+    free(starts);
     return 0;
 }
 
+static void batch_free(batch_t* batch) {
+    free(batch->hashes);
+    free(batch->shards);
+    free(batch->order);
+}
+
+enum { BATCH_GET, BATCH_SET, BATCH_DELETE };
+
+static int batch_run(int op, size_t count, const char* const* keys,
+                     void* const* out_values, size_t* out_sizes,
+                     const void* const* in_values, const size_t* in_sizes,
+                     int* results) {
+    if (!cache || (count && !keys)) {
+        return -1;
+    }
+    if (count == 0) {
+        return 0;
+    }
+    batch_t batch;
+    if (batch_init(&batch, count, keys) != 0) {
+        return -1;
+    }
+
+    // Optimistic gets need no lock, so only the locked read mode and
+    // writes take one per shard
+    int lock = op != BATCH_GET || !cache->optimistic_reads;
+    time_t now = time(NULL);
+    int done = 0;
+    for (size_t n = 0; n < count;) {
+        uint32_t shard = batch.shards[batch.order[n]];
+        shard_t* s = cache_shard(cache, shard);
+        if (lock) {
+            if (op == BATCH_GET) {
+                pthread_rwlock_rdlock(&s->lock);
+            } else {
+                pthread_rwlock_wrlock(&s->lock);
+            }
+        }
+
+        for (; n < count && batch.shards[batch.order[n]] == shard; n++) {
+            size_t i = batch.order[n];
+            int result = -1;
+            if (op == BATCH_GET && !lock) {
+                if (valid_get_args(keys[i], out_values[i], &out_sizes[i])) {
+                    result = get_one(s, keys[i], batch.hashes[i],
+                                     out_values[i], &out_sizes[i], now);
+                }
+            } else if (op == BATCH_GET) {
+                if (valid_get_args(keys[i], out_values[i], &out_sizes[i])) {
+                    evict_record(s, batch.hashes[i]);
+                    entry_t* entry = NULL;
+                    result = get_locked(s, keys[i], batch.hashes[i],
+                                        out_values[i], &out_sizes[i], &entry);
+                    result = finish_get(s, result, entry, now);
+                }
+            } else if (!valid_key(keys[i])) {
+                result = -1;
+            } else if (op == BATCH_SET) {
+                result = set_locked(s, keys[i], batch.hashes[i],
+                                    in_values[i], in_sizes[i], 0, now);
+            } else {
+                result = delete_locked(s, keys[i], batch.hashes[i]);
+            }
+            if (results) {
+                results[i] = result;
+            }
+            done += result == 0;
+        }
+        if (lock) {
+            pthread_rwlock_unlock(&s->lock);
+        }
+    }
+
+    batch_free(&batch);
+    return done;
+}
+
+int cache_mget(size_t count, const char* const* keys, void* const* values,
+               size_t* value_sizes, int* results) {
+    if (count && (!values || !value_sizes)) {
+        return -1;
+    }
+    return batch_run(BATCH_GET, count, keys, values, value_sizes, NULL, NULL, results);
+}
+
+int cache_mset(size_t count, const char* const* keys, const void* const* values,
+               const size_t* value_sizes, int* results) {
+    if (count && (!values || !value_sizes)) {
+        return -1;
+    }
+    return batch_run(BATCH_SET, count, keys, NULL, NULL, values, value_sizes, results);
+}
+
+int cache_mdel(size_t count, const char* const* keys, int* results) {
+    return batch_run(BATCH_DELETE, count, keys, NULL, NULL, NULL, NULL, results);
+}
+
 int cache_get_stats(cache_stats_t* stats) {
     if (!cache || !stats) {
         return -1;
     }
 
-    pthread_rwlock_rdlock(&cache->lock);
-    stats->total_size = cache->stats.total_size;
-    stats->used_size = cache->used_memory;  //use current used_memory
-    stats->total_entries = cache->stats.total_entries;
-    stats->hits = cache->stats.hits;
-    stats->misses = cache->stats.misses;
-    // printf("\nDEBUG: Stats - entries=%zu, used_memory=%zu\n",
-        //    stats->total_entries, stats->used_size);
-    pthread_rwlock_unlock(&cache->lock);
+    memset(stats, 0, sizeof(*stats));
+    stats->total_size = cache->max_memory;
+    for (int i = 0; i < STAT_STRIPES; i++) {
+        stats->hits += __atomic_load_n(&cache->read_stats[i].hits, __ATOMIC_RELAXED);
+        stats->misses += __atomic_load_n(&cache->read_stats[i].misses, __ATOMIC_RELAXED);
+        stats->expired += __atomic_load_n(&cache->read_stats[i].expired, __ATOMIC_RELAXED);
+    }
+    for (uint32_t i = 0; i < cache->nshards; i++) {
+        shard_t* s = cache_shard(cache, i);
+        pthread_rwlock_rdlock(&s->lock);
+        stats->used_size += s->stats.used_size;
+        stats->total_entries += s->stats.total_entries;
+        stats->evictions += s->stats.evictions;
+        stats->rejections += s->stats.rejections;
+        stats->reaped += s->stats.reaped;
+        pthread_rwlock_unlock(&s->lock);
+    }
+    return 0;
+}
+
+static void relocate_entry(void* ctx, uint32_t owner, size_t offset) {
+    shard_entries((shard_t*)ctx)[owner].data_offset = offset;
+}
+
+size_t cache_compact(size_t max_bytes) {
+    static uint32_t next_shard = 0;
+
+    if (!cache) {
+        return 0;
+    }
+
+    // Spread the budget over the shards, continuing where the last call
+    // stopped so every shard gets compacted eventually
+    size_t moved = 0;
+    for (uint32_t n = 0; n < cache->nshards && moved < max_bytes; n++) {
+        shard_t* s = cache_shard(cache, next_shard);
+        next_shard = (next_shard + 1) % cache->nshards;
+
+        pthread_rwlock_wrlock(&s->lock);
+        seq_write_begin(&s->move_seq);
+        size_t shard_moved = arena_compact(shard_arena(s), max_bytes - moved,
+                                           relocate_entry, s);
+        seq_write_end(&s->move_seq);
+        pthread_rwlock_unlock(&s->lock);
+        if (shard_moved) {
+            TRACE(cache, TRACE_COMPACT, shard_id(s), NULL, shard_moved, 0);
+        }
+        moved += shard_moved;
+    }
+    return moved;
+}
+
+size_t cache_reap(size_t max_entries) {
+    static uint32_t next_shard = 0;
+
+    if (!cache) {
+        return 0;
+    }
+
+    // Like compaction, visit the shards in turn and hold each lock for at
+    // most REAP_CHUNK slots; shards without any TTL entries are skipped
+    // without taking their lock
+    uint64_t now = now_ms();
+    size_t scanned = 0;
+    size_t reaped = 0;
+    for (uint32_t n = 0; n < cache->nshards && scanned < max_entries; n++) {
+        shard_t* s = cache_shard(cache, next_shard);
+        next_shard = (next_shard + 1) % cache->nshards;
+        if (__atomic_load_n(&s->ttl_entries, __ATOMIC_RELAXED) == 0) {
+            continue;
+        }
+
+        size_t chunk = max_entries - scanned;
+        if (chunk > REAP_CHUNK) {
+            chunk = REAP_CHUNK;
+        }
+        if (chunk > s->nentries) {
+            chunk = s->nentries;
+        }
+        pthread_rwlock_wrlock(&s->lock);
+        entry_t* entries = shard_entries(s);
+        for (size_t i = 0; i < chunk; i++) {
+            entry_t* entry = &entries[s->reap_cursor];
+            s->reap_cursor = (s->reap_cursor + 1) % s->nentries;
+            if (entry->is_valid && entry->expires_at && now >= entry->expires_at) {
+                TRACE(cache, TRACE_EXPIRE, shard_id(s), entry_key(s, entry),
+                      entry->value_size, now - entry->expires_at);
+                remove_entry(s, entry, find_slot(s, entry_key(s, entry), entry->hash));
+                s->stats.reaped++;
+                reaped++;
+            }
+        }
+        pthread_rwlock_unlock(&s->lock);
+        scanned += chunk;
+    }
+    return reaped;
+}
+
+long cache_snapshot_save(const char* path) {
+    if (!cache || !path) {
+        return -1;
+    }
+    return snapshot_save(cache, path);
+}
+
+long cache_snapshot_load(const char* path) {
+    if (!cache || !path) {
+        return -1;
+    }
+    return snapshot_load(path);
+}
+
+int cache_wal_enable(int enabled) {
+    if (!cache || !cache->wal_offset) {
+        return -1;
+    }
+    __atomic_store_n(&cache->wal_enabled, enabled != 0, __ATOMIC_RELAXED);
     return 0;
-}
\ No newline at end of file
+}
+
+long cache_wal_drain(int fd) {
+    if (!cache || !cache->wal_offset) {
+        return -1;
+    }
+    return wal_drain(cache, fd);
+}
+
+size_t cache_wal_dropped(void) {
+    if (!cache || !cache->wal_offset) {
+        return 0;
+    }
+    return __atomic_load_n(&cache_wal(cache)->dropped, __ATOMIC_RELAXED);
+}
+
+long cache_wal_replay(const char* path) {
+    if (!cache || !path) {
+        return -1;
+    }
+    return wal_replay(path);
+}
+
+void cache_trace_enable(int enabled) {
+    if (cache) {
+        __atomic_store_n(&cache->trace_enabled, CACHE_TRACE && enabled, __ATOMIC_RELAXED);
+    }
+}
+
+int cache_trace_dump(FILE* out) {
+    if (!cache || !out) {
+        return -1;
+    }
+    return trace_dump(cache, out);
+}
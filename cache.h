@@ -2,23 +2,144 @@
 #define CACHE_H
 
 #include <stddef.h>
+#include <stdio.h>
 #include <stdint.h>
 
+#define CACHE_ERR_TOO_SMALL (-2)  // cache_get buffer cannot hold the value
+
+typedef enum {
+    CACHE_EVICT_NONE = 0,  // cache_set fails once the cache is full
+    CACHE_EVICT_LRU,       // Least recently used entry goes first
+    CACHE_EVICT_CLOCK,     // Second-chance approximation of LRU
+    CACHE_EVICT_TINYLFU,   // LRU victim, replaced only by a more frequent key
+} cache_evict_policy_t;
+
+// Cache instances are named; a process attaches to one of them
+#define CACHE_NAME_MAX 64
+#define CACHE_DEFAULT_NAME "default"
+
+typedef enum {
+    CACHE_NUMA_DEFAULT = 0,  // Pages go to the node that first touches them
+    CACHE_NUMA_INTERLEAVE,   // Pages spread round-robin over all nodes
+    CACHE_NUMA_LOCAL,        // Pages on the node of the CPU that faults them in
+    CACHE_NUMA_BIND,         // Pages only on numa_node
+} cache_numa_policy_t;
+
+// How values in a file-backed cache are expected to be read, for readahead
+typedef enum {
+    CACHE_ACCESS_RANDOM = 0,  // Point lookups: read only the pages asked for
+    CACHE_ACCESS_NORMAL,      // The kernel's default readahead
+    CACHE_ACCESS_SEQUENTIAL,  // Scans in arena order: read ahead aggressively
+} cache_access_t;
+
+typedef struct {
+    const char* name;      // Instance to create, NULL for $MEMSTREAM_NAME or "default"
+    size_t max_memory;     // Bytes of value space, split evenly over the shards
+    size_t max_entries;    // Keys the cache can hold, split evenly over the shards
+    uint32_t max_key_length;  // Longest key accepted, in bytes
+    cache_evict_policy_t evict_policy;
+    uint32_t shards;  // Independently locked partitions of the key space
+    int optimistic_reads;  // cache_get reads without taking the shard lock
+    int huge_pages;   // Back the segment with huge pages, normal pages if there are none
+    int prefault;     // Fault every page in when the segment is created
+    int lock_memory;  // Keep the segment resident (mlock)
+    cache_numa_policy_t numa;
+    int numa_node;    // Node for CACHE_NUMA_BIND
+    size_t wal_buffer;  // Bytes of shared memory for the write-ahead log ring, 0 for none
+    const char* backing_file;   // Map the cache from this file instead of memory, NULL for none
+    cache_access_t value_access;  // madvise for values in a backing file
+} cache_config_t;
+
+void cache_config_init(cache_config_t* config);
+int cache_init_config(const cache_config_t* config);
 int cache_init(size_t max_memory_size);
-int cache_connect(void);
+// Attach to the instance called name: letters, digits, '.', '_' and '-',
+// at most CACHE_NAME_MAX of them. NULL means $MEMSTREAM_NAME, or
+// CACHE_DEFAULT_NAME when that is unset. A process uses one instance at a
+// time.
+int cache_connect_name(const char* name);
+int cache_connect(void);  // cache_connect_name(NULL)
 void cache_destroy(void);
 int cache_set(const char* key, const void* value, size_t value_size);
+// Like cache_set, but the key expires ttl_ms milliseconds from now (never
+// when ttl_ms is 0). Expired keys read as misses straight away and their
+// space is reclaimed by cache_reap; cache_set clears a key's TTL.
+int cache_set_ex(const char* key, const void* value, size_t value_size,
+                 uint64_t ttl_ms);
+// *value_size is the buffer size on entry and the value length on return.
+// If the buffer is too small, nothing is copied, *value_size is set to the
+// length needed and CACHE_ERR_TOO_SMALL is returned; value may be NULL when
+// *value_size is 0 to just ask for the length.
 int cache_get(const char* key, void* value, size_t* value_size);
 int cache_delete(const char* key);
 
+// Batched get, set and delete of count keys. Each shard touched is locked
+// once per call instead of once per key. values and value_sizes are
+// parallel to keys (scatter buffers for cache_mget, in/out sizes as in
+// cache_get); results, if not NULL, receives each key's single-key return
+// code. Returns the number of keys that succeeded, or -1 on bad arguments.
+int cache_mget(size_t count, const char* const* keys, void* const* values,
+               size_t* value_sizes, int* results);
+int cache_mset(size_t count, const char* const* keys, const void* const* values,
+               const size_t* value_sizes, int* results);
+int cache_mdel(size_t count, const char* const* keys, int* results);
+
+// Zero-copy get: point *value at the value inside shared memory instead of
+// copying it out. The bytes stay valid and unchanged, even if the key is
+// updated or deleted, until the pointer is passed to cache_release_ref.
+int cache_get_ref(const char* key, const void** value, size_t* value_size);
+void cache_release_ref(const void* value);
+
 typedef struct {
     size_t total_size;
     size_t used_size;
     size_t total_entries;
     size_t hits;
     size_t misses;
+    size_t evictions;   // Entries removed to make room for new values
+    size_t rejections;  // New keys refused by the TinyLFU admission filter
+    size_t expired;     // Lookups that found their key past its TTL
+    size_t reaped;      // Expired entries removed to reclaim their space
 } cache_stats_t;
 
 int cache_get_stats(cache_stats_t* stats);
 
+// Record sets, deletes, evictions and compaction in per-process rings in
+// the shared segment. Off by default; compiled out with -DCACHE_TRACE=0.
+// cache_trace_dump prints every recorded event, oldest first, and returns
+// how many there were.
+void cache_trace_enable(int enabled);
+int cache_trace_dump(FILE* out);
+
+// Move up to max_bytes of live values to close gaps left by deletes.
+// Returns the number of bytes moved; 0 once the data region is packed.
+size_t cache_compact(size_t max_bytes);
+
+// Examine up to max_entries entry slots, continuing where the last call
+// stopped, and remove the ones past their TTL. Shards are locked for a
+// bounded number of slots at a time. Returns the number of entries removed.
+size_t cache_reap(size_t max_entries);
+
+// Write every live key, its value and its expiry time to a checksummed
+// file at path, replacing it atomically. Shards are copied a chunk at a
+// time under the read lock, so readers are never held up and the snapshot
+// is not taken at a single instant. Returns the number of keys saved.
+long cache_snapshot_save(const char* path);
+
+// Verify a snapshot and set every key in it that has not expired since.
+// Nothing is loaded from a damaged file. Returns the number of keys loaded,
+// or -1 when the file is missing or damaged.
+long cache_snapshot_load(const char* path);
+
+// Write-ahead log. With a ring configured (wal_buffer) and enabled, every
+// successful set and delete is appended to it in shared memory; writers
+// never touch the disk. The manager calls cache_wal_drain to move what has
+// been appended to a log file, and cache_wal_replay to apply a log on top
+// of a snapshot at startup. A full ring drops records and counts them in
+// cache_wal_dropped; the log then needs rewriting from a fresh snapshot.
+int cache_wal_enable(int enabled);  // -1 when the segment has no ring
+long cache_wal_drain(int fd);       // Records written to fd, -1 on error
+size_t cache_wal_dropped(void);
+long cache_wal_replay(const char* path);  // Records applied, -1 on error
+
 #endif
\ No newline at end of file
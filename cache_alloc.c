@@ -0,0 +1,290 @@
+// cache_alloc.c - value allocator for the shared data region
+#include <string.h>
+#include "cache_internal.h"
+
+// Blocks are laid out back to back in arena->data. Each starts with a
+// block_t header; free blocks additionally keep their free-list links right
+// after the header. The size of the previous block is stored in every
+// header so that freeing can coalesce in both directions in O(1).
+//
+// Zero-copy readers pin a block while they hold a pointer into it. Pins are
+// only taken and dropped under the shard's read lock, and everything below
+// runs under its write lock, so a pinned block is never moved, reused or
+// overwritten: freeing it just marks it orphaned and the last reader to
+// unpin it frees it for real.
+
+#define BLOCK_USED ((size_t)1)
+
+typedef struct {
+    size_t next;
+    size_t prev;
+} free_links_t;
+
+#define MIN_BLOCK (sizeof(block_t) + sizeof(free_links_t))
+
+static size_t align_up(size_t n) {
+    return (n + ARENA_ALIGN - 1) & ~(size_t)(ARENA_ALIGN - 1);
+}
+
+static block_t* block_at(arena_t* arena, size_t off) {
+    return (block_t*)(arena->data + off);
+}
+
+static size_t block_size(const block_t* block) {
+    return block->size & ~BLOCK_USED;
+}
+
+static int block_used(const block_t* block) {
+    return (block->size & BLOCK_USED) != 0;
+}
+
+static free_links_t* links_at(arena_t* arena, size_t off) {
+    return (free_links_t*)(arena->data + off + sizeof(block_t));
+}
+
+static unsigned size_class(size_t size) {
+    unsigned bin = 63 - (unsigned)__builtin_clzl(size);
+    return bin < ARENA_BINS ? bin : ARENA_BINS - 1;
+}
+
+static void bin_push(arena_t* arena, size_t off) {
+    unsigned bin = size_class(block_size(block_at(arena, off)));
+    free_links_t* links = links_at(arena, off);
+    links->prev = ARENA_NONE;
+    links->next = arena->bins[bin];
+    if (links->next != ARENA_NONE) {
+        links_at(arena, links->next)->prev = off;
+    }
+    arena->bins[bin] = off;
+}
+
+static void bin_unlink(arena_t* arena, size_t off) {
+    unsigned bin = size_class(block_size(block_at(arena, off)));
+    free_links_t* links = links_at(arena, off);
+    if (links->prev != ARENA_NONE) {
+        links_at(arena, links->prev)->next = links->next;
+    } else {
+        arena->bins[bin] = links->next;
+    }
+    if (links->next != ARENA_NONE) {
+        links_at(arena, links->next)->prev = links->prev;
+    }
+}
+
+// Keep the prev_size back-pointer of the block following off in sync
+static void fix_next(arena_t* arena, size_t off) {
+    size_t next = off + block_size(block_at(arena, off));
+    if (next < arena->size) {
+        block_at(arena, next)->prev_size = block_size(block_at(arena, off));
+    }
+}
+
+// Mark the block at off free, merge it with free neighbours and file it
+// under its size class
+static void release_block(arena_t* arena, size_t off) {
+    block_t* block = block_at(arena, off);
+    block->size = block_size(block);
+    arena->free_bytes += block->size;
+
+    size_t next = off + block->size;
+    if (next < arena->size && !block_used(block_at(arena, next))) {
+        bin_unlink(arena, next);
+        block->size += block_at(arena, next)->size;
+    }
+    if (block->prev_size != 0) {
+        size_t prev = off - block->prev_size;
+        if (!block_used(block_at(arena, prev))) {
+            bin_unlink(arena, prev);
+            block_at(arena, prev)->size += block->size;
+            off = prev;
+        }
+    }
+    fix_next(arena, off);
+    bin_push(arena, off);
+    if (off < arena->compact_cursor) {
+        arena->compact_cursor = off;
+    }
+}
+
+// Trim a block down to size bytes, returning the tail to the free lists
+static void split_block(arena_t* arena, size_t off, size_t size) {
+    block_t* block = block_at(arena, off);
+    size_t total = block_size(block);
+    if (total - size < MIN_BLOCK) {
+        return;
+    }
+    block->size = size | (block->size & BLOCK_USED);
+    block_t* tail = block_at(arena, off + size);
+    tail->size = (total - size) | BLOCK_USED;
+    tail->prev_size = size;
+    release_block(arena, off + size);
+}
+
+void arena_init(arena_t* arena, size_t size) {
+    size &= ~(size_t)(ARENA_ALIGN - 1);
+    arena->size = size;
+    arena->free_bytes = 0;
+    arena->compact_cursor = 0;
+    for (unsigned i = 0; i < ARENA_BINS; i++) {
+        arena->bins[i] = ARENA_NONE;
+    }
+    if (size < MIN_BLOCK) {
+        arena->size = 0;
+        return;
+    }
+    block_t* block = block_at(arena, 0);
+    block->size = size | BLOCK_USED;
+    block->prev_size = 0;
+    release_block(arena, 0);
+}
+
+size_t arena_alloc(arena_t* arena, size_t value_size, uint32_t owner) {
+    size_t need = align_up(sizeof(block_t) + value_size);
+    if (need < MIN_BLOCK) {
+        need = MIN_BLOCK;
+    }
+    if (need > arena->free_bytes) {
+        return ARENA_NONE;
+    }
+
+    // The first bin may hold blocks smaller than need; every later bin
+    // only holds blocks that fit, so its head is taken directly
+    size_t off = ARENA_NONE;
+    unsigned bin = size_class(need);
+    for (size_t cur = arena->bins[bin]; cur != ARENA_NONE;
+         cur = links_at(arena, cur)->next) {
+        if (block_size(block_at(arena, cur)) >= need) {
+            off = cur;
+            break;
+        }
+    }
+    for (unsigned b = bin + 1; off == ARENA_NONE && b < ARENA_BINS; b++) {
+        off = arena->bins[b];
+    }
+    if (off == ARENA_NONE) {
+        return ARENA_NONE;
+    }
+
+    block_t* block = block_at(arena, off);
+    bin_unlink(arena, off);
+    arena->free_bytes -= block->size;
+    block->size |= BLOCK_USED;
+    block->owner = owner;
+    block->pins = 0;
+    split_block(arena, off, need);
+    return off + sizeof(block_t);
+}
+
+void arena_free(arena_t* arena, size_t offset) {
+    block_t* block = block_at(arena, offset - sizeof(block_t));
+    if (__atomic_load_n(&block->pins, __ATOMIC_ACQUIRE) != 0) {
+        block->owner = ARENA_ORPHAN;
+        return;
+    }
+    release_block(arena, offset - sizeof(block_t));
+}
+
+void arena_pin(arena_t* arena, size_t offset) {
+    __atomic_fetch_add(&block_at(arena, offset - sizeof(block_t))->pins, 1, __ATOMIC_ACQ_REL);
+}
+
+// Drop a pin; returns 1 when the block was orphaned and must now be freed
+int arena_unpin(arena_t* arena, size_t offset) {
+    block_t* block = block_at(arena, offset - sizeof(block_t));
+    return __atomic_sub_fetch(&block->pins, 1, __ATOMIC_ACQ_REL) == 0 &&
+           block->owner == ARENA_ORPHAN;
+}
+
+int arena_pinned(arena_t* arena, size_t offset) {
+    return __atomic_load_n(&block_at(arena, offset - sizeof(block_t))->pins,
+                           __ATOMIC_ACQUIRE) != 0;
+}
+
+static int block_movable(const block_t* block) {
+    return block->owner != ARENA_ORPHAN &&
+           __atomic_load_n(&block->pins, __ATOMIC_ACQUIRE) == 0;
+}
+
+size_t arena_capacity(arena_t* arena, size_t offset) {
+    return block_size(block_at(arena, offset - sizeof(block_t))) - sizeof(block_t);
+}
+
+int arena_shrink(arena_t* arena, size_t offset, size_t value_size) {
+    size_t need = align_up(sizeof(block_t) + value_size);
+    if (need < MIN_BLOCK) {
+        need = MIN_BLOCK;
+    }
+    size_t off = offset - sizeof(block_t);
+    if (block_size(block_at(arena, off)) < need) {
+        return -1;
+    }
+    split_block(arena, off, need);
+    return 0;
+}
+
+// Slide live blocks towards the start of the arena, one at a time, so free
+// space collects into a single block at the end. Every block below
+// compact_cursor is already packed, which keeps each call proportional to
+// the work it does rather than to the arena size. Pinned blocks cannot move;
+// the hole in front of one is skipped and the cursor stays there until the
+// pin is gone.
+size_t arena_compact(arena_t* arena, size_t budget,
+                     arena_relocate_fn relocate, void* ctx) {
+    size_t moved = 0;
+    size_t off = arena->compact_cursor;
+    size_t stuck = ARENA_NONE;  // First hole in front of a pinned block
+
+    while (moved < budget) {
+        while (off < arena->size && block_used(block_at(arena, off))) {
+            off += block_size(block_at(arena, off));
+        }
+        if (stuck == ARENA_NONE) {
+            arena->compact_cursor = off;
+        }
+        if (off >= arena->size) {
+            break;
+        }
+
+        block_t* hole = block_at(arena, off);
+        size_t hole_size = hole->size;
+        size_t live = off + hole_size;
+        if (live >= arena->size) {
+            break;  // Only the trailing free block is left
+        }
+
+        block_t* block = block_at(arena, live);
+        size_t live_size = block_size(block);
+        if (!block_movable(block)) {
+            if (stuck == ARENA_NONE) {
+                stuck = off;
+            }
+            off = live;
+            continue;
+        }
+        bin_unlink(arena, off);
+        uint32_t owner = block->owner;
+        size_t prev_size = hole->prev_size;
+        memmove(hole, block, live_size);
+        hole->prev_size = prev_size;
+        relocate(ctx, owner, off + sizeof(block_t));
+
+        size_t gap = off + live_size;
+        block_t* freed = block_at(arena, gap);
+        freed->size = hole_size | BLOCK_USED;
+        freed->prev_size = live_size;
+        arena->free_bytes -= hole_size;
+        release_block(arena, gap);
+
+        moved += live_size;
+        off = gap;
+    }
+    if (off > arena->size) {
+        off = arena->size;
+    }
+    arena->compact_cursor = stuck < off ? stuck : off;
+    return moved;
+}
+
+void* arena_ptr(arena_t* arena, size_t offset) {
+    return arena->data + offset;
+}
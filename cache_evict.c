@@ -0,0 +1,188 @@
+// cache_evict.c - victim selection once the cache is full
+#include <string.h>
+#include "cache_internal.h"
+
+// LRU and TinyLFU thread a recency list through entry_t by position. Readers
+// promote entries without holding the shard lock at all, so every list
+// change is serialised by lru_lock; promotion happens at most once per
+// second per entry to keep that lock off most reads. CLOCK needs no list:
+// readers set a reference bit and the hand clears it while looking for a
+// victim.
+
+#define LRU_NONE UINT32_MAX
+#define SKETCH_MAX 15  // Counters saturate like 4-bit counters
+#define SKETCH_SAMPLE 10  // Additions per entry before counters are halved
+
+static int uses_lru(const shard_t* s) {
+    return s->policy == CACHE_EVICT_LRU || s->policy == CACHE_EVICT_TINYLFU;
+}
+
+static uint32_t entry_pos(shard_t* s, const entry_t* e) {
+    return (uint32_t)(e - shard_entries(s));
+}
+
+static void lru_unlink(shard_t* s, entry_t* e) {
+    e->on_lru = 0;
+    if (e->lru_prev != LRU_NONE) {
+        shard_entries(s)[e->lru_prev].lru_next = e->lru_next;
+    } else {
+        s->lru_head = e->lru_next;
+    }
+    if (e->lru_next != LRU_NONE) {
+        shard_entries(s)[e->lru_next].lru_prev = e->lru_prev;
+    } else {
+        s->lru_tail = e->lru_prev;
+    }
+}
+
+static void lru_push_head(shard_t* s, entry_t* e) {
+    uint32_t pos = entry_pos(s, e);
+    e->on_lru = 1;
+    e->lru_prev = LRU_NONE;
+    e->lru_next = s->lru_head;
+    if (s->lru_head != LRU_NONE) {
+        shard_entries(s)[s->lru_head].lru_prev = pos;
+    } else {
+        s->lru_tail = pos;
+    }
+    s->lru_head = pos;
+}
+
+static uint8_t* sketch_counter(shard_t* s, uint32_t hash, unsigned row) {
+    static const uint32_t seeds[SKETCH_ROWS] = {
+        0x9e3779b1u, 0x85ebca77u, 0xc2b2ae3du, 0x27d4eb2fu
+    };
+    uint32_t h = (hash ^ (hash >> 16)) * seeds[row];
+    return &shard_sketch(s)[row * s->sketch_width + (((h >> 16) ^ h) & (s->sketch_width - 1))];
+}
+
+static unsigned sketch_estimate(shard_t* s, uint32_t hash) {
+    unsigned estimate = SKETCH_MAX;
+    for (unsigned row = 0; row < SKETCH_ROWS; row++) {
+        unsigned count = __atomic_load_n(sketch_counter(s, hash, row), __ATOMIC_RELAXED);
+        if (count < estimate) {
+            estimate = count;
+        }
+    }
+    return estimate;
+}
+
+void evict_init(shard_t* s, cache_evict_policy_t policy) {
+    s->policy = policy;
+    s->lru_head = LRU_NONE;
+    s->lru_tail = LRU_NONE;
+    s->clock_hand = 0;
+    s->sketch_additions = 0;
+    memset(shard_sketch(s), 0, (size_t)SKETCH_ROWS * s->sketch_width);
+
+    pthread_mutexattr_t attr;
+    pthread_mutexattr_init(&attr);
+    pthread_mutexattr_setpshared(&attr, PTHREAD_PROCESS_SHARED);
+    pthread_mutex_init(&s->lru_lock, &attr);
+    pthread_mutexattr_destroy(&attr);
+}
+
+void evict_insert(shard_t* s, entry_t* e) {
+    e->referenced = 0;
+    if (uses_lru(s)) {
+        pthread_mutex_lock(&s->lru_lock);
+        lru_push_head(s, e);
+        pthread_mutex_unlock(&s->lru_lock);
+    }
+}
+
+void evict_remove(shard_t* s, entry_t* e) {
+    if (uses_lru(s)) {
+        pthread_mutex_lock(&s->lru_lock);
+        lru_unlink(s, e);
+        pthread_mutex_unlock(&s->lru_lock);
+    }
+}
+
+void evict_touch(shard_t* s, entry_t* e, time_t now) {
+    if (s->policy == CACHE_EVICT_CLOCK) {
+        if (!__atomic_load_n(&e->referenced, __ATOMIC_RELAXED)) {
+            __atomic_store_n(&e->referenced, 1, __ATOMIC_RELAXED);
+        }
+    } else if (uses_lru(s) &&
+               __atomic_load_n(&e->last_access, __ATOMIC_RELAXED) != (uint32_t)now) {
+        // The entry may have been removed since the caller found it
+        pthread_mutex_lock(&s->lru_lock);
+        if (e->on_lru && s->lru_head != entry_pos(s, e)) {
+            lru_unlink(s, e);
+            lru_push_head(s, e);
+        }
+        pthread_mutex_unlock(&s->lru_lock);
+    }
+}
+
+void evict_record(shard_t* s, uint32_t hash) {
+    if (s->policy != CACHE_EVICT_TINYLFU) {
+        return;
+    }
+    for (unsigned row = 0; row < SKETCH_ROWS; row++) {
+        uint8_t* counter = sketch_counter(s, hash, row);
+        uint8_t count = __atomic_load_n(counter, __ATOMIC_RELAXED);
+        if (count < SKETCH_MAX) {
+            __atomic_store_n(counter, count + 1, __ATOMIC_RELAXED);
+        }
+    }
+    __atomic_fetch_add(&s->sketch_additions, 1, __ATOMIC_RELAXED);
+}
+
+// Readers keep recording while the sketch is halved; like evict_record,
+// this uses relaxed atomics and tolerates the odd lost increment
+void evict_age(shard_t* s) {
+    if (s->policy != CACHE_EVICT_TINYLFU) {
+        return;
+    }
+    size_t additions = __atomic_load_n(&s->sketch_additions, __ATOMIC_RELAXED);
+    if (additions < (size_t)SKETCH_SAMPLE * s->nentries) {
+        return;
+    }
+    uint8_t* sketch = shard_sketch(s);
+    for (size_t i = 0; i < (size_t)SKETCH_ROWS * s->sketch_width; i++) {
+        uint8_t count = __atomic_load_n(&sketch[i], __ATOMIC_RELAXED);
+        __atomic_store_n(&sketch[i], count >> 1, __ATOMIC_RELAXED);
+    }
+    __atomic_store_n(&s->sketch_additions, additions / 2, __ATOMIC_RELAXED);
+}
+
+entry_t* evict_victim(shard_t* s, const entry_t* keep) {
+    if (uses_lru(s)) {
+        entry_t* entries = shard_entries(s);
+        entry_t* victim = NULL;
+        pthread_mutex_lock(&s->lru_lock);
+        for (uint32_t i = s->lru_tail; i != LRU_NONE; i = entries[i].lru_prev) {
+            if (&entries[i] != keep) {
+                victim = &entries[i];
+                break;
+            }
+        }
+        pthread_mutex_unlock(&s->lru_lock);
+        return victim;
+    }
+    if (s->policy == CACHE_EVICT_CLOCK) {
+        // Two sweeps are enough: the first clears every reference bit
+        for (size_t n = 0; n < 2 * (size_t)s->nentries; n++) {
+            entry_t* e = &shard_entries(s)[s->clock_hand];
+            s->clock_hand = (s->clock_hand + 1) % s->nentries;
+            if (!e->is_valid || e == keep) {
+                continue;
+            }
+            if (__atomic_load_n(&e->referenced, __ATOMIC_RELAXED)) {
+                __atomic_store_n(&e->referenced, 0, __ATOMIC_RELAXED);
+                continue;
+            }
+            return e;
+        }
+    }
+    return NULL;
+}
+
+int evict_admit(shard_t* s, uint32_t hash, const entry_t* victim) {
+    if (s->policy != CACHE_EVICT_TINYLFU) {
+        return 1;
+    }
+    return sketch_estimate(s, hash) > sketch_estimate(s, victim->hash);
+}
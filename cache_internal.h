@@ -1,34 +1,325 @@
 #ifndef CACHE_INTERNAL_H
 #define CACHE_INTERNAL_H
 
+#include <stdio.h>
+#include <limits.h>
 #include <pthread.h>
 #include <time.h>
 #include <sys/types.h>
-#include <sys/ipc.h>
-#include <sys/shm.h>
 #include "cache.h"
 
-#define MAX_KEY_LENGTH 256
-#define MAX_ENTRIES 10000
-#define SHM_KEY 0x1234  // Fixed key for shared memory
+#define CACHE_MAGIC 0x4d454d53  // "MEMS", first word of every segment
+#define CACHE_LAYOUT_VERSION 3  // Bumped whenever cache_t or a shard changes shape
+#define DEFAULT_MAX_ENTRIES 10000
+#define DEFAULT_KEY_LENGTH 255
+#define MAX_SHARD_ENTRIES (1u << 30)  // Keeps the index size within 32 bits
+#define MAX_SHARDS 256
+#define SKETCH_ROWS 4
+#define CACHE_LINE 64
+#define STAT_STRIPES 16  // Read counters are spread over this many cache lines
+#define TRACE_RINGS 8
+#define TRACE_EVENTS 256  // Per ring, oldest events are overwritten
+#define REAP_CHUNK 256  // Entry slots cache_reap examines per lock hold
 
+// Build with -DCACHE_TRACE=0 to compile every trace point out
+#ifndef CACHE_TRACE
+#define CACHE_TRACE 1
+#endif
+
+// Hash index slot values: 0 is empty, otherwise entry position + 1
+#define INDEX_EMPTY 0
+#define INDEX_TOMBSTONE UINT32_MAX
+
+#define ARENA_BINS 64
+#define ARENA_ALIGN 8
+#define ARENA_NONE ((size_t)-1)
+#define ARENA_ORPHAN UINT32_MAX  // Owner of a freed block that is still pinned
+
+// Header in front of every value block in the data region
+typedef struct {
+    size_t size;       // Whole block including header, low bit set while in use
+    size_t prev_size;  // Size of the physically preceding block, 0 for the first
+    uint32_t owner;    // Entry that owns the block while it is in use
+    uint32_t pins;     // Zero-copy readers holding a pointer to the value
+} block_t;
+
+// Allocator state, placed at the start of the data region it manages
+typedef struct {
+    size_t size;            // Bytes available for blocks in data[]
+    size_t free_bytes;
+    size_t bins[ARENA_BINS];  // Free lists by power-of-two size class
+    size_t compact_cursor;  // Blocks below this offset are already packed
+    char data[];
+} arena_t;
+
+typedef void (*arena_relocate_fn)(void* ctx, uint32_t owner, size_t offset);
+
+// Keys are not stored in the entry: the arena block at data_offset holds
+// the value followed by the NUL-terminated key, so an entry is one cache
+// line no matter how long keys may be.
 typedef struct {
-    char key[MAX_KEY_LENGTH];
+    uint32_t seq;        // Odd while a writer is changing the entry or its value
+    uint32_t hash;       // Cached key hash, compared before the key itself
+    size_t data_offset;  // Offset to value in the arena, the key follows it
     size_t value_size;
-    time_t last_access;
-    time_t created_at;
+    uint64_t expires_at;  // Wall clock in ms after which the key is gone, 0 = never
+    uint32_t next_free;  // Next unused entry while on the free list
+    uint32_t lru_prev;   // Recency list neighbours for LRU and TinyLFU
+    uint32_t lru_next;
+    uint32_t last_access;  // Seconds since the epoch
+    uint32_t created_at;
     uint32_t access_count;
-    int is_valid;
-    size_t data_offset;  // Offset to value in data region
+    uint16_t key_len;    // Excluding the NUL
+    uint8_t on_lru;      // Set while linked into the recency list
+    uint8_t referenced;  // CLOCK reference bit
+    uint8_t is_valid;
 } entry_t;
 
+// One independently locked slice of the key space. The header is followed
+// by the shard's entry table, hash index, TinyLFU sketch and value arena at
+// the recorded offsets; all shards of a segment share the same geometry.
 typedef struct {
     pthread_rwlock_t lock;
+    pthread_mutex_t lru_lock;   // Guards the recency list
+    uint32_t index_seq;         // Odd while the index is being changed
+    uint32_t move_seq;          // Odd while compaction is moving values
+    cache_stats_t stats;        // Hits and misses live in cache_t read_stats
+    cache_evict_policy_t policy;
+    uint32_t nentries;
+    uint32_t index_size;        // Power of two >= 2 * nentries
+    uint32_t sketch_width;      // TinyLFU counters per row, power of two
+    uint32_t free_head;         // First unused entry, nentries when full
+    uint32_t index_tombstones;  // Deleted index slots awaiting a rebuild
+    uint32_t lru_head;          // Most recently used entry
+    uint32_t lru_tail;          // Next LRU victim
+    uint32_t clock_hand;
+    uint32_t reap_cursor;       // Next entry slot cache_reap examines
+    uint32_t ttl_entries;       // Live entries with an expiry time
+    size_t sketch_additions;
+    size_t entries_offset;
+    size_t index_offset;
+    size_t sketch_offset;
+    size_t arena_offset;
+} shard_t;
+
+typedef struct {
+    size_t hits;
+    size_t misses;
+    size_t expired;
+} __attribute__((aligned(CACHE_LINE))) stat_stripe_t;
+
+typedef enum {
+    TRACE_SET_NEW = 1,  // a = value size, b = arena offset
+    TRACE_SET_UPDATE,   // a = old size, b = new size
+    TRACE_SET_FAIL,     // a = value size
+    TRACE_DELETE,       // a = value size
+    TRACE_EVICT,        // a = value size
+    TRACE_REJECT,       // a = hash of the key refused admission
+    TRACE_COMPACT,      // a = bytes moved
+    TRACE_EXPIRE,       // a = value size, b = ms past the expiry time
+} trace_op_t;
+
+typedef struct {
+    uint64_t time_ns;  // Wall clock, 0 while the event is being written
+    uint32_t pid;
+    uint16_t op;
+    uint16_t shard;
+    uint64_t a;
+    uint64_t b;
+    char key[32];      // Truncated key
+} trace_event_t;
+
+typedef struct {
+    uint32_t pid;      // Process writing to this ring, 0 when unclaimed
+    uint64_t next;     // Events written so far
+    trace_event_t events[TRACE_EVENTS];
+} trace_ring_t;
+
+typedef enum {
+    WAL_SET = 1,
+    WAL_DELETE,
+} wal_op_t;
+
+// One logged change, followed by the key (no NUL) and the value. The same
+// bytes go to the log file, where check holds the CRC-32 of the record
+// from WAL_CHECKED on.
+typedef struct {
+    uint32_t size;        // Whole record, padded to a multiple of 8
+    uint32_t check;       // In the ring, written last to publish the record
+    uint64_t expires_at;  // Wall clock in ms, 0 = never
+    uint32_t value_size;
+    uint16_t key_len;
+    uint8_t op;
+    uint8_t reserved;
+} wal_record_t;
+
+#define WAL_CHECKED 8
+
+// Multi-producer ring the manager drains into the log file
+typedef struct {
+    uint64_t head __attribute__((aligned(CACHE_LINE)));  // Reserved up to, by writers
+    uint64_t tail __attribute__((aligned(CACHE_LINE)));  // Drained up to, by the manager
+    uint64_t dropped;  // Records lost because the ring was full
+    uint64_t size;     // Bytes of record space after the header, a power of two
+} wal_ring_t;
+
+// Segment header. Everything a client needs to find its way around the
+// segment is recorded here and in the shard headers when the manager
+// creates it; cache_connect only checks magic and version.
+typedef struct {
+    uint32_t magic;
+    uint32_t version;
+    size_t segment_size;
     size_t max_memory;
-    size_t used_memory;
-    cache_stats_t stats;
-    entry_t entries[MAX_ENTRIES];
-    char data[];  // Flexible array member for values
+    size_t max_entries;
+    uint32_t max_key_length;
+    uint32_t nshards;
+    int optimistic_reads;  // cache_get skips the shard lock when set
+    int trace_enabled;     // Runtime switch for the trace rings
+    int wal_enabled;       // Sets and deletes are appended to the log ring
+    size_t wal_offset;     // Log ring from the segment base, 0 when there is none
+    size_t shards_offset;  // Start of the first shard from the segment base
+    size_t shard_size;     // Distance between consecutive shards
+    uint32_t next_stripe;  // Hands out read_stats stripes to threads
+    stat_stripe_t read_stats[STAT_STRIPES];
+    trace_ring_t trace[TRACE_RINGS];
 } cache_t;
 
-#endif
\ No newline at end of file
+// Log a change while the manager is draining the ring
+#define WAL_LOG(c, ...)                                                   \
+    do {                                                                  \
+        if (__builtin_expect(__atomic_load_n(&(c)->wal_enabled,           \
+                                             __ATOMIC_RELAXED), 0)) {     \
+            wal_append((c), __VA_ARGS__);                                 \
+        }                                                                 \
+    } while (0)
+
+#if CACHE_TRACE
+#define TRACE(c, ...)                                                     \
+    do {                                                                  \
+        if (__builtin_expect(__atomic_load_n(&(c)->trace_enabled,         \
+                                             __ATOMIC_RELAXED), 0)) {     \
+            trace_event((c), __VA_ARGS__);                                \
+        }                                                                 \
+    } while (0)
+#else
+// Still type-checks the arguments, but the call is never emitted
+#define TRACE(c, ...) do { if (0) trace_event((c), __VA_ARGS__); } while (0)
+#endif
+
+// Sequence counters let readers copy data without taking the shard lock.
+// Writers, which always hold the write lock, make the counter odd before a
+// change and even again afterwards; a reader accepts what it copied only
+// if the counter was even and unchanged around the copy.
+static inline void seq_write_begin(uint32_t* seq) {
+    __atomic_store_n(seq, *seq + 1, __ATOMIC_RELAXED);
+    __atomic_thread_fence(__ATOMIC_RELEASE);
+}
+
+static inline void seq_write_end(uint32_t* seq) {
+    __atomic_store_n(seq, *seq + 1, __ATOMIC_RELEASE);
+}
+
+static inline uint32_t seq_read_begin(const uint32_t* seq) {
+    return __atomic_load_n(seq, __ATOMIC_ACQUIRE);
+}
+
+static inline int seq_read_valid(const uint32_t* seq, uint32_t start) {
+    __atomic_thread_fence(__ATOMIC_ACQUIRE);
+    return (start & 1) == 0 && __atomic_load_n(seq, __ATOMIC_RELAXED) == start;
+}
+
+static inline shard_t* cache_shard(cache_t* c, uint32_t i) {
+    return (shard_t*)((char*)c + c->shards_offset + i * c->shard_size);
+}
+
+static inline entry_t* shard_entries(shard_t* s) {
+    return (entry_t*)((char*)s + s->entries_offset);
+}
+
+static inline uint32_t* shard_index(shard_t* s) {
+    return (uint32_t*)((char*)s + s->index_offset);
+}
+
+static inline uint8_t* shard_sketch(shard_t* s) {
+    return (uint8_t*)s + s->sketch_offset;
+}
+
+static inline arena_t* shard_arena(shard_t* s) {
+    return (arena_t*)((char*)s + s->arena_offset);
+}
+
+static inline wal_ring_t* cache_wal(cache_t* c) {
+    return (wal_ring_t*)((char*)c + c->wal_offset);
+}
+
+static inline char* wal_data(wal_ring_t* ring) {
+    return (char*)(ring + 1);
+}
+
+static inline char* entry_key(shard_t* s, const entry_t* e) {
+    return shard_arena(s)->data + e->data_offset + e->value_size;
+}
+
+// The shared segment as mapped into this process
+typedef struct {
+    void* base;
+    size_t size;
+    char name[CACHE_NAME_MAX + 1];  // Instance name, empty when not attached
+    int huge_pages;                 // Set when backed by hugetlbfs
+    int file_backed;                // Set when mapped from an ordinary file
+    char file[PATH_MAX];            // That file
+    int owner;                      // Set in the manager, which holds lock_fd
+    int lock_fd;                    // Holds the instance's flock while it runs
+} segment_t;
+
+// cache_segment.c
+int segment_name_valid(const char* name);
+const char* segment_default_name(void);
+int segment_create(segment_t* seg, const cache_config_t* config, size_t size);
+int segment_attach(segment_t* seg, const char* name);
+void segment_detach(segment_t* seg);
+void segment_remove(segment_t* seg);
+void segment_advise(segment_t* seg, size_t offset, size_t len, int advice);
+int segment_lock(segment_t* seg, size_t offset, size_t len);
+
+// cache_snapshot.c
+uint32_t crc32_update(uint32_t crc, const void* data, size_t len);
+long snapshot_save(cache_t* c, const char* path);
+long snapshot_load(const char* path);
+
+// cache_wal.c
+void wal_append(cache_t* c, wal_op_t op, const char* key, size_t key_len,
+                const void* value, size_t value_size, uint64_t expires_at);
+long wal_drain(cache_t* c, int fd);
+long wal_replay(const char* path);
+
+// cache_alloc.c
+void arena_init(arena_t* arena, size_t size);
+size_t arena_alloc(arena_t* arena, size_t value_size, uint32_t owner);
+void arena_free(arena_t* arena, size_t offset);
+void arena_pin(arena_t* arena, size_t offset);
+int arena_unpin(arena_t* arena, size_t offset);
+int arena_pinned(arena_t* arena, size_t offset);
+size_t arena_capacity(arena_t* arena, size_t offset);
+int arena_shrink(arena_t* arena, size_t offset, size_t value_size);
+size_t arena_compact(arena_t* arena, size_t budget,
+                     arena_relocate_fn relocate, void* ctx);
+void* arena_ptr(arena_t* arena, size_t offset);
+
+// cache_trace.c
+void trace_event(cache_t* c, trace_op_t op, uint32_t shard, const char* key,
+                 uint64_t a, uint64_t b);
+int trace_dump(cache_t* c, FILE* out);
+
+// cache_evict.c
+void evict_init(shard_t* s, cache_evict_policy_t policy);
+void evict_insert(shard_t* s, entry_t* e);
+void evict_remove(shard_t* s, entry_t* e);
+void evict_touch(shard_t* s, entry_t* e, time_t now);
+void evict_record(shard_t* s, uint32_t hash);
+void evict_age(shard_t* s);
+entry_t* evict_victim(shard_t* s, const entry_t* keep);
+int evict_admit(shard_t* s, uint32_t hash, const entry_t* victim);
+
+#endif
@@ -1,41 +1,479 @@
 // cache_manager.c
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <signal.h>
+#include <errno.h>
 #include <unistd.h>
-#include <sys/ipc.h>
-#include <sys/shm.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <time.h>
+#include <pthread.h>
 #include "cache.h"
 
+#define COMPACT_BUDGET (256 * 1024)  // Bytes of values moved per tick
+#define REAP_BUDGET 4096  // Entry slots checked for expired keys per tick
+#define SNAPSHOT_INTERVAL 60  // Seconds between snapshots by default
+#define WAL_BUFFER (16 * 1024 * 1024)  // Shared memory for the log ring by default
+#define WAL_FSYNC_MS 10  // Group commit: logged records are synced this often,
+#define WAL_COMMIT_RECORDS 4096  // or as soon as this many are waiting
+#define WAL_REWRITE_BYTES (64 * 1024 * 1024)  // Log size that triggers a rewrite
+
 volatile sig_atomic_t running = 1;
 
 void handle_signal(int signum) {
     running = 0;
 }
 
-int main() {
+static const char* snapshot_path = NULL;
+static unsigned snapshot_interval = SNAPSHOT_INTERVAL;
+
+// The log is only ever read back on top of a snapshot. A rewrite moves the
+// current log to <log>.old, starts a new one and takes a snapshot, which
+// covers everything in .old, so .old can then be deleted. Until it is,
+// startup replays .old and then the log; replaying changes the snapshot
+// already has is harmless because the newer ones follow.
+static const char* wal_path = NULL;
+static char wal_old[PATH_MAX];
+static unsigned wal_fsync_ms = WAL_FSYNC_MS;
+static size_t wal_buffer = WAL_BUFFER;
+static int wal_fd = -1;
+static pthread_mutex_t wal_lock = PTHREAD_MUTEX_INITIALIZER;
+static int rewrite_wanted = 0;
+
+static double elapsed_ms(const struct timespec* start) {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (now.tv_sec - start->tv_sec) * 1e3 + (now.tv_nsec - start->tv_nsec) / 1e6;
+}
+
+static int open_log(void) {
+    wal_fd = open(wal_path, O_WRONLY | O_CREAT | O_APPEND, 0644);
+    if (wal_fd == -1) {
+        printf("Failed to open log %s: %s\n", wal_path, strerror(errno));
+        return -1;
+    }
+    return 0;
+}
+
+// Hand the log over to .old and start a new one. If an earlier rewrite did
+// not finish, .old is still needed and the current log carries on instead.
+static void rotate_log(void) {
+    pthread_mutex_lock(&wal_lock);
+    if (access(wal_old, F_OK) != 0) {
+        cache_wal_drain(wal_fd);
+        fdatasync(wal_fd);
+        close(wal_fd);
+        if (rename(wal_path, wal_old) != 0) {
+            printf("\nFailed to rotate log %s: %s\n", wal_path, strerror(errno));
+        }
+        open_log();
+    }
+    pthread_mutex_unlock(&wal_lock);
+}
+
+static void save_snapshot(void) {
+    struct timespec start;
+    clock_gettime(CLOCK_MONOTONIC, &start);
+    if (wal_path) {
+        rotate_log();
+    }
+    long count = cache_snapshot_save(snapshot_path);
+    if (count >= 0) {
+        printf("\nSaved %ld keys to %s in %.1f ms\n", count, snapshot_path,
+               elapsed_ms(&start));
+        if (wal_path) {
+            unlink(wal_old);
+        }
+    }
+}
+
+static void replay_logs(void) {
+    struct timespec start;
+    clock_gettime(CLOCK_MONOTONIC, &start);
+    long replayed = 0;
+    long count = cache_wal_replay(wal_old);
+    replayed += count > 0 ? count : 0;
+    count = cache_wal_replay(wal_path);
+    replayed += count > 0 ? count : 0;
+    if (replayed > 0) {
+        printf("Log replay took %.1f ms\n", elapsed_ms(&start));
+        __atomic_store_n(&rewrite_wanted, 1, __ATOMIC_RELAXED);
+    }
+}
+
+// Moves logged records from the ring to the log file. Syncs are batched
+// (group commit): a record is on disk at most wal_fsync_ms after it was
+// drained, sooner once WAL_COMMIT_RECORDS are waiting.
+static void* wal_loop(void* arg) {
+    struct timespec synced;
+    clock_gettime(CLOCK_MONOTONIC, &synced);
+    long unsynced = 0;
+    size_t dropped = cache_wal_dropped();
+    while (running) {
+        pthread_mutex_lock(&wal_lock);
+        long count = cache_wal_drain(wal_fd);
+        if (count > 0) {
+            unsynced += count;
+        }
+        if (unsynced && (unsynced >= WAL_COMMIT_RECORDS ||
+                         elapsed_ms(&synced) >= wal_fsync_ms)) {
+            fdatasync(wal_fd);
+            unsynced = 0;
+            clock_gettime(CLOCK_MONOTONIC, &synced);
+        }
+        off_t size = lseek(wal_fd, 0, SEEK_END);
+        pthread_mutex_unlock(&wal_lock);
+
+        // Records lost to a full ring or a failed write are only covered
+        // again by the next snapshot
+        if (cache_wal_dropped() != dropped || count < 0) {
+            if (cache_wal_dropped() != dropped) {
+                printf("\nLog ring overflowed, taking a snapshot to cover the gap\n");
+            }
+            dropped = cache_wal_dropped();
+            __atomic_store_n(&rewrite_wanted, 1, __ATOMIC_RELAXED);
+        }
+        if (size > WAL_REWRITE_BYTES) {
+            __atomic_store_n(&rewrite_wanted, 1, __ATOMIC_RELAXED);
+        }
+        if (count <= 0) {
+            usleep(count < 0 ? 100000 : 1000);
+        }
+    }
+
+    pthread_mutex_lock(&wal_lock);
+    cache_wal_drain(wal_fd);
+    fdatasync(wal_fd);
+    pthread_mutex_unlock(&wal_lock);
+    return NULL;
+}
+
+static void load_snapshot(void) {
+    if (access(snapshot_path, F_OK) != 0) {
+        printf("No snapshot at %s yet, starting empty\n", snapshot_path);
+        return;
+    }
+    struct timespec start;
+    clock_gettime(CLOCK_MONOTONIC, &start);
+    if (cache_snapshot_load(snapshot_path) >= 0) {
+        printf("Warm restart took %.1f ms\n", elapsed_ms(&start));
+    }
+}
+
+// Snapshots, and with them log rewrites, are written from their own thread
+// so a slow disk never holds up reaping and compaction
+static void* snapshot_loop(void* arg) {
+    unsigned waited = 0;
+    while (running) {
+        sleep(1);
+        waited++;
+        if (!running) {
+            break;
+        }
+        if ((snapshot_interval && waited >= snapshot_interval) ||
+            __atomic_exchange_n(&rewrite_wanted, 0, __ATOMIC_RELAXED)) {
+            save_snapshot();
+            waited = 0;
+        }
+    }
+    return NULL;
+}
+
+static const char* policy_names[] = {"none", "lru", "clock", "tinylfu"};
+static const char* access_names[] = {"random", "normal", "sequential"};
+
+static int parse_policy(const char* name, cache_evict_policy_t* policy) {
+    for (size_t i = 0; i < sizeof(policy_names) / sizeof(policy_names[0]); i++) {
+        if (strcmp(name, policy_names[i]) == 0) {
+            *policy = (cache_evict_policy_t)i;
+            return 0;
+        }
+    }
+    return -1;
+}
+
+static int parse_access(const char* name, cache_access_t* access) {
+    for (size_t i = 0; i < sizeof(access_names) / sizeof(access_names[0]); i++) {
+        if (strcmp(name, access_names[i]) == 0) {
+            *access = (cache_access_t)i;
+            return 0;
+        }
+    }
+    return -1;
+}
+
+// Parse -N: interleave, local or a node number to bind to
+static int parse_numa(const char* text, cache_config_t* config) {
+    char* end;
+    if (strcmp(text, "interleave") == 0) {
+        config->numa = CACHE_NUMA_INTERLEAVE;
+    } else if (strcmp(text, "local") == 0) {
+        config->numa = CACHE_NUMA_LOCAL;
+    } else {
+        long node = strtol(text, &end, 10);
+        if (end == text || *end != '\0' || node < 0) {
+            return -1;
+        }
+        config->numa = CACHE_NUMA_BIND;
+        config->numa_node = (int)node;
+    }
+    return 0;
+}
+
+// Parse a byte count with an optional K, M or G suffix
+static int parse_size(const char* text, size_t* size) {
+    char* end;
+    unsigned long long value = strtoull(text, &end, 10);
+    switch (*end) {
+    case 'G': case 'g': value <<= 10;  // fall through
+    case 'M': case 'm': value <<= 10;  // fall through
+    case 'K': case 'k': value <<= 10; end++; break;
+    }
+    if (end == text || *end != '\0' || value == 0) {
+        return -1;
+    }
+    *size = (size_t)value;
+    return 0;
+}
+
+// Settings that may also come from the environment, as in the containers;
+// command line flags override them
+static int parse_env(cache_config_t* config) {
+    const char* value;
+    if ((value = getenv("MEMSTREAM_MEMORY")) && parse_size(value, &config->max_memory) != 0) {
+        printf("Invalid MEMSTREAM_MEMORY: %s\n", value);
+        return -1;
+    }
+    if ((value = getenv("MEMSTREAM_ENTRIES")) && parse_size(value, &config->max_entries) != 0) {
+        printf("Invalid MEMSTREAM_ENTRIES: %s\n", value);
+        return -1;
+    }
+    if ((value = getenv("MEMSTREAM_SNAPSHOT")) && *value) {
+        snapshot_path = value;
+    }
+    if ((value = getenv("MEMSTREAM_SNAPSHOT_INTERVAL"))) {
+        snapshot_interval = (unsigned)strtoul(value, NULL, 10);
+    }
+    if ((value = getenv("MEMSTREAM_WAL")) && *value) {
+        wal_path = value;
+    }
+    if ((value = getenv("MEMSTREAM_WAL_BUFFER")) && parse_size(value, &wal_buffer) != 0) {
+        printf("Invalid MEMSTREAM_WAL_BUFFER: %s\n", value);
+        return -1;
+    }
+    if ((value = getenv("MEMSTREAM_WAL_FSYNC_MS"))) {
+        wal_fsync_ms = (unsigned)strtoul(value, NULL, 10);
+    }
+    if ((value = getenv("MEMSTREAM_FILE")) && *value) {
+        config->backing_file = value;
+    }
+    if ((value = getenv("MEMSTREAM_NAME")) && *value) {
+        config->name = value;
+    }
+    if ((value = getenv("MEMSTREAM_KEY_LENGTH"))) {
+        config->max_key_length = (uint32_t)strtoul(value, NULL, 10);
+    }
+    return 0;
+}
+
+static void usage(const char* prog) {
+    printf("Usage: %s [-i name] [-m bytes] [-n entries] [-k key length] [-e none|lru|clock|tinylfu]\n"
+           "       [-s shards] [-r optimistic|locked] [-H] [-P] [-L] [-N interleave|local|node]\n"
+           "       [-f file] [-A random|normal|sequential]\n"
+           "       [-S file] [-p seconds] [-W file] [-F ms] [-b bytes] [-t] [-d]\n", prog);
+    printf("  -i  name of the cache instance (default: env MEMSTREAM_NAME, else default)\n");
+    printf("  -m  value memory, K/M/G suffixes allowed (default: 1M, env MEMSTREAM_MEMORY)\n");
+    printf("  -n  number of keys the cache can hold (default: 10000, env MEMSTREAM_ENTRIES)\n");
+    printf("  -k  longest key in bytes (default: 255, env MEMSTREAM_KEY_LENGTH)\n");
+    printf("  -e  eviction policy when the cache is full (default: lru)\n");
+    printf("  -s  number of independently locked shards (default: 8)\n");
+    printf("  -r  how cache_get synchronises with writers (default: optimistic)\n");
+    printf("  -H  back the cache with huge pages, normal pages if none are reserved\n");
+    printf("  -P  fault every page in at startup\n");
+    printf("  -L  lock the cache in memory so it is never swapped out\n");
+    printf("  -N  NUMA placement: interleave over all nodes, local, or bind to a node\n");
+    printf("  -f  keep the cache in this file rather than in memory (env MEMSTREAM_FILE)\n");
+    printf("  -A  how values in the file are read, for readahead (default: random)\n");
+    printf("  -S  save snapshots to file and load it at startup (env MEMSTREAM_SNAPSHOT)\n");
+    printf("  -p  seconds between snapshots, 0 for only at shutdown (default: 60)\n");
+    printf("  -W  append every change to this log between snapshots (needs -S, env MEMSTREAM_WAL)\n");
+    printf("  -F  sync the log at least every this many ms (default: 10)\n");
+    printf("  -b  shared memory for changes waiting to be logged (default: 16M)\n");
+    printf("  -t  record operations in the trace rings\n");
+    printf("  -d  print the trace of the running cache manager of that name and exit\n");
+}
+
+static int dump_trace(const char* name) {
+    if (cache_connect_name(name) != 0) {
+        printf("Failed to connect to cache - Is cache manager running?\n");
+        return 1;
+    }
+    int count = cache_trace_dump(stdout);
+    if (count == 0) {
+        printf("No trace events (start the cache manager with -t)\n");
+    }
+    return count < 0;
+}
+
+int main(int argc, char* argv[]) {
+    cache_config_t config;
+    cache_config_init(&config);
+    if (parse_env(&config) != 0) {
+        return 1;
+    }
+
+    int trace = 0;
+    int dump = 0;
+    int opt;
+    while ((opt = getopt(argc, argv, "i:m:n:k:e:s:r:HPLN:f:A:S:p:W:F:b:tdh")) != -1) {
+        switch (opt) {
+        case 'm':
+            if (parse_size(optarg, &config.max_memory) != 0) {
+                printf("Invalid memory size: %s\n", optarg);
+                usage(argv[0]);
+                return 1;
+            }
+            break;
+        case 'n':
+            if (parse_size(optarg, &config.max_entries) != 0) {
+                printf("Invalid entry count: %s\n", optarg);
+                usage(argv[0]);
+                return 1;
+            }
+            break;
+        case 'k':
+            config.max_key_length = (uint32_t)strtoul(optarg, NULL, 10);
+            break;
+        case 'e':
+            if (parse_policy(optarg, &config.evict_policy) != 0) {
+                printf("Unknown eviction policy: %s\n", optarg);
+                usage(argv[0]);
+                return 1;
+            }
+            break;
+        case 's':
+            config.shards = (uint32_t)strtoul(optarg, NULL, 10);
+            break;
+        case 'r':
+            if (strcmp(optarg, "optimistic") == 0) {
+                config.optimistic_reads = 1;
+            } else if (strcmp(optarg, "locked") == 0) {
+                config.optimistic_reads = 0;
+            } else {
+                printf("Unknown read mode: %s\n", optarg);
+                usage(argv[0]);
+                return 1;
+            }
+            break;
+        case 'H':
+            config.huge_pages = 1;
+            break;
+        case 'P':
+            config.prefault = 1;
+            break;
+        case 'L':
+            config.lock_memory = 1;
+            break;
+        case 'N':
+            if (parse_numa(optarg, &config) != 0) {
+                printf("Invalid NUMA placement: %s\n", optarg);
+                usage(argv[0]);
+                return 1;
+            }
+            break;
+        case 'f':
+            config.backing_file = optarg;
+            break;
+        case 'A':
+            if (parse_access(optarg, &config.value_access) != 0) {
+                printf("Unknown access pattern: %s\n", optarg);
+                usage(argv[0]);
+                return 1;
+            }
+            break;
+        case 'S':
+            snapshot_path = optarg;
+            break;
+        case 'p':
+            snapshot_interval = (unsigned)strtoul(optarg, NULL, 10);
+            break;
+        case 'W':
+            wal_path = optarg;
+            break;
+        case 'F':
+            wal_fsync_ms = (unsigned)strtoul(optarg, NULL, 10);
+            break;
+        case 'b':
+            if (parse_size(optarg, &wal_buffer) != 0) {
+                printf("Invalid log buffer size: %s\n", optarg);
+                usage(argv[0]);
+                return 1;
+            }
+            break;
+        case 't':
+            trace = 1;
+            break;
+        case 'i':
+            config.name = optarg;
+            break;
+        case 'd':
+            dump = 1;
+            break;
+        default:
+            usage(argv[0]);
+            return opt == 'h' ? 0 : 1;
+        }
+    }
+
+    if (dump) {
+        return dump_trace(config.name);
+    }
+    if (wal_path) {
+        if (!snapshot_path) {
+            printf("A log (-W) is replayed on top of a snapshot, so it needs -S as well\n");
+            return 1;
+        }
+        if (snprintf(wal_old, sizeof(wal_old), "%s.old", wal_path) >= (int)sizeof(wal_old)) {
+            printf("Log path too long: %s\n", wal_path);
+            return 1;
+        }
+        config.wal_buffer = wal_buffer;
+    }
+
     signal(SIGINT, handle_signal);
     signal(SIGTERM, handle_signal);
 
-    printf("Starting Cache Manager...\n");
+    printf("Starting Cache Manager '%s'...\n",
+           config.name ? config.name : CACHE_DEFAULT_NAME);
+    printf("Eviction policy: %s, shards: %u, reads: %s\n",
+           policy_names[config.evict_policy], config.shards,
+           config.optimistic_reads ? "optimistic" : "locked");
 
     // Initialize cache
-    int result = cache_init(1024 * 1024);  // 1MB cache
+    int result = cache_init_config(&config);
     if (result != 0) {
         printf("Failed to initialize cache: error code %d\n", result);
         return 1;
     }
-
-    // Print shared memory info
-    int shm_id = shmget(0x1234, 0, 0);
-    if (shm_id != -1) {
-        struct shmid_ds shm_info;
-        if (shmctl(shm_id, IPC_STAT, &shm_info) == 0) {
-            printf("Shared Memory Info:\n");
-            printf("Segment ID: %d\n", shm_id);
-            printf("Size: %lu bytes\n", shm_info.shm_segsz);
-            printf("Number of attaches: %lu\n", shm_info.shm_nattch);
+    cache_trace_enable(trace);
+    pthread_t snapshotter, logger;
+    int snapshotting = 0;
+    int logging = 0;
+    if (snapshot_path) {
+        load_snapshot();
+    }
+    if (wal_path) {
+        replay_logs();
+        if (open_log() != 0) {
+            cache_destroy();
+            return 1;
         }
+        cache_wal_enable(1);
+        logging = pthread_create(&logger, NULL, wal_loop, NULL) == 0;
+    }
+    if (snapshot_path && (snapshot_interval > 0 || wal_path)) {
+        snapshotting = pthread_create(&snapshotter, NULL, snapshot_loop, NULL) == 0;
     }
 
     printf("Cache initialized successfully\n");
@@ -43,10 +481,13 @@ int main() {
     printf("Press Ctrl+C to shutdown\n");
 
     while (running) {
+        cache_reap(REAP_BUDGET);
+        cache_compact(COMPACT_BUDGET);
+
         cache_stats_t stats;
         if (cache_get_stats(&stats) == 0) {
-            printf("\rEntries: %zu, Used: %zu bytes    ",
-                   stats.total_entries, stats.used_size);
+            printf("\rEntries: %zu, Used: %zu bytes, Evictions: %zu, Reaped: %zu    ",
+                   stats.total_entries, stats.used_size, stats.evictions, stats.reaped);
             fflush(stdout);
         } else {
             printf("\rFailed to get stats    ");
@@ -56,6 +497,15 @@ int main() {
     }
 
     printf("\nShutting down Cache Manager...\n");
+    if (snapshotting) {
+        pthread_join(snapshotter, NULL);
+    }
+    if (logging) {
+        pthread_join(logger, NULL);
+    }
+    if (snapshot_path) {
+        save_snapshot();
+    }
     cache_destroy();
     printf("Cache Manager stopped\n");
 
@@ -0,0 +1,551 @@
+// cache_segment.c - creating, placing and attaching the shared segment
+#define _GNU_SOURCE
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/file.h>
+#include <sys/stat.h>
+#include <sys/syscall.h>
+#include "cache_internal.h"
+
+// The manager creates the segment and decides where its pages live: huge
+// pages when asked for and available, a NUMA policy, and optionally every
+// page faulted in and locked up front so the first lookups do not pay for
+// it. Clients only ever attach to what is there.
+//
+// Every cache instance is a named POSIX shared memory object,
+// /dev/shm/memstream.<name>, or a file of the same name on hugetlbfs when it
+// was created with huge pages. Any number of instances can live side by
+// side; a process attaches to one of them by name.
+//
+// An instance can also live in an ordinary file mapped MAP_SHARED, so it
+// may be larger than memory and the kernel pages values in and out. The
+// shared memory object is then only a stub holding the file's path, which
+// clients follow when they attach.
+//
+// The manager holds an exclusive flock on the instance's object for as long
+// as it runs. A second manager for the same name is refused while the lock
+// is held; an object nobody holds was left by a manager that died, and is
+// removed and created again.
+
+#ifndef MADV_POPULATE_WRITE
+#define MADV_POPULATE_WRITE 23
+#endif
+
+// mbind(2) modes, declared here rather than pulling in libnuma
+#define MPOL_BIND 2
+#define MPOL_INTERLEAVE 3
+#define MPOL_LOCAL 4
+#define MPOL_MF_MOVE (1 << 1)
+#define NUMA_MAX_NODES 1024
+#define MASK_BITS (8 * sizeof(unsigned long))
+
+#define DEFAULT_HUGE_PAGE (2 * 1024 * 1024)
+#define HUGETLBFS_DIR "/dev/hugepages"
+#define REDIRECT_MAGIC 0x52444d53  // "SMDR"
+
+typedef struct {
+    uint32_t magic;
+    uint32_t reserved;
+    char path[PATH_MAX];  // Absolute path of the backing file
+} redirect_t;
+
+int segment_name_valid(const char* name) {
+    size_t len = strlen(name);
+    if (len == 0 || len > CACHE_NAME_MAX) {
+        return 0;
+    }
+    for (const char* p = name; *p; p++) {
+        if (!((*p >= 'a' && *p <= 'z') || (*p >= 'A' && *p <= 'Z') ||
+              (*p >= '0' && *p <= '9') || *p == '_' || *p == '-' || *p == '.')) {
+            return 0;
+        }
+    }
+    return 1;
+}
+
+const char* segment_default_name(void) {
+    const char* name = getenv("MEMSTREAM_NAME");
+    return name && *name ? name : CACHE_DEFAULT_NAME;
+}
+
+static void shm_path(const segment_t* seg, char* path, size_t len) {
+    snprintf(path, len, "/memstream.%s", seg->name);
+}
+
+static void huge_path(const segment_t* seg, char* path, size_t len) {
+    snprintf(path, len, HUGETLBFS_DIR "/memstream.%s", seg->name);
+}
+
+static int set_name(segment_t* seg, const char* name) {
+    if (!name) {
+        name = segment_default_name();
+    }
+    if (!segment_name_valid(name)) {
+        printf("Invalid cache name '%s': use up to %d letters, digits, '.', '_' or '-'\n",
+               name, CACHE_NAME_MAX);
+        return -1;
+    }
+    strcpy(seg->name, name);
+    return 0;
+}
+
+// Map an open object of size bytes; the mapping keeps it alive, so the
+// descriptor is closed either way
+static int map_fd(segment_t* seg, int fd, size_t size) {
+    void* base = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    int saved = errno;
+    close(fd);
+    if (base == MAP_FAILED) {
+        errno = saved;
+        return -1;
+    }
+    seg->base = base;
+    seg->size = size;
+    return 0;
+}
+
+// Take the instance's lock on a new object, through a descriptor of our own
+static void hold_lock(segment_t* seg, int fd) {
+    seg->lock_fd = dup(fd);
+    if (seg->lock_fd == -1 || flock(seg->lock_fd, LOCK_EX | LOCK_NB) != 0) {
+        printf("Warning: could not lock cache '%s': %s\n", seg->name, strerror(errno));
+    }
+    seg->owner = 1;
+}
+
+static void drop_lock(segment_t* seg) {
+    if (seg->owner) {
+        close(seg->lock_fd);
+        seg->owner = 0;
+    }
+}
+
+// Remove path if it is left over from a manager that is gone; fail if a
+// running manager holds it
+static int remove_stale(const segment_t* seg, const char* path, int shm) {
+    int fd = shm ? shm_open(path, O_RDWR, 0) : open(path, O_RDWR);
+    if (fd == -1) {
+        if (errno == ENOENT) {
+            return 0;
+        }
+        printf("Failed to check %s: %s\n", path, strerror(errno));
+        return -1;
+    }
+    int running = flock(fd, LOCK_EX | LOCK_NB) != 0;
+    if (running) {
+        close(fd);
+        printf("Cache instance '%s' already exists and its manager is running\n", seg->name);
+        return -1;
+    }
+    printf("Removing %s, left by a manager that is no longer running\n", path);
+    redirect_t redirect;
+    struct stat info;
+    if (shm && fstat(fd, &info) == 0 && info.st_size == sizeof(redirect) &&
+        pread(fd, &redirect, sizeof(redirect), 0) == (ssize_t)sizeof(redirect) &&
+        redirect.magic == REDIRECT_MAGIC) {
+        // The stub proves that manager created the backing file
+        redirect.path[sizeof(redirect.path) - 1] = '\0';
+        printf("Removing its backing file %s\n", redirect.path);
+        unlink(redirect.path);
+    }
+    close(fd);
+    if ((shm ? shm_unlink(path) : unlink(path)) != 0 && errno != ENOENT) {
+        printf("Failed to remove %s: %s\n", path, strerror(errno));
+        return -1;
+    }
+    return 0;
+}
+
+static size_t huge_page_size(void) {
+    FILE* f = fopen("/proc/meminfo", "r");
+    if (!f) {
+        return DEFAULT_HUGE_PAGE;
+    }
+    char line[128];
+    size_t kb = 0;
+    while (fgets(line, sizeof(line), f)) {
+        if (sscanf(line, "Hugepagesize: %zu kB", &kb) == 1) {
+            break;
+        }
+    }
+    fclose(f);
+    return kb ? kb * 1024 : DEFAULT_HUGE_PAGE;
+}
+
+// Set the bit of every node listed in /sys/devices/system/node/online
+// ("0-3,6"); node 0 alone when the file is missing
+static void online_nodes(unsigned long* mask) {
+    FILE* f = fopen("/sys/devices/system/node/online", "r");
+    unsigned first, last;
+    if (f) {
+        char sep;
+        while (fscanf(f, "%u", &first) == 1) {
+            last = first;
+            if (fscanf(f, "%c", &sep) == 1 && sep == '-') {
+                if (fscanf(f, "%u", &last) != 1) {
+                    break;
+                }
+                if (fscanf(f, "%c", &sep) != 1) {
+                    sep = '\n';
+                }
+            }
+            for (unsigned node = first; node <= last && node < NUMA_MAX_NODES; node++) {
+                mask[node / MASK_BITS] |= 1UL << (node % MASK_BITS);
+            }
+            if (sep != ',') {
+                break;
+            }
+        }
+        fclose(f);
+    }
+    if (!f) {
+        mask[0] |= 1;
+    }
+}
+
+// Apply the configured NUMA policy before any page is touched, moving
+// pages already faulted in
+static void place_segment(segment_t* seg, const cache_config_t* config) {
+    static const char* names[] = {"default", "interleave", "local", "bind"};
+    unsigned long mask[NUMA_MAX_NODES / MASK_BITS];
+    memset(mask, 0, sizeof(mask));
+    int mode;
+    switch (config->numa) {
+    case CACHE_NUMA_INTERLEAVE:
+        mode = MPOL_INTERLEAVE;
+        online_nodes(mask);
+        break;
+    case CACHE_NUMA_LOCAL:
+        mode = MPOL_LOCAL;
+        break;
+    case CACHE_NUMA_BIND:
+        if (config->numa_node < 0 || config->numa_node >= NUMA_MAX_NODES) {
+            printf("Warning: NUMA node %d out of range, policy not applied\n",
+                   config->numa_node);
+            return;
+        }
+        mode = MPOL_BIND;
+        mask[config->numa_node / MASK_BITS] |= 1UL << (config->numa_node % MASK_BITS);
+        break;
+    default:
+        return;
+    }
+
+    int local = mode == MPOL_LOCAL;
+    if (syscall(SYS_mbind, seg->base, seg->size, mode, local ? NULL : mask,
+                local ? 0 : NUMA_MAX_NODES, MPOL_MF_MOVE) != 0) {
+        printf("Warning: NUMA policy %s not applied: %s\n", names[config->numa],
+               strerror(errno));
+        return;
+    }
+    printf("NUMA policy: %s", names[config->numa]);
+    if (mode == MPOL_BIND) {
+        printf(" to node %d", config->numa_node);
+    }
+    printf("\n");
+}
+
+static void prefault(segment_t* seg) {
+    if (madvise(seg->base, seg->size, MADV_POPULATE_WRITE) != 0) {
+        // Older kernels: touch one byte per page, all still zero
+        long page = sysconf(_SC_PAGESIZE);
+        for (size_t off = 0; off < seg->size; off += (size_t)page) {
+            ((volatile char*)seg->base)[off] = 0;
+        }
+    }
+    printf("Prefaulted %zu bytes\n", seg->size);
+}
+
+// A fresh sparse backing file, and the stub that points clients at it.
+// The file must not exist: the manager owns it and deletes it on shutdown,
+// so it never takes over a path that might hold something else.
+static int create_file(segment_t* seg, const char* file, const char* stub, size_t size) {
+    int fd = open(file, O_RDWR | O_CREAT | O_EXCL, 0666);
+    if (fd == -1) {
+        if (errno == EEXIST) {
+            printf("Backing file %s already exists; the manager creates and deletes it "
+                   "itself, so give a path that does not exist\n", file);
+        } else {
+            printf("Failed to create backing file %s: %s\n", file, strerror(errno));
+        }
+        return -1;
+    }
+    fchmod(fd, 0666);
+    if (!realpath(file, seg->file)) {
+        snprintf(seg->file, sizeof(seg->file), "%s", file);
+    }
+    if (ftruncate(fd, (off_t)size) != 0) {
+        printf("Failed to size %s to %zu bytes: %s\n", file, size, strerror(errno));
+        close(fd);
+        unlink(seg->file);
+        return -1;
+    }
+    if (map_fd(seg, fd, size) != 0) {
+        printf("mmap of %s failed: %s\n", file, strerror(errno));
+        unlink(seg->file);
+        return -1;
+    }
+
+    redirect_t redirect;
+    memset(&redirect, 0, sizeof(redirect));
+    redirect.magic = REDIRECT_MAGIC;
+    snprintf(redirect.path, sizeof(redirect.path), "%s", seg->file);
+    fd = shm_open(stub, O_RDWR | O_CREAT | O_EXCL, 0666);
+    if (fd != -1) {
+        hold_lock(seg, fd);
+    }
+    if (fd == -1 || pwrite(fd, &redirect, sizeof(redirect), 0) != (ssize_t)sizeof(redirect)) {
+        printf("Failed to publish %s as %s: %s\n", seg->file, stub, strerror(errno));
+        if (fd != -1) {
+            close(fd);
+            shm_unlink(stub);
+            drop_lock(seg);
+        }
+        segment_detach(seg);
+        unlink(seg->file);
+        return -1;
+    }
+    fchmod(fd, 0666);
+    close(fd);
+    seg->file_backed = 1;
+    return 0;
+}
+
+// Follow a stub to the backing file; fd is the stub and is closed
+static int attach_file(segment_t* seg, int fd) {
+    redirect_t redirect;
+    ssize_t n = pread(fd, &redirect, sizeof(redirect), 0);
+    close(fd);
+    if (n != (ssize_t)sizeof(redirect) || redirect.magic != REDIRECT_MAGIC) {
+        printf("Shared memory for cache '%s' is not ready\n", seg->name);
+        return -1;
+    }
+    redirect.path[sizeof(redirect.path) - 1] = '\0';
+    fd = open(redirect.path, O_RDWR);
+    struct stat info;
+    if (fd == -1 || fstat(fd, &info) != 0) {
+        printf("Failed to open backing file %s of cache '%s': %s\n", redirect.path,
+               seg->name, strerror(errno));
+        if (fd != -1) {
+            close(fd);
+        }
+        return -1;
+    }
+    if (map_fd(seg, fd, (size_t)info.st_size) != 0) {
+        printf("Failed to map %s: %s\n", redirect.path, strerror(errno));
+        return -1;
+    }
+    snprintf(seg->file, sizeof(seg->file), "%s", redirect.path);
+    seg->file_backed = 1;
+    return 0;
+}
+
+// A fresh file on hugetlbfs, sized in whole huge pages
+static int create_huge(segment_t* seg, size_t size) {
+    char path[sizeof(HUGETLBFS_DIR) + CACHE_NAME_MAX + 16];
+    huge_path(seg, path, sizeof(path));
+    size_t huge = huge_page_size();
+    size = (size + huge - 1) / huge * huge;
+
+    int fd = open(path, O_RDWR | O_CREAT | O_EXCL, 0666);
+    if (fd == -1) {
+        return -1;
+    }
+    hold_lock(seg, fd);
+    fchmod(fd, 0666);
+    int failed = ftruncate(fd, (off_t)size) != 0;
+    if (failed) {
+        close(fd);
+    } else {
+        failed = map_fd(seg, fd, size) != 0;  // Fails when no huge pages are free
+    }
+    if (failed) {
+        int saved = errno;
+        unlink(path);
+        drop_lock(seg);
+        errno = saved;
+        return -1;
+    }
+    printf("Using %zu kB huge pages\n", huge / 1024);
+    return 0;
+}
+
+int segment_create(segment_t* seg, const cache_config_t* config, size_t size) {
+    char path[CACHE_NAME_MAX + 16];
+    seg->base = NULL;
+    seg->huge_pages = 0;
+    seg->file_backed = 0;
+    seg->owner = 0;
+    if (set_name(seg, config->name) != 0) {
+        return -1;
+    }
+    shm_path(seg, path, sizeof(path));
+    char huge[sizeof(HUGETLBFS_DIR) + CACHE_NAME_MAX + 16];
+    huge_path(seg, huge, sizeof(huge));
+    if (remove_stale(seg, path, 1) != 0 || remove_stale(seg, huge, 0) != 0) {
+        return -1;
+    }
+
+    if (config->backing_file) {
+        if (config->huge_pages) {
+            printf("Huge pages do not apply to a backing file, using normal pages\n");
+        }
+        if (create_file(seg, config->backing_file, path, size) != 0) {
+            return -1;
+        }
+    } else if (config->huge_pages) {
+        if (create_huge(seg, size) == 0) {
+            seg->huge_pages = 1;
+        } else if (errno == EEXIST) {
+            printf("Cache instance '%s' already exists\n", seg->name);
+            return -1;
+        } else {
+            printf("Huge pages unavailable (%s), using normal pages\n", strerror(errno));
+        }
+    }
+    if (!seg->huge_pages && !seg->file_backed) {
+        int fd = shm_open(path, O_RDWR | O_CREAT | O_EXCL, 0666);
+        if (fd == -1) {
+            if (errno == EEXIST) {
+                printf("Cache instance '%s' already exists\n", seg->name);
+            } else {
+                printf("shm_open %s failed: %s\n", path, strerror(errno));
+            }
+            return -1;
+        }
+        hold_lock(seg, fd);
+        fchmod(fd, 0666);  // Whatever the umask, every service may attach
+        if (ftruncate(fd, (off_t)size) != 0) {
+            printf("Failed to size shared memory to %zu bytes: %s\n", size, strerror(errno));
+            close(fd);
+            shm_unlink(path);
+            drop_lock(seg);
+            return -1;
+        }
+        if (map_fd(seg, fd, size) != 0) {
+            printf("mmap failed: %s\n", strerror(errno));
+            shm_unlink(path);
+            drop_lock(seg);
+            return -1;
+        }
+    }
+    printf("Created %s %s: %zu bytes at %p\n", seg->file_backed ? "backing file" : "shared memory",
+           seg->file_backed ? seg->file : seg->huge_pages ? huge : path, seg->size, seg->base);
+
+    if (config->huge_pages && !seg->huge_pages && !seg->file_backed) {
+        // Transparent huge pages, where the kernel allows them for shmem
+        madvise(seg->base, seg->size, MADV_HUGEPAGE);
+    }
+    place_segment(seg, config);
+    if (config->prefault) {
+        prefault(seg);
+    }
+    if (config->lock_memory && !seg->file_backed) {
+        // The manager keeps the segment mapped for its lifetime, so its lock
+        // keeps every page resident. A file-backed segment only locks its
+        // metadata, see segment_lock.
+        if (mlock(seg->base, seg->size) == 0) {
+            printf("Locked %zu bytes in memory\n", seg->size);
+        } else {
+            printf("Warning: could not lock the segment: %s\n", strerror(errno));
+        }
+    }
+    return 0;
+}
+
+int segment_attach(segment_t* seg, const char* name) {
+    char path[sizeof(HUGETLBFS_DIR) + CACHE_NAME_MAX + 16];
+    if (set_name(seg, name) != 0) {
+        return -1;
+    }
+    shm_path(seg, path, sizeof(path));
+    seg->huge_pages = 0;
+    seg->file_backed = 0;
+    seg->owner = 0;
+    int fd = shm_open(path, O_RDWR, 0);
+    if (fd == -1 && errno == ENOENT) {
+        huge_path(seg, path, sizeof(path));
+        fd = open(path, O_RDWR);
+        seg->huge_pages = fd != -1;
+    }
+    if (fd == -1) {
+        printf("Failed to find shared memory for cache '%s': %s\n", seg->name,
+               strerror(errno));
+        return -1;
+    }
+
+    struct stat info;
+    if (fstat(fd, &info) != 0 || info.st_size == 0) {
+        printf("Shared memory for cache '%s' is not ready\n", seg->name);
+        close(fd);
+        return -1;
+    }
+    if (info.st_size == sizeof(redirect_t) && !seg->huge_pages) {
+        return attach_file(seg, fd);
+    }
+    if (map_fd(seg, fd, (size_t)info.st_size) != 0) {
+        printf("Failed to attach to shared memory: %s\n", strerror(errno));
+        return -1;
+    }
+    return 0;
+}
+
+void segment_detach(segment_t* seg) {
+    if (seg->base) {
+        munmap(seg->base, seg->size);
+        seg->base = NULL;
+        seg->size = 0;
+    }
+}
+
+void segment_remove(segment_t* seg) {
+    segment_detach(seg);
+    if (seg->name[0] == '\0') {
+        return;
+    }
+    char path[sizeof(HUGETLBFS_DIR) + CACHE_NAME_MAX + 16];
+    if (seg->huge_pages) {
+        huge_path(seg, path, sizeof(path));
+        unlink(path);
+    } else {
+        shm_path(seg, path, sizeof(path));
+        shm_unlink(path);
+    }
+    if (seg->file_backed) {
+        unlink(seg->file);  // Its contents do not outlive the manager
+        seg->file_backed = 0;
+    }
+    drop_lock(seg);  // Only now, so no new manager removes what is still in use
+    seg->name[0] = '\0';
+}
+
+// Widen [offset, offset + len) of the segment to whole pages
+static void page_range(segment_t* seg, size_t offset, size_t len, char** start, size_t* bytes) {
+    size_t page = (size_t)sysconf(_SC_PAGESIZE);
+    size_t first = offset / page * page;
+    size_t end = (offset + len + page - 1) / page * page;
+    if (end > seg->size) {
+        end = seg->size;
+    }
+    *start = (char*)seg->base + first;
+    *bytes = end - first;
+}
+
+void segment_advise(segment_t* seg, size_t offset, size_t len, int advice) {
+    char* start;
+    size_t bytes;
+    page_range(seg, offset, len, &start, &bytes);
+    madvise(start, bytes, advice);
+}
+
+int segment_lock(segment_t* seg, size_t offset, size_t len) {
+    char* start;
+    size_t bytes;
+    page_range(seg, offset, len, &start, &bytes);
+    return mlock(start, bytes);
+}
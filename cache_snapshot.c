@@ -0,0 +1,303 @@
+// cache_snapshot.c - saving the live entries to a file and loading them back
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <libgen.h>
+#include <limits.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include "cache_internal.h"
+
+// A snapshot is a header followed by one record per live key:
+//
+//   record_t | key (key_len bytes, no NUL) | value (value_size bytes)
+//
+// The header holds the record count, the size of the record area and a
+// CRC-32 over it. Saving walks each shard SNAPSHOT_CHUNK entry slots at a
+// time, copying them out under the read lock and writing them after it is
+// dropped, so readers never wait and writers only wait for a chunk's
+// memcpy. The result is fuzzy, not a point in time: a key changed during
+// the walk may be saved with either value. The file is written next to the
+// target and renamed over it, so a crash leaves the previous snapshot.
+
+#define SNAPSHOT_MAGIC 0x504e534d  // "MSNP"
+#define SNAPSHOT_VERSION 1
+#define SNAPSHOT_CHUNK 1024
+
+typedef struct {
+    uint32_t magic;
+    uint32_t version;
+    uint64_t created_at;  // Wall clock in ms
+    uint64_t count;
+    uint64_t data_size;   // Bytes of records after the header
+    uint32_t crc;         // CRC-32 of the records
+    uint32_t reserved;
+} snapshot_header_t;
+
+typedef struct {
+    uint64_t expires_at;  // Wall clock in ms, 0 = never
+    uint32_t value_size;
+    uint16_t key_len;
+} __attribute__((packed)) record_t;
+
+typedef struct {
+    char* data;
+    size_t len;
+    size_t cap;
+} buffer_t;
+
+// CRC-32 (IEEE), eight bytes per step with the slicing-by-8 tables so the
+// manager can checksum the log as fast as writers fill it
+static uint32_t crc_table[8][256];
+static pthread_once_t crc_once = PTHREAD_ONCE_INIT;
+
+static void crc_init(void) {
+    for (uint32_t i = 0; i < 256; i++) {
+        uint32_t c = i;
+        for (int k = 0; k < 8; k++) {
+            c = c & 1 ? 0xedb88320 ^ (c >> 1) : c >> 1;
+        }
+        crc_table[0][i] = c;
+    }
+    for (uint32_t i = 0; i < 256; i++) {
+        for (int t = 1; t < 8; t++) {
+            uint32_t c = crc_table[t - 1][i];
+            crc_table[t][i] = crc_table[0][c & 0xff] ^ (c >> 8);
+        }
+    }
+}
+
+uint32_t crc32_update(uint32_t crc, const void* data, size_t len) {
+    pthread_once(&crc_once, crc_init);
+    const unsigned char* p = data;
+    crc = ~crc;
+    for (; len >= 8; len -= 8, p += 8) {
+        uint32_t lo, hi;
+        memcpy(&lo, p, 4);
+        memcpy(&hi, p + 4, 4);
+        lo ^= crc;  // Little-endian, as everything else in the segment
+        crc = crc_table[7][lo & 0xff] ^ crc_table[6][(lo >> 8) & 0xff] ^
+              crc_table[5][(lo >> 16) & 0xff] ^ crc_table[4][lo >> 24] ^
+              crc_table[3][hi & 0xff] ^ crc_table[2][(hi >> 8) & 0xff] ^
+              crc_table[1][(hi >> 16) & 0xff] ^ crc_table[0][hi >> 24];
+    }
+    while (len--) {
+        crc = crc_table[0][(crc ^ *p++) & 0xff] ^ (crc >> 8);
+    }
+    return ~crc;
+}
+
+static uint64_t wall_ms(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_REALTIME, &ts);
+    return (uint64_t)ts.tv_sec * 1000 + (uint64_t)ts.tv_nsec / 1000000;
+}
+
+static int buffer_append(buffer_t* b, const void* data, size_t len) {
+    if (b->len + len > b->cap) {
+        size_t cap = b->cap ? b->cap : 64 * 1024;
+        while (cap < b->len + len) {
+            cap *= 2;
+        }
+        char* grown = realloc(b->data, cap);
+        if (!grown) {
+            return -1;
+        }
+        b->data = grown;
+        b->cap = cap;
+    }
+    memcpy(b->data + b->len, data, len);
+    b->len += len;
+    return 0;
+}
+
+// Copy the live entries of slots [start, end) into out, under the read lock
+static long copy_chunk(shard_t* s, size_t start, size_t end, uint64_t now, buffer_t* out) {
+    long count = 0;
+    pthread_rwlock_rdlock(&s->lock);
+    entry_t* entries = shard_entries(s);
+    for (size_t i = start; i < end; i++) {
+        entry_t* e = &entries[i];
+        if (!e->is_valid || (e->expires_at && now >= e->expires_at) ||
+            e->value_size > UINT32_MAX) {
+            continue;
+        }
+        record_t record = {e->expires_at, (uint32_t)e->value_size, e->key_len};
+        if (buffer_append(out, &record, sizeof(record)) != 0 ||
+            buffer_append(out, entry_key(s, e), e->key_len) != 0 ||
+            buffer_append(out, shard_arena(s)->data + e->data_offset, e->value_size) != 0) {
+            count = -1;
+            break;
+        }
+        count++;
+    }
+    pthread_rwlock_unlock(&s->lock);
+    return count;
+}
+
+// fsync the directory holding path so the rename itself is durable
+static void sync_dir(const char* path) {
+    char copy[PATH_MAX];
+    snprintf(copy, sizeof(copy), "%s", path);
+    int fd = open(dirname(copy), O_RDONLY | O_DIRECTORY);
+    if (fd != -1) {
+        fsync(fd);
+        close(fd);
+    }
+}
+
+long snapshot_save(cache_t* c, const char* path) {
+    char tmp[PATH_MAX];
+    if (snprintf(tmp, sizeof(tmp), "%s.tmp", path) >= (int)sizeof(tmp)) {
+        printf("Snapshot path too long: %s\n", path);
+        return -1;
+    }
+    FILE* f = fopen(tmp, "wb");
+    if (!f) {
+        printf("Failed to create snapshot %s: %s\n", tmp, strerror(errno));
+        return -1;
+    }
+
+    snapshot_header_t header = {SNAPSHOT_MAGIC, SNAPSHOT_VERSION, wall_ms(), 0, 0, 0, 0};
+    buffer_t chunk = {NULL, 0, 0};
+    int ok = fwrite(&header, sizeof(header), 1, f) == 1;
+    for (uint32_t i = 0; i < c->nshards && ok; i++) {
+        shard_t* s = cache_shard(c, i);
+        for (size_t start = 0; start < s->nentries && ok; start += SNAPSHOT_CHUNK) {
+            size_t end = start + SNAPSHOT_CHUNK < s->nentries ? start + SNAPSHOT_CHUNK
+                                                               : s->nentries;
+            chunk.len = 0;
+            long count = copy_chunk(s, start, end, header.created_at, &chunk);
+            if (count < 0) {
+                printf("Out of memory while writing snapshot\n");
+                ok = 0;
+                break;
+            }
+            if (chunk.len && fwrite(chunk.data, 1, chunk.len, f) != chunk.len) {
+                ok = 0;
+                break;
+            }
+            header.crc = crc32_update(header.crc, chunk.data, chunk.len);
+            header.count += (uint64_t)count;
+            header.data_size += chunk.len;
+        }
+    }
+    free(chunk.data);
+
+    ok = ok && fseek(f, 0, SEEK_SET) == 0 && fwrite(&header, sizeof(header), 1, f) == 1 &&
+         fflush(f) == 0 && fsync(fileno(f)) == 0;
+    if (!ok) {
+        printf("Failed to write snapshot %s: %s\n", tmp, strerror(errno));
+    }
+    if (fclose(f) != 0 || !ok || rename(tmp, path) != 0) {
+        if (ok) {
+            printf("Failed to replace snapshot %s: %s\n", path, strerror(errno));
+        }
+        unlink(tmp);
+        return -1;
+    }
+    sync_dir(path);
+    return (long)header.count;
+}
+
+// Check the header, the checksum and that the records exactly fill the
+// file before anything is loaded, so a damaged snapshot loads nothing
+static int snapshot_valid(const char* path, const char* data, size_t size) {
+    const snapshot_header_t* header = (const snapshot_header_t*)data;
+    if (size < sizeof(*header) || header->magic != SNAPSHOT_MAGIC) {
+        printf("%s is not a snapshot\n", path);
+        return 0;
+    }
+    if (header->version != SNAPSHOT_VERSION) {
+        printf("Snapshot %s has version %u, expected %u\n", path, header->version,
+               SNAPSHOT_VERSION);
+        return 0;
+    }
+    const char* p = data + sizeof(*header);
+    const char* end = data + size;
+    if (header->data_size != (uint64_t)(end - p) ||
+        crc32_update(0, p, (size_t)(end - p)) != header->crc) {
+        printf("Snapshot %s is corrupt (checksum mismatch)\n", path);
+        return 0;
+    }
+    uint64_t count = 0;
+    while (p < end) {
+        record_t record;
+        if ((size_t)(end - p) < sizeof(record)) {
+            break;
+        }
+        memcpy(&record, p, sizeof(record));
+        size_t len = sizeof(record) + record.key_len + (size_t)record.value_size;
+        if ((size_t)(end - p) < len || record.key_len == 0) {
+            break;
+        }
+        p += len;
+        count++;
+    }
+    if (p != end || count != header->count) {
+        printf("Snapshot %s is corrupt (bad record at offset %zu)\n", path,
+               (size_t)(p - data));
+        return 0;
+    }
+    return 1;
+}
+
+long snapshot_load(const char* path) {
+    int fd = open(path, O_RDONLY);
+    if (fd == -1) {
+        printf("Failed to open snapshot %s: %s\n", path, strerror(errno));
+        return -1;
+    }
+    struct stat info;
+    if (fstat(fd, &info) != 0 || info.st_size == 0) {
+        printf("Snapshot %s is empty\n", path);
+        close(fd);
+        return -1;
+    }
+    size_t size = (size_t)info.st_size;
+    char* data = mmap(NULL, size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if (data == MAP_FAILED) {
+        printf("Failed to map snapshot %s: %s\n", path, strerror(errno));
+        return -1;
+    }
+    madvise(data, size, MADV_SEQUENTIAL);
+    if (!snapshot_valid(path, data, size)) {
+        munmap(data, size);
+        return -1;
+    }
+
+    uint64_t total = ((const snapshot_header_t*)data)->count;
+    uint64_t now = wall_ms();
+    long loaded = 0;
+    uint64_t expired = 0;
+    char key[UINT16_MAX + 1];
+    for (const char* p = data + sizeof(snapshot_header_t); p < data + size;) {
+        record_t record;
+        memcpy(&record, p, sizeof(record));
+        p += sizeof(record);
+        memcpy(key, p, record.key_len);
+        key[record.key_len] = '\0';
+        p += record.key_len;
+
+        if (record.expires_at && now >= record.expires_at) {
+            expired++;
+        } else if (cache_set_ex(key, p, record.value_size,
+                                record.expires_at ? record.expires_at - now : 0) == 0) {
+            loaded++;
+        }
+        p += record.value_size;
+    }
+    munmap(data, size);
+
+    printf("Loaded %ld of %llu entries from snapshot %s", loaded,
+           (unsigned long long)total, path);
+    if (expired) {
+        printf(" (%llu expired since it was taken)", (unsigned long long)expired);
+    }
+    printf("\n");
+    return loaded;
+}
@@ -0,0 +1,127 @@
+// cache_trace.c - ring-buffered event trace in the shared segment
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <signal.h>
+#include <errno.h>
+#include <unistd.h>
+#include "cache_internal.h"
+
+// Every process writes to a ring of its own, claimed the first time it
+// traces, so the manager can dump what all clients did without any of them
+// doing I/O. Processes beyond TRACE_RINGS share rings by pid. An event's
+// timestamp is stored last and is 0 while the slot is being filled, which
+// lets a concurrent dump skip half-written events.
+
+static const char* op_names[] = {
+    [TRACE_SET_NEW] = "set-new",
+    [TRACE_SET_UPDATE] = "set-update",
+    [TRACE_SET_FAIL] = "set-fail",
+    [TRACE_DELETE] = "delete",
+    [TRACE_EVICT] = "evict",
+    [TRACE_REJECT] = "reject",
+    [TRACE_COMPACT] = "compact",
+    [TRACE_EXPIRE] = "expire",
+};
+
+static int process_alive(uint32_t pid) {
+    return kill((pid_t)pid, 0) == 0 || errno != ESRCH;
+}
+
+static trace_ring_t* claim_ring(cache_t* c, uint32_t pid) {
+    for (unsigned i = 0; i < TRACE_RINGS; i++) {
+        trace_ring_t* ring = &c->trace[i];
+        uint32_t owner = __atomic_load_n(&ring->pid, __ATOMIC_RELAXED);
+        if (owner == pid) {
+            return ring;
+        }
+        if ((owner == 0 || !process_alive(owner)) &&
+            __atomic_compare_exchange_n(&ring->pid, &owner, pid, 0,
+                                        __ATOMIC_ACQ_REL, __ATOMIC_RELAXED)) {
+            return ring;
+        }
+    }
+    return &c->trace[pid % TRACE_RINGS];
+}
+
+void trace_event(cache_t* c, trace_op_t op, uint32_t shard, const char* key,
+                 uint64_t a, uint64_t b) {
+    static __thread trace_ring_t* ring = NULL;
+    static __thread uint32_t ring_pid = 0;
+
+    uint32_t pid = (uint32_t)getpid();
+    if (!ring || ring_pid != pid) {  // First event, or a forked child
+        ring = claim_ring(c, pid);
+        ring_pid = pid;
+    }
+
+    uint64_t n = __atomic_fetch_add(&ring->next, 1, __ATOMIC_RELAXED);
+    trace_event_t* event = &ring->events[n % TRACE_EVENTS];
+    __atomic_store_n(&event->time_ns, 0, __ATOMIC_RELAXED);
+    __atomic_thread_fence(__ATOMIC_RELEASE);
+    event->pid = pid;
+    event->op = (uint16_t)op;
+    event->shard = (uint16_t)shard;
+    event->a = a;
+    event->b = b;
+    if (key) {
+        strncpy(event->key, key, sizeof(event->key) - 1);
+        event->key[sizeof(event->key) - 1] = '\0';
+    } else {
+        event->key[0] = '\0';
+    }
+
+    struct timespec ts;
+    clock_gettime(CLOCK_REALTIME, &ts);
+    __atomic_store_n(&event->time_ns, (uint64_t)ts.tv_sec * 1000000000u + ts.tv_nsec,
+                     __ATOMIC_RELEASE);
+}
+
+static int by_time(const void* a, const void* b) {
+    uint64_t ta = ((const trace_event_t*)a)->time_ns;
+    uint64_t tb = ((const trace_event_t*)b)->time_ns;
+    return ta < tb ? -1 : ta > tb;
+}
+
+// Print every recorded event, oldest first
+int trace_dump(cache_t* c, FILE* out) {
+    trace_event_t* events = malloc(sizeof(trace_event_t) * TRACE_RINGS * TRACE_EVENTS);
+    if (!events) {
+        return -1;
+    }
+
+    size_t count = 0;
+    for (unsigned i = 0; i < TRACE_RINGS; i++) {
+        trace_ring_t* ring = &c->trace[i];
+        for (unsigned j = 0; j < TRACE_EVENTS; j++) {
+            trace_event_t* event = &ring->events[j];
+            uint64_t time_ns = __atomic_load_n(&event->time_ns, __ATOMIC_ACQUIRE);
+            if (time_ns == 0) {
+                continue;
+            }
+            events[count] = *event;
+            events[count].key[sizeof(event->key) - 1] = '\0';
+            if (__atomic_load_n(&event->time_ns, __ATOMIC_ACQUIRE) == time_ns) {
+                count++;
+            }
+        }
+    }
+    qsort(events, count, sizeof(trace_event_t), by_time);
+
+    for (size_t i = 0; i < count; i++) {
+        trace_event_t* event = &events[i];
+        time_t secs = (time_t)(event->time_ns / 1000000000u);
+        struct tm tm;
+        char stamp[32];
+        localtime_r(&secs, &tm);
+        strftime(stamp, sizeof(stamp), "%H:%M:%S", &tm);
+        const char* name = event->op < sizeof(op_names) / sizeof(op_names[0]) &&
+                           op_names[event->op] ? op_names[event->op] : "?";
+        fprintf(out, "%s.%06lu pid=%u shard=%u %-10s %-24s %lu %lu\n",
+                stamp, (unsigned long)(event->time_ns % 1000000000u / 1000),
+                event->pid, event->shard, name, event->key,
+                (unsigned long)event->a, (unsigned long)event->b);
+    }
+    free(events);
+    return (int)count;
+}
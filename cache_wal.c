@@ -0,0 +1,208 @@
+// cache_wal.c - write-ahead log ring in the shared segment, and its replay
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <unistd.h>
+#include "cache_internal.h"
+
+// Every successful set and delete is appended to a ring in the segment by
+// the process that made it, while it still holds the shard's write lock, so
+// the ring has each key's changes in the order they were applied. Writers
+// reserve space with a CAS on head, fill the record in and publish it by
+// setting its check word last; they never wait for the disk. When the ring
+// is full the record is dropped and counted instead, and the manager
+// rewrites the log from a snapshot to close the gap.
+//
+// The manager is the only consumer: it copies published records out,
+// zeroes the space so the next lap starts from clean memory, advances tail
+// and writes the records to the log file with the check word replaced by a
+// CRC-32 of the rest of the record. A record never wraps around the end of
+// the ring; a writer that would cross it first fills the remainder with a
+// padding record.
+
+#define WAL_READY 1
+#define WAL_PAD 2
+
+static size_t round8(size_t n) {
+    return (n + 7) & ~(size_t)7;
+}
+
+static uint64_t wall_ms(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_REALTIME, &ts);
+    return (uint64_t)ts.tv_sec * 1000 + (uint64_t)ts.tv_nsec / 1000000;
+}
+
+void wal_append(cache_t* c, wal_op_t op, const char* key, size_t key_len,
+                const void* value, size_t value_size, uint64_t expires_at) {
+    wal_ring_t* ring = cache_wal(c);
+    char* data = wal_data(ring);
+    uint64_t mask = ring->size - 1;
+    size_t need = round8(sizeof(wal_record_t) + key_len + value_size);
+    if (value_size > UINT32_MAX || need > ring->size / 2) {
+        __atomic_fetch_add(&ring->dropped, 1, __ATOMIC_RELAXED);
+        return;
+    }
+
+    uint64_t head = __atomic_load_n(&ring->head, __ATOMIC_RELAXED);
+    uint64_t pad;
+    do {
+        uint64_t offset = head & mask;
+        pad = offset + need > ring->size ? ring->size - offset : 0;
+        if (head + pad + need - __atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE) > ring->size) {
+            __atomic_fetch_add(&ring->dropped, 1, __ATOMIC_RELAXED);
+            return;
+        }
+    } while (!__atomic_compare_exchange_n(&ring->head, &head, head + pad + need, 1,
+                                          __ATOMIC_RELAXED, __ATOMIC_RELAXED));
+
+    if (pad) {
+        // Only the first 8 bytes are written, which any padding has room for
+        wal_record_t* filler = (wal_record_t*)(data + (head & mask));
+        filler->size = (uint32_t)pad;
+        __atomic_store_n(&filler->check, WAL_PAD, __ATOMIC_RELEASE);
+    }
+    wal_record_t* record = (wal_record_t*)(data + ((head + pad) & mask));
+    record->size = (uint32_t)need;
+    record->expires_at = expires_at;
+    record->value_size = (uint32_t)value_size;
+    record->key_len = (uint16_t)key_len;
+    record->op = (uint8_t)op;
+    memcpy((char*)(record + 1), key, key_len);
+    if (value_size) {
+        memcpy((char*)(record + 1) + key_len, value, value_size);
+    }
+    __atomic_store_n(&record->check, WAL_READY, __ATOMIC_RELEASE);
+}
+
+long wal_drain(cache_t* c, int fd) {
+    static char* out = NULL;
+    static size_t cap = 0;
+
+    wal_ring_t* ring = cache_wal(c);
+    char* data = wal_data(ring);
+    uint64_t mask = ring->size - 1;
+    uint64_t tail = ring->tail;
+    uint64_t head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE);
+    size_t len = 0;
+    long records = 0;
+
+    while (tail < head) {
+        wal_record_t* record = (wal_record_t*)(data + (tail & mask));
+        uint32_t check = __atomic_load_n(&record->check, __ATOMIC_ACQUIRE);
+        if (check == 0) {
+            break;  // Reserved, still being written
+        }
+        uint32_t size = record->size;
+        if (check == WAL_READY) {
+            if (len + size > cap) {
+                size_t grown_cap = cap ? cap : 1 << 20;
+                while (grown_cap < len + size) {
+                    grown_cap *= 2;
+                }
+                char* grown = realloc(out, grown_cap);
+                if (!grown) {
+                    break;  // Leave the rest in the ring for the next call
+                }
+                out = grown;
+                cap = grown_cap;
+            }
+            wal_record_t* copy = (wal_record_t*)(out + len);
+            memcpy(copy, record, size);
+            copy->check = crc32_update(0, (char*)copy + WAL_CHECKED, size - WAL_CHECKED);
+            len += size;
+            records++;
+        }
+        memset(record, 0, size);
+        tail += size;
+    }
+    __atomic_store_n(&ring->tail, tail, __ATOMIC_RELEASE);
+
+    for (size_t written = 0; written < len;) {
+        ssize_t n = write(fd, out + written, len - written);
+        if (n < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            printf("Failed to write the log: %s\n", strerror(errno));
+            return -1;
+        }
+        written += (size_t)n;
+    }
+    return records;
+}
+
+// Read the next record into *buf, growing it as needed. Returns 1 for a
+// good record, 0 at a clean end of file and -1 for a torn or damaged one.
+static int read_record(FILE* f, wal_record_t* header, char** buf, size_t* cap) {
+    size_t n = fread(header, 1, sizeof(*header), f);
+    if (n == 0 && feof(f)) {
+        return 0;
+    }
+    if (n != sizeof(*header) || header->size < sizeof(*header) || header->size % 8 ||
+        sizeof(*header) + header->key_len + (size_t)header->value_size > header->size ||
+        header->key_len == 0) {
+        return -1;
+    }
+    size_t body = header->size - sizeof(*header);
+    if (body > *cap) {
+        char* grown = realloc(*buf, body);
+        if (!grown) {
+            return -1;
+        }
+        *buf = grown;
+        *cap = body;
+    }
+    if (fread(*buf, 1, body, f) != body) {
+        return -1;
+    }
+    uint32_t crc = crc32_update(0, (char*)header + WAL_CHECKED,
+                                sizeof(*header) - WAL_CHECKED);
+    return crc32_update(crc, *buf, body) == header->check ? 1 : -1;
+}
+
+long wal_replay(const char* path) {
+    FILE* f = fopen(path, "rb");
+    if (!f) {
+        if (errno == ENOENT) {
+            return 0;
+        }
+        printf("Failed to open log %s: %s\n", path, strerror(errno));
+        return -1;
+    }
+
+    char* buf = NULL;
+    size_t cap = 0;
+    char key[UINT16_MAX + 1];
+    long applied = 0;
+    long good = 0;  // Bytes of intact records
+    uint64_t now = wall_ms();
+    wal_record_t header;
+    int result;
+    while ((result = read_record(f, &header, &buf, &cap)) == 1) {
+        memcpy(key, buf, header.key_len);
+        key[header.key_len] = '\0';
+        if (header.op == WAL_DELETE || (header.expires_at && now >= header.expires_at)) {
+            cache_delete(key);
+        } else {
+            cache_set_ex(key, buf + header.key_len, header.value_size,
+                         header.expires_at ? header.expires_at - now : 0);
+        }
+        applied++;
+        good += header.size;
+    }
+    free(buf);
+    fclose(f);
+
+    if (result < 0) {
+        // A crash mid-write leaves a partial record; anything after it
+        // cannot be trusted, and appending after it would be unreadable
+        printf("Log %s is damaged after %ld bytes, truncating it there\n", path, good);
+        if (truncate(path, good) != 0) {
+            printf("Failed to truncate %s: %s\n", path, strerror(errno));
+        }
+    }
+    printf("Replayed %ld records from %s\n", applied, path);
+    return applied;
+}
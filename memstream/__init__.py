@@ -0,0 +1,20 @@
+"""Shared building blocks for the MemStream Python services."""
+
+from .client import Cache, CacheError, CacheStats, CacheValueRef
+
+__all__ = ['Cache', 'CacheError', 'CacheStats', 'CacheValueRef', 'CacheService', 'ServiceLogger', 'serve']
+
+
+def __getattr__(name):
+    # The logging side needs fluent-logger, which the test scripts that only
+    # use Cache do not install, so it is imported on first use
+    if name == 'ServiceLogger':
+        from .log import ServiceLogger
+        return ServiceLogger
+    if name == 'CacheService':
+        from .service import CacheService
+        return CacheService
+    if name == 'serve':
+        from .server import serve
+        return serve
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
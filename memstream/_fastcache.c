@@ -0,0 +1,445 @@
+// _fastcache.c - CPython fast path for memstream.Cache
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+// The extension does not link against libcache. memstream.Cache hands it
+// the addresses of the functions in the copy of libcache it already loaded
+// through ctypes, so both paths share one cache_connect() and the library
+// can still be chosen at run time. Every call releases the GIL around the
+// cache call itself; keys and values are read straight out of bytes, str
+// and buffer-protocol objects without any ctypes marshalling.
+
+#define CACHE_ERR_TOO_SMALL (-2)
+#define GET_BUFFER_SIZE 1024  // Initial per-thread get buffer
+
+typedef int (*cache_get_fn)(const char*, void*, size_t*);
+typedef int (*cache_set_fn)(const char*, const void*, size_t, uint64_t);
+typedef int (*cache_delete_fn)(const char*);
+typedef int (*cache_mget_fn)(size_t, const char* const*, void* const*, size_t*, int*);
+typedef int (*cache_mset_fn)(size_t, const char* const*, const void* const*,
+                             const size_t*, int*);
+
+typedef struct {
+    PyObject_HEAD
+    cache_get_fn get;
+    cache_set_fn set;
+    cache_delete_fn delete;
+    cache_mget_fn mget;
+    cache_mset_fn mset;
+} ClientObject;
+
+// Per-thread get buffer, grown on demand and freed when the thread exits
+typedef struct {
+    char* data;
+    size_t size;
+} thread_buffer_t;
+
+static pthread_key_t buffer_key;
+
+static void free_thread_buffer(void* p) {
+    thread_buffer_t* buffer = p;
+    free(buffer->data);
+    free(buffer);
+}
+
+static char* get_buffer(size_t size, size_t* capacity) {
+    thread_buffer_t* buffer = pthread_getspecific(buffer_key);
+    if (!buffer) {
+        buffer = calloc(1, sizeof(*buffer));
+        if (!buffer || pthread_setspecific(buffer_key, buffer) != 0) {
+            free(buffer);
+            return NULL;
+        }
+    }
+    if (!buffer->data || buffer->size < size) {
+        size_t grown = buffer->size ? buffer->size * 2 : GET_BUFFER_SIZE;
+        if (grown < size) {
+            grown = size;
+        }
+        char* data = realloc(buffer->data, grown);
+        if (!data) {
+            return NULL;
+        }
+        buffer->data = data;
+        buffer->size = grown;
+    }
+    *capacity = buffer->size;
+    return buffer->data;
+}
+
+// Keys are str (encoded as UTF-8, cached by the str object) or bytes; the
+// pointer stays valid as long as the caller holds a reference to the key
+static const char* key_arg(PyObject* key) {
+    if (PyBytes_Check(key)) {
+        return PyBytes_AS_STRING(key);
+    }
+    if (PyUnicode_Check(key)) {
+        return PyUnicode_AsUTF8(key);
+    }
+    PyErr_Format(PyExc_TypeError, "key must be str or bytes, not %.100s",
+                 Py_TYPE(key)->tp_name);
+    return NULL;
+}
+
+// Values are str (UTF-8) or any bytes-like object. Contiguous buffers are
+// passed without a copy; anything else is copied into bytes once.
+static int value_arg(PyObject* value, Py_buffer* view) {
+    if (PyUnicode_Check(value)) {
+        Py_ssize_t size;
+        const char* data = PyUnicode_AsUTF8AndSize(value, &size);
+        if (!data) {
+            return -1;
+        }
+        return PyBuffer_FillInfo(view, value, (void*)data, size, 1, PyBUF_SIMPLE);
+    }
+    if (PyObject_GetBuffer(value, view, PyBUF_SIMPLE) == 0) {
+        return 0;
+    }
+    PyErr_Clear();
+    PyObject* copy = PyBytes_FromObject(value);
+    if (!copy) {
+        return -1;
+    }
+    int result = PyObject_GetBuffer(copy, view, PyBUF_SIMPLE);
+    Py_DECREF(copy);
+    return result;
+}
+
+static int Client_init(ClientObject* self, PyObject* args, PyObject* kwargs) {
+    static char* kwlist[] = {"get", "set_ex", "delete", "mget", "mset", NULL};
+    PyObject* addresses[5];
+    void* fns[5];
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OOOOO", kwlist, &addresses[0],
+                                     &addresses[1], &addresses[2], &addresses[3],
+                                     &addresses[4])) {
+        return -1;
+    }
+    for (int i = 0; i < 5; i++) {
+        fns[i] = PyLong_AsVoidPtr(addresses[i]);
+        if (!fns[i]) {
+            if (!PyErr_Occurred()) {
+                PyErr_Format(PyExc_ValueError, "%s must not be NULL", kwlist[i]);
+            }
+            return -1;
+        }
+    }
+    self->get = (cache_get_fn)fns[0];
+    self->set = (cache_set_fn)fns[1];
+    self->delete = (cache_delete_fn)fns[2];
+    self->mget = (cache_mget_fn)fns[3];
+    self->mset = (cache_mset_fn)fns[4];
+    return 0;
+}
+
+static PyObject* Client_get(ClientObject* self, PyObject* key) {
+    const char* k = key_arg(key);
+    if (!k) {
+        return NULL;
+    }
+
+    int result = -1;
+    char* buffer = NULL;
+    size_t size = 0;
+    Py_BEGIN_ALLOW_THREADS
+    size_t capacity;
+    buffer = get_buffer(0, &capacity);
+    if (buffer) {
+        size = capacity;
+        result = self->get(k, buffer, &size);
+        if (result == CACHE_ERR_TOO_SMALL) {
+            // size now holds the length needed; retry once
+            buffer = get_buffer(size, &capacity);
+            if (buffer) {
+                size = capacity;
+                result = self->get(k, buffer, &size);
+            }
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    if (!buffer) {
+        return PyErr_NoMemory();
+    }
+    if (result != 0) {
+        Py_RETURN_NONE;
+    }
+    return PyBytes_FromStringAndSize(buffer, (Py_ssize_t)size);
+}
+
+static PyObject* Client_set(ClientObject* self, PyObject* args) {
+    PyObject *key, *value;
+    unsigned long long ttl_ms = 0;
+    if (!PyArg_ParseTuple(args, "OO|K:set", &key, &value, &ttl_ms)) {
+        return NULL;
+    }
+    const char* k = key_arg(key);
+    Py_buffer view;
+    if (!k || value_arg(value, &view) != 0) {
+        return NULL;
+    }
+
+    int result;
+    Py_BEGIN_ALLOW_THREADS
+    result = self->set(k, view.buf, (size_t)view.len, (uint64_t)ttl_ms);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&view);
+    return PyBool_FromLong(result == 0);
+}
+
+static PyObject* Client_delete(ClientObject* self, PyObject* key) {
+    const char* k = key_arg(key);
+    if (!k) {
+        return NULL;
+    }
+
+    int result;
+    Py_BEGIN_ALLOW_THREADS
+    result = self->delete(k);
+    Py_END_ALLOW_THREADS
+    return PyBool_FromLong(result == 0);
+}
+
+// Fetch the values that exist into one buffer for this call, each slot
+// sized to the value. A first cache_mget with empty buffers only reports
+// the lengths (and counts the misses); the second copies the values. A
+// value that grew in between is fetched on its own.
+static int gather(ClientObject* self, Py_ssize_t count, const char** k, void** buffers,
+                  size_t* sizes, int* results, char** gathered, char** big) {
+    for (Py_ssize_t i = 0; i < count; i++) {
+        buffers[i] = NULL;
+        sizes[i] = 0;
+    }
+    self->mget((size_t)count, k, buffers, sizes, results);
+
+    size_t total = 0;
+    Py_ssize_t found = 0;
+    for (Py_ssize_t i = 0; i < count; i++) {
+        if (results[i] == CACHE_ERR_TOO_SMALL) {
+            total += sizes[i];
+            found++;
+        }
+    }
+    if (found == 0) {
+        return 0;
+    }
+
+    Py_ssize_t* index = malloc(found * sizeof(Py_ssize_t));
+    const char** fk = malloc(found * sizeof(char*));
+    void** fbuffers = malloc(found * sizeof(void*));
+    size_t* fsizes = malloc(found * sizeof(size_t));
+    int* fresults = malloc(found * sizeof(int));
+    *gathered = malloc(total);
+    int failed = !index || !fk || !fbuffers || !fsizes || !fresults || !*gathered;
+    if (!failed) {
+        size_t offset = 0;
+        for (Py_ssize_t i = 0, n = 0; i < count; i++) {
+            if (results[i] == CACHE_ERR_TOO_SMALL) {
+                index[n] = i;
+                fk[n] = k[i];
+                fbuffers[n] = *gathered + offset;
+                fsizes[n] = sizes[i];
+                offset += sizes[i];
+                n++;
+            }
+        }
+        self->mget((size_t)found, fk, fbuffers, fsizes, fresults);
+        for (Py_ssize_t n = 0; n < found; n++) {
+            Py_ssize_t i = index[n];
+            buffers[i] = fbuffers[n];
+            sizes[i] = fsizes[n];
+            results[i] = fresults[n];
+            if (results[i] == CACHE_ERR_TOO_SMALL) {
+                if (!(big[i] = malloc(sizes[i]))) {
+                    failed = 1;
+                    break;
+                }
+                buffers[i] = big[i];
+                results[i] = self->get(k[i], big[i], &sizes[i]);
+            }
+        }
+    }
+    free(fresults);
+    free(fsizes);
+    free(fbuffers);
+    free(fk);
+    free(index);
+    return failed ? -1 : 0;
+}
+
+static PyObject* Client_mget(ClientObject* self, PyObject* keys) {
+    PyObject* seq = PySequence_Fast(keys, "keys must be a sequence");
+    if (!seq) {
+        return NULL;
+    }
+    Py_ssize_t count = PySequence_Fast_GET_SIZE(seq);
+    PyObject** items = PySequence_Fast_ITEMS(seq);
+    PyObject* out = NULL;
+    char* gathered = NULL;
+
+    const char** k = malloc(count * sizeof(char*) + 1);
+    void** buffers = malloc(count * sizeof(void*) + 1);
+    size_t* sizes = malloc(count * sizeof(size_t) + 1);
+    int* results = malloc(count * sizeof(int) + 1);
+    char** big = calloc(count + 1, sizeof(char*));
+    if (!k || !buffers || !sizes || !results || !big) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for (Py_ssize_t i = 0; i < count; i++) {
+        if (!(k[i] = key_arg(items[i]))) {
+            goto done;
+        }
+    }
+
+    int failed;
+    Py_BEGIN_ALLOW_THREADS
+    failed = gather(self, count, k, buffers, sizes, results, &gathered, big);
+    Py_END_ALLOW_THREADS
+    if (failed) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    out = PyList_New(count);
+    for (Py_ssize_t i = 0; out && i < count; i++) {
+        PyObject* value;
+        if (results[i] == 0) {
+            value = PyBytes_FromStringAndSize(buffers[i], (Py_ssize_t)sizes[i]);
+            if (!value) {
+                Py_CLEAR(out);
+                break;
+            }
+        } else {
+            Py_INCREF(Py_None);
+            value = Py_None;
+        }
+        PyList_SET_ITEM(out, i, value);
+    }
+
+done:
+    if (big) {
+        for (Py_ssize_t i = 0; i < count; i++) {
+            free(big[i]);
+        }
+    }
+    free(big);
+    free(gathered);
+    free(results);
+    free(sizes);
+    free(buffers);
+    free(k);
+    Py_DECREF(seq);
+    return out;
+}
+
+// Set every item of a mapping with one call; returns the keys that failed
+static PyObject* Client_mset(ClientObject* self, PyObject* mapping) {
+    PyObject* pairs = PyMapping_Items(mapping);
+    if (!pairs) {
+        return NULL;
+    }
+    Py_ssize_t count = PyList_GET_SIZE(pairs);
+    PyObject* out = NULL;
+    Py_ssize_t held = 0;  // Views acquired so far
+
+    const char** k = malloc(count * sizeof(char*) + 1);
+    const void** values = malloc(count * sizeof(void*) + 1);
+    size_t* sizes = malloc(count * sizeof(size_t) + 1);
+    int* results = malloc(count * sizeof(int) + 1);
+    Py_buffer* views = malloc(count * sizeof(Py_buffer) + 1);
+    if (!k || !values || !sizes || !results || !views) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for (; held < count; held++) {
+        PyObject* pair = PyList_GET_ITEM(pairs, held);
+        if (!(k[held] = key_arg(PyTuple_GET_ITEM(pair, 0))) ||
+            value_arg(PyTuple_GET_ITEM(pair, 1), &views[held]) != 0) {
+            goto done;
+        }
+        values[held] = views[held].buf;
+        sizes[held] = (size_t)views[held].len;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    self->mset((size_t)count, k, values, sizes, results);
+    Py_END_ALLOW_THREADS
+
+    out = PyList_New(0);
+    for (Py_ssize_t i = 0; out && i < count; i++) {
+        if (results[i] != 0 &&
+            PyList_Append(out, PyTuple_GET_ITEM(PyList_GET_ITEM(pairs, i), 0)) != 0) {
+            Py_CLEAR(out);
+        }
+    }
+
+done:
+    for (Py_ssize_t i = 0; i < held; i++) {
+        PyBuffer_Release(&views[i]);
+    }
+    free(views);
+    free(results);
+    free(sizes);
+    free(values);
+    free(k);
+    Py_DECREF(pairs);
+    return out;
+}
+
+static PyMethodDef Client_methods[] = {
+    {"get", (PyCFunction)Client_get, METH_O,
+     "get(key) -> bytes or None\n\nCopy a value out of the cache."},
+    {"set", (PyCFunction)Client_set, METH_VARARGS,
+     "set(key, value, ttl_ms=0) -> bool\n\nStore a str or bytes-like value, "
+     "expiring after ttl_ms milliseconds unless it is 0."},
+    {"delete", (PyCFunction)Client_delete, METH_O,
+     "delete(key) -> bool"},
+    {"mget", (PyCFunction)Client_mget, METH_O,
+     "mget(keys) -> list\n\nGet many values with one call; None for every missing key."},
+    {"mset", (PyCFunction)Client_mset, METH_O,
+     "mset(items) -> list\n\nSet every item of a mapping with one call; returns the keys that failed."},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject ClientType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "memstream._fastcache.Client",
+    .tp_doc = "Client(get, set_ex, delete, mget, mset)\n\n"
+              "Cache calls through the given libcache function addresses.",
+    .tp_basicsize = sizeof(ClientObject),
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = PyType_GenericNew,
+    .tp_init = (initproc)Client_init,
+    .tp_methods = Client_methods,
+};
+
+static struct PyModuleDef fastcache_module = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "memstream._fastcache",
+    .m_doc = "Compiled fast path for memstream.Cache",
+    .m_size = -1,
+};
+
+PyMODINIT_FUNC PyInit__fastcache(void) {
+    if (pthread_key_create(&buffer_key, free_thread_buffer) != 0) {
+        return PyErr_NoMemory();
+    }
+    if (PyType_Ready(&ClientType) < 0) {
+        return NULL;
+    }
+    PyObject* module = PyModule_Create(&fastcache_module);
+    if (!module) {
+        return NULL;
+    }
+    Py_INCREF(&ClientType);
+    if (PyModule_AddObject(module, "Client", (PyObject*)&ClientType) < 0) {
+        Py_DECREF(&ClientType);
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
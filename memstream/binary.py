@@ -0,0 +1,389 @@
+"""Length-prefixed binary protocol for the reader and writer services.
+
+Every request is a header followed by its arguments, each prefixed with
+its length; values travel as raw bytes, with no JSON or UTF-8 step:
+
+    request:  payload length u32 | command u8 | argument count u16 | payload
+    response: payload length u32 | status u8  | item count u16     | payload
+    payload:  (length u32 | bytes) per argument; response items use a
+              signed length and -1 for a missing value
+
+All integers are big-endian. A connection can send any number of requests
+without waiting for answers; they are run in order and the responses come
+back in the same order, so a pipelined batch costs one round trip.
+"""
+import asyncio
+import os
+import socket
+import struct
+import threading
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+HEADER = struct.Struct('!IBH')
+MAX_ITEMS = 0xFFFF  # The item count is a u16: at most 65535 keys, 32767 MSET pairs
+LENGTH = struct.Struct('!I')
+ITEM_LENGTH = struct.Struct('!i')
+TTL = struct.Struct('!Q')
+MAX_PAYLOAD = int(os.getenv('MEMSTREAM_MAX_FRAME', str(256 * 1024 * 1024)))
+
+# Commands
+PING = 0
+GET = 1
+MGET = 2
+EXISTS = 3
+SET = 4       # key, value[, ttl_ms as u64]
+DELETE = 5
+MSET = 6      # key, value, key, value, ...; answers with the keys that failed
+MDELETE = 7   # Answers with the keys that were not there
+
+# Statuses
+OK = 0
+MISSING = 1   # GET of an absent key, DELETE of one that was not there
+ERROR = 2     # The single item is the error message
+
+Items = List[Optional[bytes]]
+Address = Union[str, Tuple[str, int]]
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(code: int, items: Sequence[Optional[bytes]]) -> bytes:
+    """Build a request (code is the command) or a response (code is the status)"""
+    if len(items) > MAX_ITEMS:
+        raise ProtocolError(f"{len(items)} items do not fit in one frame, the limit is {MAX_ITEMS}")
+    parts = [b'']
+    size = 0
+    for item in items:
+        if item is None:
+            parts.append(ITEM_LENGTH.pack(-1))
+            size += ITEM_LENGTH.size
+        else:
+            parts.append(LENGTH.pack(len(item)))
+            parts.append(item)
+            size += LENGTH.size + len(item)
+    parts[0] = HEADER.pack(size, code, len(items))
+    return b''.join(parts)
+
+
+def decode_frames(buffer: bytearray, signed: bool = False) -> Tuple[List[Tuple[int, Items]], int]:
+    """Parse the complete frames at the start of buffer.
+
+    Returns them as (code, items) with the number of bytes they used; a
+    partial frame at the end is left for the next call.
+    """
+    frames = []
+    view = memoryview(buffer)
+    offset = 0
+    try:
+        while len(buffer) - offset >= HEADER.size:
+            size, code, count = HEADER.unpack_from(view, offset)
+            if size > MAX_PAYLOAD:
+                raise ProtocolError(f"frame of {size} bytes is over the limit")
+            end = offset + HEADER.size + size
+            if len(buffer) < end:
+                break
+            items: Items = []
+            position = offset + HEADER.size
+            for _ in range(count):
+                if position + LENGTH.size > end:
+                    raise ProtocolError("frame is shorter than its items")
+                length = (ITEM_LENGTH if signed else LENGTH).unpack_from(view, position)[0]
+                position += LENGTH.size
+                if length < 0:
+                    items.append(None)
+                    continue
+                if position + length > end:
+                    raise ProtocolError("frame is shorter than its items")
+                items.append(bytes(view[position:position + length]))
+                position += length
+            if position != end:
+                raise ProtocolError("frame is longer than its items")
+            frames.append((code, items))
+            offset = end
+    finally:
+        view.release()
+    return frames, offset
+
+
+# Command handlers take the service and the request's arguments and return
+# (status, items). Keys are passed on as bytes, which Cache accepts as-is.
+
+def single_key(args: Items, command: str) -> bytes:
+    if len(args) != 1:
+        raise ValueError(f"{command} takes one key")
+    return args[0]
+
+
+def ping(service, args: Items):
+    return OK, []
+
+
+def get(service, args: Items):
+    value = service.get(single_key(args, 'GET'))
+    return (OK, [value]) if value is not None else (MISSING, [])
+
+
+def mget(service, args: Items):
+    values = service.mget(args)
+    return OK, [values[key] for key in args]
+
+
+def exists(service, args: Items):
+    return (OK, []) if service.get(single_key(args, 'EXISTS')) is not None else (MISSING, [])
+
+
+def set_value(service, args: Items):
+    if len(args) not in (2, 3) or not args[1]:
+        raise ValueError("SET takes a key, a non-empty value and an optional ttl_ms")
+    ttl_ms = TTL.unpack(args[2])[0] if len(args) == 3 else 0
+    if service.set(args[0], args[1], ttl_ms):
+        return OK, []
+    raise RuntimeError("Failed to set value")
+
+
+def delete(service, args: Items):
+    return (OK, []) if service.delete(single_key(args, 'DELETE')) else (MISSING, [])
+
+
+def mset(service, args: Items):
+    if len(args) % 2 or not all(args[1::2]):
+        raise ValueError("MSET takes pairs of keys and non-empty values")
+    return OK, service.mset(dict(zip(args[0::2], args[1::2])))
+
+
+def mdelete(service, args: Items):
+    missing = service.mdelete(args)
+    return OK, missing
+
+
+READ_COMMANDS: Dict[int, Callable] = {PING: ping, GET: get, MGET: mget, EXISTS: exists}
+WRITE_COMMANDS: Dict[int, Callable] = {PING: ping, SET: set_value, DELETE: delete,
+                                       MSET: mset, MDELETE: mdelete}
+
+
+class BinaryProtocol(asyncio.Protocol):
+    """One connection: parse whatever frames have arrived, run them as a
+    batch and write all their responses back in one go"""
+
+    def __init__(self, server: 'BinaryServer'):
+        self.server = server
+        self.buffer = bytearray()
+        self.transport = None
+        self.busy = False           # A batch is running on the executor
+        self.write_paused = False   # The peer is not reading its responses
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+
+    def data_received(self, data):
+        self.buffer += data
+        if not self.busy:
+            self.process()
+
+    def pause_writing(self):
+        self.write_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.write_paused = False
+        if not self.busy:
+            self.transport.resume_reading()
+
+    def process(self):
+        try:
+            frames, used = decode_frames(self.buffer)
+        except ProtocolError as e:
+            self.transport.write(encode_frame(ERROR, [str(e).encode()]))
+            self.transport.close()
+            return
+        del self.buffer[:used]
+        if not frames:
+            return
+        if self.server.executor is None:
+            self.transport.write(self.server.execute(frames))
+            return
+
+        self.busy = True
+        self.transport.pause_reading()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.server.executor, self.server.execute, frames)
+        future.add_done_callback(self.batch_done)
+
+    def batch_done(self, future):
+        self.busy = False
+        if self.transport.is_closing():
+            return
+        self.transport.write(future.result())
+        if not self.write_paused:
+            self.transport.resume_reading()
+        self.process()
+
+
+class BinaryServer:
+    """Serves the binary protocol on listening sockets with one service.
+
+    commands maps command codes to handlers (READ_COMMANDS for the reader,
+    WRITE_COMMANDS for the writer). Batches run on the event loop, or on
+    executor when one is given.
+    """
+
+    def __init__(self, service, commands: Mapping[int, Callable], executor=None):
+        self.service = service
+        self.commands = commands
+        self.executor = executor
+        self.connections = set()
+        self.servers = []
+        self.loop = None
+        self.thread = None
+
+    def execute(self, frames: List[Tuple[int, Items]]) -> bytes:
+        responses = []
+        for command, args in frames:
+            handler = self.commands.get(command)
+            if handler is None:
+                responses.append(encode_frame(ERROR, [f"Unsupported command {command}".encode()]))
+                continue
+            try:
+                status, items = handler(self.service, args)
+            except Exception as e:
+                status, items = ERROR, [str(e).encode()]
+            responses.append(encode_frame(status, items))
+        return b''.join(responses)
+
+    async def start(self, sockets: Sequence[socket.socket]):
+        loop = asyncio.get_running_loop()
+        for sock in sockets:
+            self.servers.append(await loop.create_server(lambda: BinaryProtocol(self), sock=sock))
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+        for connection in list(self.connections):
+            connection.transport.close()
+        self.servers = []
+
+    def start_thread(self, sockets: Sequence[socket.socket]):
+        """Serve from a thread with its own event loop, for threaded hosts"""
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.start(sockets))
+            started.set()
+            self.loop.run_forever()
+            self.close()
+            self.loop.run_until_complete(asyncio.sleep(0))  # Let the transports close
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, name='binary-protocol', daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop_thread(self, timeout: float = 5.0):
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=timeout)
+            self.thread = None
+
+
+def listen_tcp(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    return sock
+
+
+def listen_unix(path: str) -> socket.socket:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, 0o666)
+    sock.listen(1024)
+    return sock
+
+
+class BinaryClient:
+    """Blocking client for the binary protocol; not safe to share between threads.
+
+    address is (host, port) for TCP or a path for the Unix socket.
+    """
+
+    def __init__(self, address: Address, timeout: Optional[float] = 5.0):
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.buffer = bytearray()
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def pipeline(self, requests: Sequence[Tuple[int, Sequence[bytes]]]) -> List[Tuple[int, Items]]:
+        """Send every (command, args) request at once and return their
+        (status, items) responses in order"""
+        self.sock.sendall(b''.join(encode_frame(command, args) for command, args in requests))
+        responses: List[Tuple[int, Items]] = []
+        while len(responses) < len(requests):
+            frames, used = decode_frames(self.buffer, signed=True)
+            del self.buffer[:used]
+            responses.extend(frames)
+            if len(responses) < len(requests):
+                data = self.sock.recv(1 << 16)
+                if not data:
+                    raise ConnectionError("Connection closed by the server")
+                self.buffer += data
+        return responses
+
+    def call(self, command: int, *args: bytes) -> Tuple[int, Items]:
+        status, items = self.pipeline([(command, args)])[0]
+        if status == ERROR:
+            raise ProtocolError(items[0].decode('utf-8', errors='replace') if items else "error")
+        return status, items
+
+    def ping(self) -> bool:
+        return self.call(PING)[0] == OK
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        status, items = self.call(GET, key)
+        return items[0] if status == OK else None
+
+    def mget(self, keys: Sequence[bytes]) -> List[Optional[bytes]]:
+        return self.call(MGET, *keys)[1]
+
+    def exists(self, key: bytes) -> bool:
+        return self.call(EXISTS, key)[0] == OK
+
+    def set(self, key: bytes, value: bytes, ttl_ms: int = 0) -> bool:
+        args = (key, value, TTL.pack(ttl_ms)) if ttl_ms else (key, value)
+        return self.call(SET, *args)[0] == OK
+
+    def delete(self, key: bytes) -> bool:
+        return self.call(DELETE, key)[0] == OK
+
+    def mset(self, items: Mapping[bytes, bytes]) -> List[bytes]:
+        """Returns the keys that could not be set"""
+        args = [part for pair in items.items() for part in pair]
+        return self.call(MSET, *args)[1]
+
+    def mdelete(self, keys: Sequence[bytes]) -> List[bytes]:
+        """Returns the keys that were not there"""
+        return self.call(MDELETE, *keys)[1]
@@ -0,0 +1,328 @@
+import ctypes
+import os
+import threading
+import weakref
+from ctypes import CDLL, POINTER, c_char_p, c_int, c_size_t, c_uint64, c_void_p
+from dataclasses import dataclass
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+try:
+    from . import _fastcache
+except ImportError:  # Not built; every call goes through ctypes
+    _fastcache = None
+
+CACHE_ERR_TOO_SMALL = -2  # cache_get: buffer too small, size holds the length needed
+GET_BUFFER_SIZE = 1024  # Initial per-thread get buffer, grown on demand
+# MEMSTREAM_LIB, else the images' copy, else the one make builds beside the package
+DEFAULT_LIBRARY = os.getenv('MEMSTREAM_LIB') or next(
+    (path for path in ('/app/libcache.so',
+                       os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                    'libcache.so'))
+     if os.path.exists(path)), '/app/libcache.so')
+USE_NATIVE = os.getenv('MEMSTREAM_NATIVE', '1') != '0'
+
+Key = Union[str, bytes]
+Value = Union[bytes, bytearray, memoryview, str]
+
+
+class CacheError(RuntimeError):
+    pass
+
+
+class CacheStats_C(ctypes.Structure):
+    _fields_ = [
+        ("total_size", c_size_t),
+        ("used_size", c_size_t),
+        ("total_entries", c_size_t),
+        ("hits", c_size_t),
+        ("misses", c_size_t),
+        ("evictions", c_size_t),
+        ("rejections", c_size_t),
+        ("expired", c_size_t),
+        ("reaped", c_size_t)
+    ]
+
+
+@dataclass
+class CacheStats:
+    total_size: int
+    used_size: int
+    total_entries: int
+    hits: int
+    misses: int
+    evictions: int
+    rejections: int
+    expired: int
+    reaped: int
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+
+# restype and argtypes of every libcache function used from Python
+SIGNATURES = {
+    'cache_init': (c_int, [c_size_t]),
+    'cache_connect': (c_int, []),
+    'cache_connect_name': (c_int, [c_char_p]),
+    'cache_destroy': (None, []),
+    'cache_set': (c_int, [c_char_p, c_void_p, c_size_t]),
+    'cache_set_ex': (c_int, [c_char_p, c_void_p, c_size_t, c_uint64]),
+    'cache_get': (c_int, [c_char_p, c_void_p, POINTER(c_size_t)]),
+    'cache_delete': (c_int, [c_char_p]),
+    'cache_mget': (c_int, [c_size_t, POINTER(c_char_p), POINTER(c_void_p),
+                           POINTER(c_size_t), POINTER(c_int)]),
+    'cache_mset': (c_int, [c_size_t, POINTER(c_char_p), POINTER(c_char_p),
+                           POINTER(c_size_t), POINTER(c_int)]),
+    'cache_mdel': (c_int, [c_size_t, POINTER(c_char_p), POINTER(c_int)]),
+    'cache_get_ref': (c_int, [c_char_p, POINTER(c_void_p), POINTER(c_size_t)]),
+    'cache_release_ref': (None, [c_void_p]),
+    'cache_get_stats': (c_int, [POINTER(CacheStats_C)]),
+}
+
+# Passed to _fastcache.Client in this order
+NATIVE_FUNCTIONS = ('cache_get', 'cache_set_ex', 'cache_delete', 'cache_mget', 'cache_mset')
+
+_libraries: Dict[str, CDLL] = {}
+_libraries_lock = threading.Lock()
+
+
+def load_library(path: str = DEFAULT_LIBRARY) -> CDLL:
+    """Load libcache once per path, with every signature already declared"""
+    with _libraries_lock:
+        lib = _libraries.get(path)
+        if lib is None:
+            lib = CDLL(path)
+            for name, (restype, argtypes) in SIGNATURES.items():
+                function = getattr(lib, name)
+                function.restype = restype
+                function.argtypes = argtypes
+            _libraries[path] = lib
+        return lib
+
+
+def native_client(lib: CDLL):
+    """Compiled fast path bound to lib's functions, None if it is not built"""
+    if _fastcache is None:
+        return None
+    return _fastcache.Client(*[ctypes.cast(getattr(lib, name), c_void_p).value
+                               for name in NATIVE_FUNCTIONS])
+
+
+def encode_key(key: Key) -> bytes:
+    return key if isinstance(key, bytes) else key.encode('utf-8')
+
+
+def value_arg(value: Value) -> Tuple[object, int]:
+    """Return something cache_set accepts as a pointer, and its length.
+
+    bytes and writable buffers are passed without copying; str is encoded
+    as UTF-8 and read-only buffers other than bytes are copied once.
+    """
+    if isinstance(value, bytes):
+        return value, len(value)
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+        return value, len(value)
+    view = memoryview(value)
+    if view.readonly or not view.c_contiguous:
+        data = view.tobytes()
+        return data, len(data)
+    return (ctypes.c_char * view.nbytes).from_buffer(view), view.nbytes
+
+
+class CacheValueRef:
+    """Read-only memoryview of a value pinned in shared memory.
+
+    The cache keeps the bytes alive and unchanged until release() is called,
+    after which the view must not be used. Without release(), the value
+    stays pinned until the view, and every view taken from it, has been
+    garbage collected, even if the ref itself was dropped before.
+    """
+
+    def __init__(self, lib, address: int, size: int):
+        buffer = (ctypes.c_char * size).from_address(address)
+        self.view = memoryview(buffer).cast('B').toreadonly()
+        # The pin follows the array the views export, not this wrapper
+        self._release = weakref.finalize(buffer, lib.cache_release_ref, c_void_p(address))
+
+    def release(self):
+        """Unpin the value; calling it again does nothing"""
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        self._release()
+
+    def __enter__(self):
+        return self.view
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class Cache:
+    """Handle on the shared cache, safe to share between threads.
+
+    libcache does its own locking, so the only per-thread state is the get
+    buffer, which is allocated once and grown when a value does not fit.
+    Keys may be str or bytes; values go in as bytes-like objects (or str,
+    encoded as UTF-8) and always come back as bytes.
+
+    get, set, delete, mget and mset go through the compiled _fastcache
+    module when it is built (make pyext) and MEMSTREAM_NATIVE is not 0; it
+    skips ctypes marshalling and releases the GIL around each call. native
+    forces either path, and True fails if the module is missing.
+
+    name selects the cache instance to attach to (MEMSTREAM_NAME, else
+    "default"). libcache attaches a process to one instance, so every Cache
+    in a process must use the same name.
+    """
+
+    def __init__(self, library: str = DEFAULT_LIBRARY, connect: bool = True,
+                 native: Optional[bool] = None, name: Optional[str] = None):
+        self.lib = load_library(library)
+        self.local = threading.local()
+        self.native = native_client(self.lib) if native or \
+            (native is None and USE_NATIVE) else None
+        if native and self.native is None:
+            raise CacheError("memstream._fastcache is not built (run make pyext)")
+        if connect and self.lib.cache_connect_name(name.encode('utf-8') if name else None) != 0:
+            name = name or os.getenv('MEMSTREAM_NAME') or 'default'
+            raise CacheError(f"Failed to connect to cache '{name}'. Is cache manager running?")
+
+    def init(self, max_memory: int) -> bool:
+        """Create the cache instead of connecting to one (cache manager only)"""
+        return self.lib.cache_init(max_memory) == 0
+
+    def destroy(self):
+        self.lib.cache_destroy()
+
+    def get_buffer(self, size: int = 0):
+        """Return this thread's get buffer, growing it to at least size bytes"""
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None or len(buffer) < size:
+            current = len(buffer) if buffer is not None else GET_BUFFER_SIZE // 2
+            buffer = ctypes.create_string_buffer(max(size, current * 2))
+            self.local.buffer = buffer
+        return buffer
+
+    def get(self, key: Key) -> Optional[bytes]:
+        """Copy a value out of the cache, None when the key is missing"""
+        if self.native:
+            return self.native.get(key)
+        key = encode_key(key)
+        buffer = self.get_buffer()
+        size = c_size_t(len(buffer))
+        result = self.lib.cache_get(key, buffer, ctypes.byref(size))
+        if result == CACHE_ERR_TOO_SMALL:
+            # size now holds the length needed; retry once
+            buffer = self.get_buffer(size.value)
+            size.value = len(buffer)
+            result = self.lib.cache_get(key, buffer, ctypes.byref(size))
+        if result != 0:
+            return None
+        return ctypes.string_at(buffer, size.value)
+
+    def get_ref(self, key: Key) -> Optional[CacheValueRef]:
+        """Pin a value in shared memory instead of copying it out"""
+        address = c_void_p()
+        size = c_size_t()
+        if self.lib.cache_get_ref(encode_key(key), ctypes.byref(address),
+                                  ctypes.byref(size)) != 0:
+            return None
+        return CacheValueRef(self.lib, address.value, size.value)
+
+    def set(self, key: Key, value: Value, ttl_ms: int = 0) -> bool:
+        """Store a value, expiring after ttl_ms milliseconds unless it is 0"""
+        if self.native:
+            return self.native.set(key, value, ttl_ms)
+        data, size = value_arg(value)
+        return self.lib.cache_set_ex(encode_key(key), data, size, ttl_ms) == 0
+
+    def delete(self, key: Key) -> bool:
+        if self.native:
+            return self.native.delete(key)
+        return self.lib.cache_delete(encode_key(key)) == 0
+
+    def mget(self, keys: Sequence[Key]) -> List[Optional[bytes]]:
+        """Get many values with one call; None for every missing key"""
+        if self.native:
+            return self.native.mget(keys)
+        count = len(keys)
+        if count == 0:
+            return []
+        key_array = (c_char_p * count)(*[encode_key(key) for key in keys])
+        # Empty buffers first, so cache_mget only reports each value's
+        # length (and counts the misses)
+        sizes = (c_size_t * count)()
+        results = (c_int * count)()
+        self.lib.cache_mget(count, key_array, (c_void_p * count)(), sizes, results)
+        values: List[Optional[bytes]] = [b'' if results[i] == 0 else None for i in range(count)]
+
+        found = [i for i in range(count) if results[i] == CACHE_ERR_TOO_SMALL]
+        if not found:
+            return values
+        # Then copy them into one buffer for this call, a slot per value
+        gathered = ctypes.create_string_buffer(sum(sizes[i] for i in found))
+        offsets = []
+        offset = ctypes.addressof(gathered)
+        for i in found:
+            offsets.append(offset)
+            offset += sizes[i]
+        found_sizes = (c_size_t * len(found))(*[sizes[i] for i in found])
+        found_results = (c_int * len(found))()
+        self.lib.cache_mget(len(found), (c_char_p * len(found))(*[key_array[i] for i in found]),
+                            (c_void_p * len(found))(*offsets), found_sizes, found_results)
+        for n, i in enumerate(found):
+            if found_results[n] == 0:
+                values[i] = ctypes.string_at(offsets[n], found_sizes[n])
+            elif found_results[n] == CACHE_ERR_TOO_SMALL:
+                values[i] = self.get(keys[i])  # Grew since its length was read
+        return values
+
+    def mset(self, items: Mapping[Key, Value]) -> List[Key]:
+        """Set many values with one call; returns the keys that failed"""
+        if self.native:
+            return self.native.mset(items)
+        keys = list(items)
+        count = len(keys)
+        if count == 0:
+            return []
+        values = [value_arg(items[key]) for key in keys]
+        results = (c_int * count)()
+        self.lib.cache_mset(
+            count,
+            (c_char_p * count)(*[encode_key(key) for key in keys]),
+            (c_char_p * count)(*[ctypes.cast(data, c_char_p) if not isinstance(data, bytes)
+                                 else data for data, _ in values]),
+            (c_size_t * count)(*[size for _, size in values]),
+            results
+        )
+        return [key for i, key in enumerate(keys) if results[i] != 0]
+
+    def mdel(self, keys: Sequence[Key]) -> List[Key]:
+        """Delete many keys with one call; returns the keys not deleted"""
+        count = len(keys)
+        if count == 0:
+            return []
+        results = (c_int * count)()
+        self.lib.cache_mdel(count, (c_char_p * count)(*[encode_key(key) for key in keys]),
+                            results)
+        return [key for i, key in enumerate(keys) if results[i] != 0]
+
+    def stats(self) -> Optional[CacheStats]:
+        stats = CacheStats_C()
+        if self.lib.cache_get_stats(ctypes.byref(stats)) != 0:
+            return None
+        return CacheStats(
+            total_size=stats.total_size,
+            used_size=stats.used_size,
+            total_entries=stats.total_entries,
+            hits=stats.hits,
+            misses=stats.misses,
+            evictions=stats.evictions,
+            rejections=stats.rejections,
+            expired=stats.expired,
+            reaped=stats.reaped
+        )
@@ -0,0 +1,211 @@
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from fluent import sender
+
+
+class BatchSender(sender.FluentSender):
+    """FluentSender that can write several records in one go.
+
+    fluent-logger has no public call for that, so this is the only place
+    that touches its internals; the images pin the version it was written
+    against (0.11.1).
+    """
+
+    def pack(self, label: str, timestamp: float, record: dict) -> bytes:
+        return self._make_packet(label, timestamp, record)
+
+    def send_packed(self, data: bytes) -> Optional[Exception]:
+        """Write packed records; returns the error if fluentd did not take them"""
+        if self._send(data):
+            return None
+        error = self.last_error
+        self.clear_last_error()
+        return error
+
+
+class ServiceLogger:
+    """Structured fluentd logging that never blocks the request thread.
+
+    Records are put on a bounded queue as raw tuples and only turned into
+    the usual LOG / HEARTBEAT / REGISTRATION dicts by a background flusher,
+    which packs up to batch_size of them into a single socket write. When
+    the queue is full new records are dropped and counted, and per-operation
+    INFO logs (sampled=True) are only kept at info_sample_rate.
+    """
+
+    def __init__(self, node_id: str, service_name: str,
+                 host: Optional[str] = None, port: Optional[int] = None,
+                 queue_size: int = 10000, batch_size: int = 200,
+                 flush_interval: float = 0.5,
+                 info_sample_rate: Optional[float] = None):
+        host = host or os.getenv('FLUENT_HOST', 'localhost')
+        port = port or int(os.getenv('FLUENT_PORT', '24224'))
+        if info_sample_rate is None:
+            info_sample_rate = float(os.getenv('LOG_INFO_SAMPLE_RATE', '0.01'))
+        print(f"Connecting to fluentd at {host}:{port}")
+
+        self.sender = BatchSender(
+            'cache',
+            host=host,
+            port=port,
+            nanosecond_precision=True
+        )
+        self.node_id = node_id
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.info_sample_rate = info_sample_rate
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.counts_lock = threading.Lock()  # Request threads count drops and sampling
+        self.dropped = 0        # Records lost because the queue was full
+        self.reported_drops = 0
+        self.sampled_out = 0    # INFO records skipped by sampling
+        self.sent = 0
+        self.failed = 0         # Records fluentd did not accept
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def enqueue(self, label: str, kind: str, message, fields) -> bool:
+        try:
+            self.queue.put_nowait((label, kind, time.time(), message, fields))
+            return True
+        except queue.Full:
+            with self.counts_lock:
+                self.dropped += 1
+            return False
+
+    def info(self, message: str, sampled: bool = False, **kwargs) -> bool:
+        """Queue an INFO log; sampled per-operation logs may be skipped"""
+        if sampled and random.random() >= self.info_sample_rate:
+            with self.counts_lock:
+                self.sampled_out += 1
+            return False
+        return self.enqueue('log.info', 'INFO', message, kwargs)
+
+    def warn(self, message: str, response_time_ms, threshold_limit_ms) -> bool:
+        """Queue a WARN log"""
+        return self.enqueue('log.warn', 'WARN', message, {
+            "response_time_ms": response_time_ms,
+            "threshold_limit_ms": threshold_limit_ms
+        })
+
+    def error(self, message: str, error_code: str, error_message: str) -> bool:
+        """Queue an ERROR log"""
+        return self.enqueue('log.error', 'ERROR', message, {
+            "error_details": {
+                "error_code": error_code,
+                "error_message": error_message
+            }
+        })
+
+    def registration(self, status: str) -> bool:
+        return self.enqueue('registration', 'REGISTRATION', None, {"status": status})
+
+    def heartbeat(self, status: str) -> bool:
+        return self.enqueue('heartbeat', 'HEARTBEAT', None, {"status": status})
+
+    def build_record(self, kind: str, timestamp: float, message, fields) -> dict:
+        stamp = datetime.fromtimestamp(timestamp).isoformat()
+        if kind == 'REGISTRATION':
+            record = {
+                "message_type": "REGISTRATION",
+                "node_id": self.node_id,
+                "service_name": self.service_name,
+            }
+        elif kind == 'HEARTBEAT':
+            record = {
+                "node_id": self.node_id,
+                "message_type": "HEARTBEAT",
+            }
+        else:
+            record = {
+                "log_id": str(uuid.uuid4()),
+                "node_id": self.node_id,
+                "log_level": kind,
+                "message_type": "LOG",
+                "message": message,
+                "service_name": self.service_name,
+            }
+        record.update(fields)
+        record["timestamp"] = stamp
+        return record
+
+    def drain(self, block: bool) -> list:
+        batch = []
+        try:
+            if block:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def send(self, batch: list):
+        if self.dropped != self.reported_drops:
+            dropped = self.dropped
+            batch.append(('log.warn', 'WARN', time.time(),
+                          f"Dropped {dropped - self.reported_drops} log records, queue full", {
+                              "response_time_ms": "0",
+                              "threshold_limit_ms": "0",
+                              "dropped_total": dropped
+                          }))
+            self.reported_drops = dropped
+
+        # fluentd's forward input accepts back-to-back messages, so the
+        # whole batch goes out in one write
+        packets = []
+        for label, kind, timestamp, message, fields in batch:
+            try:
+                record = self.build_record(kind, timestamp, message, fields)
+                packets.append(self.sender.pack(label, timestamp, record))
+            except Exception as e:
+                self.failed += 1
+                print(f"Error building {label} log: {str(e)}")
+        if not packets:
+            return
+        error = self.sender.send_packed(b''.join(packets))
+        if error is None:
+            self.sent += len(packets)
+        else:
+            self.failed += len(packets)
+            print(f"Failed to send {len(packets)} log records: {error}")
+
+    def flush_loop(self):
+        while not self.closed.is_set():
+            batch = self.drain(block=True)
+            if batch:
+                self.send(batch)
+
+    def flush(self):
+        """Send everything queued so far from the calling thread"""
+        while True:
+            batch = self.drain(block=False)
+            if not batch:
+                break
+            self.send(batch)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "sent": self.sent,
+            "failed": self.failed
+        }
+
+    def close(self, timeout: float = 5.0):
+        """Stop the flusher, send what is left and close the connection"""
+        self.closed.set()
+        self.flusher.join(timeout=timeout)
+        self.flush()
+        self.sender.close()
@@ -0,0 +1,103 @@
+import os
+from typing import Mapping, Optional, Type
+
+from gunicorn.app.base import BaseApplication
+
+from .binary import BinaryServer, listen_tcp, listen_unix
+from .log import ServiceLogger
+from .service import CacheService, Presence
+
+WORKERS = int(os.getenv('MEMSTREAM_WORKERS', '0')) or os.cpu_count() or 1
+THREADS = int(os.getenv('MEMSTREAM_THREADS', '4'))  # Request threads per worker
+KEEPALIVE_TIMEOUT = int(os.getenv('MEMSTREAM_KEEPALIVE', '5'))  # Seconds an idle connection stays open
+GRACEFUL_TIMEOUT = 8  # Seconds workers get on SIGTERM, inside compose's stop_grace_period
+
+
+class ServiceApplication(BaseApplication):
+    """Runs a service's Flask app in gunicorn's pre-fork worker model.
+
+    The master binds the socket, forks the workers, replaces any that die
+    and passes SIGTERM on to them for a graceful stop. It also announces
+    the node: registration, heartbeats and the DOWN messages are sent once
+    from the master, not once per worker. Each worker builds its own
+    service, without announcing it, once it has been forked: libcache
+    attaches once per process, and the logger's thread would not survive
+    the fork. Workers use gunicorn's threaded worker, which keeps HTTP/1.1
+    connections open between requests.
+
+    With binary commands, the master also listens for the binary protocol
+    and every worker accepts from those sockets on a thread of its own.
+    """
+
+    def __init__(self, app, service_class: Type[CacheService], options: dict,
+                 commands: Optional[Mapping] = None, binary_sockets=(), binary_path=None):
+        self.app = app
+        self.service_class = service_class
+        self.options = options
+        self.commands = commands
+        self.binary_sockets = binary_sockets
+        self.binary_path = binary_path
+        self.binary = None
+        self.presence = None
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set('when_ready', self.announce)
+        self.cfg.set('post_worker_init', self.attach)
+        self.cfg.set('worker_exit', self.detach)
+        self.cfg.set('on_exit', self.shutdown)
+
+    def load(self):
+        return self.app
+
+    def announce(self, server):
+        service = self.service_class
+        logger = ServiceLogger(service.node_id, service.service_name)
+        self.presence = Presence(logger, service.heartbeat_interval)
+
+    def attach(self, worker):
+        self.app.config['cache'] = self.service_class(announce=False)
+        if self.binary_sockets:
+            self.binary = BinaryServer(self.app.config['cache'], self.commands)
+            self.binary.start_thread(self.binary_sockets)
+        worker.log.info("Worker %s attached to the cache", worker.pid)
+
+    def detach(self, server, worker):
+        if self.binary is not None:
+            self.binary.stop_thread()
+        if 'cache' in self.app.config:
+            self.app.config['cache'].cleanup()
+
+    def shutdown(self, server):
+        if self.presence is not None:
+            self.presence.stop()
+            self.presence.logger.close()
+        if self.binary_path and os.path.exists(self.binary_path):
+            os.unlink(self.binary_path)
+
+
+def serve(app, service_class: Type[CacheService], port: int, host: str = '0.0.0.0',
+          workers: int = WORKERS, threads: int = THREADS, commands: Optional[Mapping] = None,
+          binary_port: int = 0, binary_path: Optional[str] = None):
+    """Serve app on port until SIGTERM or SIGINT, from a pool of worker
+    processes that each build a service_class.
+
+    commands, if given, are also served over the binary protocol on
+    binary_port and/or the Unix socket at binary_path.
+    """
+    binary_sockets = []
+    if commands and binary_port:
+        binary_sockets.append(listen_tcp(host, binary_port))
+    if commands and binary_path:
+        binary_sockets.append(listen_unix(binary_path))
+
+    ServiceApplication(app, service_class, {
+        'bind': f'{host}:{port}',
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': threads,
+        'keepalive': KEEPALIVE_TIMEOUT,
+        'graceful_timeout': GRACEFUL_TIMEOUT,
+    }, commands, binary_sockets, binary_path).run()
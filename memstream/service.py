@@ -0,0 +1,116 @@
+import threading
+import time
+
+from .client import DEFAULT_LIBRARY, Cache, CacheError
+from .log import ServiceLogger
+
+SLOW_OPERATION_MS = 100.0
+
+
+class Presence:
+    """Announces a node: registration when it starts, a heartbeat every
+    interval seconds while it runs and the DOWN messages when it stops"""
+
+    def __init__(self, logger: ServiceLogger, interval: float):
+        self.logger = logger
+        self.interval = interval
+        self.shutdown_event = threading.Event()
+        self.logger.registration("UP")
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat_loop)
+        self.heartbeat_thread.daemon = False
+        self.heartbeat_thread.start()
+
+    def heartbeat_loop(self):
+        """Continuous heartbeat sender"""
+        while not self.shutdown_event.is_set():
+            self.logger.heartbeat("UP")
+            self.shutdown_event.wait(timeout=self.interval)
+
+    def stop(self):
+        self.shutdown_event.set()
+        if self.heartbeat_thread.is_alive():
+            print("Stopping heartbeat thread...")
+            self.heartbeat_thread.join(timeout=5)
+
+        self.logger.warn("node going off", "0", "0")
+        self.logger.registration("DOWN")
+        self.logger.heartbeat("DOWN")
+
+
+class CacheService:
+    """Registration, heartbeats, logging and cleanup common to every service.
+
+    Subclasses set node_id and service_name and add their cache operations
+    on top of self.cache. With announce=False the service only logs, for
+    processes whose node is announced by another one (serve's workers).
+    """
+
+    node_id = "Cache_Service"
+    service_name = "CacheService"
+    heartbeat_interval = 5
+
+    def __init__(self, library: str = DEFAULT_LIBRARY, announce: bool = True):
+        self.logger = ServiceLogger(self.node_id, self.service_name)
+        self.init_cache(library)
+        self.presence = Presence(self.logger, self.heartbeat_interval) if announce else None
+        self.running = True
+
+    def log_info(self, message: str, sampled: bool = False, **kwargs):
+        """Queue INFO level log message; per-operation logs pass sampled=True"""
+        self.logger.info(message, sampled=sampled, **kwargs)
+
+    def log_warn(self, message: str, response_time_ms: float, threshold_limit_ms: float):
+        """Queue WARN level log message"""
+        self.logger.warn(message, response_time_ms, threshold_limit_ms)
+
+    def log_error(self, message: str, error_code: str, error_message: str):
+        """Queue ERROR level log message"""
+        self.logger.error(message, error_code, error_message)
+
+    def log_if_slow(self, message: str, start_time: float):
+        """Queue a WARN when an operation started at start_time took too long"""
+        response_time = (time.time() - start_time) * 1000
+        if response_time > SLOW_OPERATION_MS:
+            self.log_warn(message, response_time, SLOW_OPERATION_MS)
+
+    def init_cache(self, library: str):
+        """Initialize cache connection"""
+        try:
+            self.cache = Cache(library)
+        except CacheError as e:
+            self.log_error(
+                "Cache connection failed",
+                "CONN_ERROR",
+                str(e)
+            )
+            raise
+        except Exception as e:
+            self.log_error(
+                "Cache initialization failed",
+                "INIT_ERROR",
+                str(e)
+            )
+            raise
+
+        self.log_info("Cache connection established successfully")
+
+    def cleanup(self):
+        """Cleanup before exit"""
+        if hasattr(self, 'running') and self.running:
+            print("Starting cleanup process...")
+            self.running = False
+
+            try:
+                if self.presence is not None:
+                    self.presence.stop()
+            except Exception as e:
+                print(f"Error during cleanup: {str(e)}")
+            finally:
+                try:
+                    if hasattr(self, 'logger'):
+                        print("Flushing and closing logger...")
+                        self.logger.close()
+                        print("Logger closed")
+                except Exception as e:
+                    print(f"Error closing logger: {str(e)}")
+                print("Cleanup completed")
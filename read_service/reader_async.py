@@ -0,0 +1,134 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from memstream.binary import READ_COMMANDS, BinaryServer, listen_tcp, listen_unix
+from reader import BINARY_PORT, BINARY_SOCKET, STREAM_CHUNK, CacheReadService
+
+# The same endpoints as reader.py, served from one event loop so thousands
+# of idle or slow keep-alive connections cost a coroutine each rather than
+# a thread. Cache calls run on a small pool of their own; libcache releases
+# the GIL around each call, and logging only queues records for the
+# logger's sender thread, so neither stalls the loop.
+
+CACHE_THREADS = int(os.getenv('MEMSTREAM_CACHE_THREADS', '4'))
+KEEPALIVE_TIMEOUT = int(os.getenv('MEMSTREAM_KEEPALIVE', '5'))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.cache = CacheReadService()
+    app.state.executor = ThreadPoolExecutor(max_workers=CACHE_THREADS,
+                                            thread_name_prefix='cache')
+    binary = BinaryServer(app.state.cache, READ_COMMANDS, app.state.executor)
+    sockets = []
+    if BINARY_PORT:
+        sockets.append(listen_tcp('0.0.0.0', BINARY_PORT))
+    if BINARY_SOCKET:
+        sockets.append(listen_unix(BINARY_SOCKET))
+    await binary.start(sockets)
+    try:
+        yield
+    finally:
+        binary.close()
+        if BINARY_SOCKET and os.path.exists(BINARY_SOCKET):
+            os.unlink(BINARY_SOCKET)
+        app.state.executor.shutdown(wait=True)
+        app.state.cache.cleanup()
+
+
+async def run(request, fn, *args):
+    """Run a blocking cache function on the cache pool"""
+    return await asyncio.get_running_loop().run_in_executor(
+        request.app.state.executor, fn, *args)
+
+
+async def call(request, method, *args):
+    """Run one of the service's cache methods on the cache pool"""
+    return await run(request, getattr(request.app.state.cache, method), *args)
+
+
+async def get_value(request):
+    key = request.path_params['key']
+    value = await call(request, 'get', key)
+
+    if value is not None:
+        return JSONResponse({
+            'key': key,
+            'value': value.decode('utf-8', errors='replace')
+        })
+    return JSONResponse({'error': f'Key not found: {key}'}, status_code=404)
+
+
+async def get_raw_value(request):
+    key = request.path_params['key']
+    ref = await call(request, 'get_ref', key)
+    if ref is None:
+        return JSONResponse({'error': f'Key not found: {key}'}, status_code=404)
+
+    size = len(ref.view)
+
+    async def stream():
+        # Each chunk is copied once, straight from shared memory; a slow
+        # client only keeps its own coroutine waiting between chunks
+        try:
+            for start in range(0, size, STREAM_CHUNK):
+                yield bytes(ref.view[start:start + STREAM_CHUNK])
+        finally:
+            # Submitted even if the stream was cancelled; release() takes a
+            # shard lock, so it runs on the pool rather than the loop
+            await run(request, ref.release)
+
+    # The background task covers a client that goes away before the first
+    # chunk; release() is idempotent, so running it twice is fine
+    return StreamingResponse(stream(), media_type='application/octet-stream',
+                             headers={'Content-Length': str(size)},
+                             background=BackgroundTask(run, request, ref.release))
+
+
+async def mget_values(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    keys = data.get('keys') if isinstance(data, dict) else None
+
+    if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+        return JSONResponse({'error': 'Missing keys'}, status_code=400)
+
+    values = await call(request, 'mget', keys)
+    return JSONResponse({'values': {
+        key: value.decode('utf-8', errors='replace') if value is not None else None
+        for key, value in values.items()
+    }})
+
+
+async def check_exists(request):
+    key = request.path_params['key']
+    value = await call(request, 'get', key)
+
+    return JSONResponse({
+        'key': key,
+        'exists': value is not None
+    })
+
+
+app = Starlette(lifespan=lifespan, routes=[
+    Route('/get/{key}', get_value, methods=['GET']),
+    Route('/get/{key}/raw', get_raw_value, methods=['GET']),
+    Route('/mget', mget_values, methods=['POST']),
+    Route('/exists/{key}', check_exists, methods=['GET']),
+])
+
+if __name__ == '__main__':
+    # Per-request access lines would be written from the loop; the service
+    # already logs operations through its queue
+    uvicorn.run(app, host='0.0.0.0', port=4003, access_log=False,
+                timeout_keep_alive=KEEPALIVE_TIMEOUT)
@@ -7,5 +7,9 @@
 # Wait for Fluentd to start
 sleep 2
 
-# Start the Python service
-python3 /app/reader.py
\ No newline at end of file
+# Start the Python service; READER_MODE=async runs the asyncio front-end
+if [ "$READER_MODE" = "async" ]; then
+    python3 /app/reader_async.py
+else
+    python3 /app/reader.py
+fi
\ No newline at end of file
@@ -0,0 +1,180 @@
+// bench.c
+#include <stdio.h>
+#include <string.h>
+#include <time.h>
+#include "../cache.h"
+
+// Latency of get, set and mget against a running cache manager at several
+// resident key counts. "get rand" looks keys up in random order, so once the
+// working set outgrows the TLB it shows what huge pages (-H) save; run it
+// against a manager started with and without -H, and with -n 1M -m 128M so
+// the larger sizes fit. The last line says which pages the segment really
+// got, since -H falls back to normal pages when none are reserved.
+
+#define VALUE_SIZE 32
+#define OPS 200000
+#define BATCH 64
+
+static double now_ns(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1e9 + ts.tv_nsec;
+}
+
+static uint64_t xorshift(uint64_t* state) {
+    uint64_t x = *state;
+    x ^= x << 13;
+    x ^= x >> 7;
+    x ^= x << 17;
+    return *state = x;
+}
+
+static void make_key(char* buf, size_t len, const char* prefix, size_t i) {
+    snprintf(buf, len, "%s:%zu", prefix, i);
+}
+
+static void run(size_t resident) {
+    char key[64];
+    char value[VALUE_SIZE];
+    char buffer[VALUE_SIZE];
+    memset(value, 'v', sizeof(value));
+
+    cache_stats_t before, after;
+    cache_get_stats(&before);
+    size_t loaded = 0;
+    for (size_t i = 0; i < resident; i++) {
+        make_key(key, sizeof(key), "bench", i);
+        if (cache_set(key, value, sizeof(value)) != 0) {
+            break;
+        }
+        loaded++;
+    }
+    if (loaded == 0) {
+        printf("%8zu keys: could not load any keys\n", resident);
+        return;
+    }
+    cache_get_stats(&after);
+    if (after.total_entries - before.total_entries < loaded) {
+        printf("%8zu keys: skipped, the cache holds only %zu of them\n", resident,
+               after.total_entries - before.total_entries);
+        for (size_t i = 0; i < loaded; i++) {
+            make_key(key, sizeof(key), "bench", i);
+            cache_delete(key);
+        }
+        return;
+    }
+
+    double start = now_ns();
+    for (size_t i = 0; i < OPS; i++) {
+        make_key(key, sizeof(key), "bench", i % loaded);
+        size_t size = sizeof(buffer);
+        cache_get(key, buffer, &size);
+    }
+    double hit_ns = (now_ns() - start) / OPS;
+
+    uint64_t state = 0x9e3779b97f4a7c15ULL;
+    start = now_ns();
+    for (size_t i = 0; i < OPS; i++) {
+        make_key(key, sizeof(key), "bench", xorshift(&state) % loaded);
+        size_t size = sizeof(buffer);
+        cache_get(key, buffer, &size);
+    }
+    double random_ns = (now_ns() - start) / OPS;
+
+    start = now_ns();
+    for (size_t i = 0; i < OPS; i++) {
+        make_key(key, sizeof(key), "missing", i);
+        size_t size = sizeof(buffer);
+        cache_get(key, buffer, &size);
+    }
+    double miss_ns = (now_ns() - start) / OPS;
+
+    start = now_ns();
+    for (size_t i = 0; i < OPS; i++) {
+        make_key(key, sizeof(key), "bench", i % loaded);
+        cache_set(key, value, sizeof(value));
+    }
+    double set_ns = (now_ns() - start) / OPS;
+
+    static char batch_keys[BATCH][64];
+    static char batch_bufs[BATCH][VALUE_SIZE];
+    const char* keys[BATCH];
+    void* bufs[BATCH];
+    size_t sizes[BATCH];
+    start = now_ns();
+    for (size_t i = 0; i < OPS; i += BATCH) {
+        for (size_t j = 0; j < BATCH; j++) {
+            make_key(batch_keys[j], sizeof(batch_keys[j]), "bench", (i + j) % loaded);
+            keys[j] = batch_keys[j];
+            bufs[j] = batch_bufs[j];
+            sizes[j] = VALUE_SIZE;
+        }
+        cache_mget(BATCH, keys, bufs, sizes, NULL);
+    }
+    double mget_ns = (now_ns() - start) / OPS;
+
+    printf("%8zu keys: get hit %8.1f ns  get rand %8.1f ns  get miss %8.1f ns"
+           "  set %8.1f ns  mget %8.1f ns/key\n",
+           loaded, hit_ns, random_ns, miss_ns, set_ns, mget_ns);
+
+    for (size_t i = 0; i < loaded; i++) {
+        make_key(key, sizeof(key), "bench", i);
+        cache_delete(key);
+    }
+}
+
+// Print the segment's mapping, its page size and how much of it the kernel
+// maps with transparent huge pages, from /proc/self/smaps
+static void print_pages(void) {
+    FILE* smaps = fopen("/proc/self/smaps", "r");
+    if (!smaps) {
+        return;
+    }
+    char line[512];
+    char path[sizeof(line)] = "";
+    int found = 0;
+    size_t page_kb = 0, pmd_kb = 0, value;
+    while (fgets(line, sizeof(line), smaps)) {
+        char* colon = strchr(line, ':');
+        if (!colon || colon > strchr(line, ' ')) {
+            // A mapping's header (address range, permissions, ..., path),
+            // not a "Field: value" line
+            if (found) {
+                break;
+            }
+            char* name = strstr(line, "memstream.");
+            if (name) {
+                found = 1;
+                while (name > line && name[-1] != ' ') {
+                    name--;
+                }
+                snprintf(path, sizeof(path), "%s", name);
+                path[strcspn(path, "\n")] = '\0';
+            }
+        } else if (found && sscanf(line, "KernelPageSize: %zu kB", &value) == 1) {
+            page_kb = value;
+        } else if (found && (sscanf(line, "ShmemPmdMapped: %zu kB", &value) == 1 ||
+                             sscanf(line, "FilePmdMapped: %zu kB", &value) == 1)) {
+            pmd_kb += value;
+        }
+    }
+    fclose(smaps);
+    if (found) {
+        printf("segment %s: %zu kB pages, %zu kB in transparent huge pages\n",
+               path, page_kb, pmd_kb);
+    }
+}
+
+int main() {
+    if (cache_connect() != 0) {
+        fprintf(stderr, "Failed to connect to cache - Is cache manager running?\n");
+        return 1;
+    }
+
+    const size_t sizes[] = {10, 1000, 10000, 100000, 1000000};
+    for (size_t i = 0; i < sizeof(sizes) / sizeof(sizes[0]); i++) {
+        run(sizes[i]);
+    }
+    print_pages();
+    return 0;
+}
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# bench_client.py
+
+# Operations per second of the ctypes and compiled (_fastcache) paths of
+# memstream.Cache against a running cache manager, from one thread and from
+# several threads sharing one Cache. mget and mset are counted per key.
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from memstream import Cache
+
+LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libcache.so')
+KEYS = 1000
+VALUE = b'v' * 32
+OPS = 100000
+BATCH = 64
+THREADS = int(os.getenv('BENCH_THREADS', '8'))
+
+
+def run(cache: Cache, op: str, threads: int) -> float:
+    keys = [f"bench:{i}" for i in range(KEYS)]
+    batches = [keys[i:i + BATCH] for i in range(0, KEYS, BATCH)]
+    items = {key: VALUE for key in keys[:BATCH]}
+    per_thread = OPS // threads
+
+    def worker():
+        if op == 'get':
+            for i in range(per_thread):
+                cache.get(keys[i % KEYS])
+        elif op == 'set':
+            for i in range(per_thread):
+                cache.set(keys[i % KEYS], VALUE)
+        elif op == 'mget':
+            for i in range(per_thread // BATCH):
+                cache.mget(batches[i % len(batches)])
+        elif op == 'mset':
+            for i in range(per_thread // BATCH):
+                cache.mset(items)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return per_thread * threads / elapsed
+
+
+def main():
+    paths = [('ctypes', Cache(LIBRARY, native=False))]
+    try:
+        paths.append(('native', Cache(LIBRARY, native=True)))
+    except Exception as e:
+        print(f"Compiled path unavailable ({e}), only measuring ctypes")
+
+    for i in range(KEYS):
+        paths[0][1].set(f"bench:{i}", VALUE)
+
+    print(f"{'':8}{'threads':>8}" + ''.join(f"{op:>14}" for op in ('get', 'set', 'mget', 'mset')))
+    for name, cache in paths:
+        for threads in (1, THREADS):
+            rates = [run(cache, op, threads) for op in ('get', 'set', 'mget', 'mset')]
+            print(f"{name:8}{threads:>8}" + ''.join(f"{rate / 1000:>10.1f} k/s"
+                                                    for rate in rates))
+
+    paths[0][1].mdel([f"bench:{i}" for i in range(KEYS)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Checks that a CacheValueRef unpins its value however it goes away, and
+# not while a view of it is still in use.
+# Needs a running cache_manager.
+
+import ctypes
+import gc
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from memstream import Cache
+
+KEY = b"ref_test_key"
+
+
+def ctypes_address(ref):
+    return ctypes.addressof(ref.view.obj)
+
+
+def pinned(cache, value: bytes) -> bool:
+    """An unpinned value of the same size is overwritten where it is; a
+    pinned one makes the update move to a new block"""
+    before = cache.get_ref(KEY)
+    start = ctypes_address(before)
+    before.release()
+    cache.set(KEY, value)
+    after = cache.get_ref(KEY)
+    moved = ctypes_address(after) != start
+    after.release()
+    return moved
+
+
+def run_tests(cache: Cache) -> bool:
+    ok = True
+
+    print("Test 1: An update moves a pinned value")
+    cache.set(KEY, b"a" * 4096)
+    ref = cache.get_ref(KEY)
+    start = ctypes_address(ref)
+    cache.set(KEY, b"b" * 4096)
+    moved = cache.get_ref(KEY)
+    result = ctypes_address(moved) != start and bytes(ref.view[:1]) == b"a"
+    moved.release()
+    ref.release()
+    print(f"Pinned value kept: {'Success' if result else 'Failed'}")
+    ok &= result
+
+    print("\nTest 2: release() twice unpins once")
+    ref = cache.get_ref(KEY)
+    ref.release()
+    ref.release()
+    result = not pinned(cache, b"c" * 4096)
+    print(f"Value unpinned: {'Success' if result else 'Failed'}")
+    ok &= result
+
+    print("\nTest 3: A dropped ref unpins its value")
+    ref = cache.get_ref(KEY)
+    del ref
+    gc.collect()
+    result = not pinned(cache, b"d" * 4096)
+    print(f"Value unpinned: {'Success' if result else 'Failed'}")
+    ok &= result
+
+    print("\nTest 4: Dropped refs free values replaced while they were pinned")
+    # Each round orphans a 4 KiB block; more rounds than the whole cache
+    # holds would run out of space if the orphans were never freed
+    value_size = 4096
+    rounds = cache.stats().total_size // value_size + 1
+    evictions = cache.stats().evictions
+    result = True
+    for i in range(rounds):
+        ref = cache.get_ref(KEY)
+        result &= cache.set(KEY, bytes([i % 256]) * value_size)
+        del ref
+    gc.collect()
+    result &= cache.stats().evictions == evictions
+    print(f"Space recovered over {rounds} rounds: {'Success' if result else 'Failed'}")
+    ok &= result
+
+    print("\nTest 5: A view outlives the ref it came from")
+    cache.set(KEY, b"g" * 4096)
+    view = cache.get_ref(KEY).view
+    gc.collect()
+    cache.set(KEY, b"h" * 4096)
+    result = bytes(view) == b"g" * 4096
+    del view
+    gc.collect()
+    result &= not pinned(cache, b"i" * 4096)
+    print(f"Value kept while viewed: {'Success' if result else 'Failed'}")
+    ok &= result
+
+    cache.delete(KEY)
+    return ok
+
+
+if __name__ == "__main__":
+    cache = Cache(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libcache.so'))
+    passed = run_tests(cache)
+    print(f"\n{'All tests passed' if passed else 'Some tests failed'}")
+    sys.exit(0 if passed else 1)
@@ -1,46 +1,29 @@
 #!/usr/bin/env python3
 # cache_repl.py
 
-from ctypes import *
+import os
 import sys
-import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from memstream import Cache, CacheError
 
 class CacheInterface:
     def __init__(self):
         try:
-            # Load the shared library
-            self.lib = CDLL("../libcache.so")
-            self.setup_functions()
-
-            # Connect to existing cache
-            if self.lib.cache_connect() != 0:
-                print("Failed to connect to cache. Is cache manager running?")
-                sys.exit(1)
+            # Load the shared library and connect to the existing cache
+            self.cache = Cache("../libcache.so")
             print("Successfully connected to cache")
 
+        except CacheError as e:
+            print(str(e))
+            sys.exit(1)
         except Exception as e:
             print(f"Failed to initialize cache interface: {str(e)}")
             sys.exit(1)
 
-    def setup_functions(self):
-        # cache_set
-        self.lib.cache_set.argtypes = [c_char_p, c_void_p, c_size_t]
-        self.lib.cache_set.restype = c_int
-
-        # cache_get
-        self.lib.cache_get.argtypes = [c_char_p, c_void_p, POINTER(c_size_t)]
-        self.lib.cache_get.restype = c_int
-
-        # cache_delete
-        self.lib.cache_delete.argtypes = [c_char_p]
-        self.lib.cache_delete.restype = c_int
-
     def set(self, key: str, value: str) -> bool:
         try:
-            key_bytes = key.encode('utf-8')
-            value_bytes = value.encode('utf-8')
-            result = self.lib.cache_set(key_bytes, value_bytes, len(value_bytes))
-            if result == 0:
+            if self.cache.set(key, value):
                 print(f"Successfully set key '{key}' with value '{value}'")
                 return True
             else:
@@ -50,15 +33,11 @@ class CacheInterface:
             print(f"Error setting key: {str(e)}")
             return False
 
-    def get(self, key: str, max_size: int = 1024) -> str:
+    def get(self, key: str) -> str:
         try:
-            key_bytes = key.encode('utf-8')
-            buffer = create_string_buffer(max_size)
-            size = c_size_t(max_size)
-
-            result = self.lib.cache_get(key_bytes, buffer, byref(size))
-            if result == 0:
-                value = buffer.value.decode('utf-8')
+            value = self.cache.get(key)
+            if value is not None:
+                value = value.decode('utf-8', errors='replace')
                 print(f"Value for key '{key}': '{value}'")
                 return value
             else:
@@ -70,9 +49,7 @@ class CacheInterface:
 
     def delete(self, key: str) -> bool:
         try:
-            key_bytes = key.encode('utf-8')
-            result = self.lib.cache_delete(key_bytes)
-            if result == 0:
+            if self.cache.delete(key):
                 print(f"Successfully deleted key '{key}'")
                 return True
             else:
@@ -1,11 +1,11 @@
 // test.c
 #include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
 #include <unistd.h>
 #include <errno.h>
-#include <sys/shm.h>
 #include <sys/types.h>
-#include <sys/ipc.h>
+#include <sys/stat.h>
 #include "../cache.h"
 #include "../cache_internal.h"
 
@@ -17,6 +17,8 @@ void print_stats() {
         printf("Used Size: %zu bytes\n", stats.used_size);
         printf("Hits: %zu\n", stats.hits);
         printf("Misses: %zu\n", stats.misses);
+        printf("Evictions: %zu\n", stats.evictions);
+        printf("Expired: %zu, Reaped: %zu\n", stats.expired, stats.reaped);
     } else {
         printf("Failed to get cache stats - Is cache manager running?\n");
     }
@@ -25,18 +27,9 @@ void print_stats() {
 int main() {
     printf("Starting cache tests...\n");
 
-    // Check shared memory segment
-    int shm_id = shmget(SHM_KEY, 0, 0);
-    if (shm_id == -1) {
-        printf("Cannot access shared memory segment - Cache manager not running?\n");
-        printf("Error: %s\n", strerror(errno));
-        return 1;
-    }
-    printf("Found shared memory segment ID: %d\n", shm_id);
-
-    // Connect to existing cache
+    // Connect to existing cache ($MEMSTREAM_NAME, or the default one)
     if (cache_connect() != 0) {
-        printf("Failed to connect to cache\n");
+        printf("Failed to connect to cache - Cache manager not running?\n");
         return 1;
     }
     printf("Successfully connected to cache\n");
@@ -124,6 +117,179 @@ int main() {
 
     print_stats();
 
+    // Test 6: Churn must not let values overlap
+    printf("\nTest 6: Churn Test\n");
+    const char *small = "tiny";
+    const char *large = "a value that is much longer than the one it replaces";
+    int churn_ok = 1;
+    for (int i = 0; i < 100; i++) {
+        cache_set("churn_a", small, strlen(small) + 1);
+        cache_set("churn_b", small, strlen(small) + 1);
+        cache_set("churn_a", large, strlen(large) + 1);
+        cache_delete("churn_b");
+        cache_set("churn_b", small, strlen(small) + 1);
+
+        size = sizeof(buffer);
+        if (cache_get("churn_a", buffer, &size) != 0 || strcmp(buffer, large) != 0) {
+            churn_ok = 0;
+        }
+        size = sizeof(buffer);
+        if (cache_get("churn_b", buffer, &size) != 0 || strcmp(buffer, small) != 0) {
+            churn_ok = 0;
+        }
+        cache_delete("churn_a");
+        cache_delete("churn_b");
+    }
+    printf(churn_ok ? "Values stayed intact across updates and deletes\n"
+                    : "Values were corrupted by churn\n");
+
+    print_stats();
+
+    // Test 7: A pinned value must survive updates and deletes of its key
+    printf("\nTest 7: Zero-copy Get\n");
+    const void* ref;
+    size_t ref_size;
+    cache_set("ref_key", small, strlen(small) + 1);
+    if (cache_get_ref("ref_key", &ref, &ref_size) == 0) {
+        printf("Pinned value: %s (%zu bytes)\n", (const char*)ref, ref_size);
+        cache_set("ref_key", large, strlen(large) + 1);
+        cache_set("ref_key", "x", 2);
+        cache_delete("ref_key");
+        cache_compact(1024 * 1024);
+        printf(strcmp((const char*)ref, small) == 0
+                   ? "Pinned value unchanged after update and delete\n"
+                   : "Pinned value was overwritten\n");
+        cache_release_ref(ref);
+    } else {
+        printf("Zero-copy get failed\n");
+    }
+
+    print_stats();
+
+    // Test 8: A short buffer reports the length it needs
+    printf("\nTest 8: Buffer Too Small\n");
+    cache_set("long_key", large, strlen(large) + 1);
+    size = 4;
+    if (cache_get("long_key", buffer, &size) == CACHE_ERR_TOO_SMALL &&
+        size == strlen(large) + 1 &&
+        cache_get("long_key", buffer, &size) == 0) {
+        printf("Short buffer reported %zu bytes needed, retry succeeded\n", size);
+    } else {
+        printf("Short buffer was not reported correctly\n");
+    }
+    cache_delete("long_key");
+
+    // Test 9: Batched calls
+    printf("\nTest 9: Batch Operations\n");
+    const char* batch_keys[] = {"batch_1", "batch_2", "batch_3", "batch_missing"};
+    const void* batch_in[] = {"one", "two", "three"};
+    size_t batch_in_sizes[] = {4, 4, 6};
+    char batch_bufs[4][16];
+    void* batch_out[] = {batch_bufs[0], batch_bufs[1], batch_bufs[2], batch_bufs[3]};
+    size_t batch_sizes[] = {16, 16, 16, 16};
+    int batch_results[4];
+    printf("mset stored %d of 3 keys\n", cache_mset(3, batch_keys, batch_in, batch_in_sizes, NULL));
+    int batch_hits = cache_mget(4, batch_keys, batch_out, batch_sizes, batch_results);
+    printf("mget found %d of 4 keys: %s %s %s, missing key %s\n", batch_hits,
+           batch_bufs[0], batch_bufs[1], batch_bufs[2],
+           batch_results[3] == -1 ? "reported as a miss" : "not reported");
+    printf("mdel removed %d of 4 keys\n", cache_mdel(4, batch_keys, NULL));
+
+    // Test 10: Keys with a TTL read as misses once it has passed
+    printf("\nTest 10: Expiry\n");
+    cache_set_ex("ttl_key", small, strlen(small) + 1, 100);
+    size = sizeof(buffer);
+    int before = cache_get("ttl_key", buffer, &size);
+    usleep(150 * 1000);
+    size = sizeof(buffer);
+    int after = cache_get("ttl_key", buffer, &size);
+    cache_set_ex("ttl_reaped", small, strlen(small) + 1, 1);
+    usleep(10 * 1000);
+    size_t reaped = cache_reap(1000000);
+    printf(before == 0 && after == -1
+               ? "Key readable before its TTL and gone after it\n"
+               : "Key did not expire correctly\n");
+    printf("Reaper removed %zu expired keys\n", reaped);
+
+    print_stats();
+
+    // Test 11: Keys are stored behind their values, so they must survive
+    // values growing and shrinking in place, and prefixes must not match
+    printf("\nTest 11: Key Lengths\n");
+    char long_key[201];
+    int keys_ok = 1;
+    for (int len = 1; len <= 200; len++) {
+        memset(long_key, 'k', len);
+        long_key[len] = '\0';
+        cache_set(long_key, large, (size_t)len % 40 + 1);
+        cache_set(long_key, large, (size_t)len % 7 + 1);
+    }
+    for (int len = 1; len <= 200; len++) {
+        memset(long_key, 'k', len);
+        long_key[len] = '\0';
+        size = sizeof(buffer);
+        if (cache_get(long_key, buffer, &size) != 0 || size != (size_t)len % 7 + 1 ||
+            memcmp(buffer, large, size) != 0) {
+            keys_ok = 0;
+        }
+        cache_delete(long_key);
+    }
+    printf(keys_ok ? "Keys of 1 to 200 bytes kept their own values\n"
+                   : "Keys of different lengths were mixed up\n");
+
+    // Test 12: Instances are picked by name, one per process
+    printf("\nTest 12: Cache Names\n");
+    int names_ok = cache_connect_name("bad/name") != 0 &&
+                   cache_connect_name("") != 0 &&
+                   cache_connect_name(NULL) == 0;
+    const char* other = strcmp(getenv("MEMSTREAM_NAME") ? getenv("MEMSTREAM_NAME") : "",
+                               "other") == 0 ? "another" : "other";
+    names_ok = names_ok && cache_connect_name(other) != 0;
+    printf(names_ok ? "Invalid and second cache names were refused\n"
+                    : "Cache names were not checked\n");
+
+    // Test 13: A snapshot brings keys back as they were when it was saved,
+    // and a damaged one is refused as a whole
+    printf("\nTest 13: Snapshots\n");
+    const char* snapshot = "/tmp/memstream_test.snap";
+    cache_set("snap_key", "saved", 6);
+    cache_set_ex("snap_ttl", "short", 6, 100);
+    long saved = cache_snapshot_save(snapshot);
+    cache_set("snap_key", "changed", 8);
+    usleep(150 * 1000);
+    long loaded = cache_snapshot_load(snapshot);
+    size = sizeof(buffer);
+    int snap_ok = saved >= 2 && loaded == saved - 1 &&
+                  cache_get("snap_key", buffer, &size) == 0 && strcmp(buffer, "saved") == 0;
+    FILE* damaged = fopen(snapshot, "r+b");
+    if (damaged) {
+        fseek(damaged, -1, SEEK_END);
+        fputc('X', damaged);
+        fclose(damaged);
+    }
+    snap_ok = snap_ok && cache_snapshot_load(snapshot) == -1;
+    printf(snap_ok ? "Snapshot saved %ld keys and restored them\n"
+                   : "Snapshot round trip failed (%ld saved)\n", saved);
+    cache_delete("snap_key");
+    unlink(snapshot);
+
+    // Test 14: Replaying a log stops at the first damaged record and cuts
+    // the file there, so later appends stay readable
+    printf("\nTest 14: Log Replay\n");
+    const char* log_path = "/tmp/memstream_test.wal";
+    FILE* log = fopen(log_path, "wb");
+    if (log) {
+        fputs("not a log record", log);
+        fclose(log);
+    }
+    struct stat log_info;
+    int replay_ok = cache_wal_replay("/tmp/memstream_missing.wal") == 0 &&
+                    cache_wal_replay(log_path) == 0 &&
+                    stat(log_path, &log_info) == 0 && log_info.st_size == 0;
+    printf(replay_ok ? "Damaged log was cut back to its last good record\n"
+                     : "Damaged log was not handled\n");
+    unlink(log_path);
+
     printf("\nTests completed. Cache manager continues running.\n");
     printf("You can run these tests multiple times while cache manager is running.\n");
 